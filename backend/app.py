@@ -1,19 +1,50 @@
-import eventlet
-eventlet.monkey_patch()
+import os
+# "eventlet" (Flask-SocketIO on a monkey-patched hub, this module's entry point) or
+# "asgi" (python-socketio AsyncServer, see asgi_app.py, which sets this before importing us)
+SERVER_MODE = os.getenv("SERVER_MODE", "eventlet").lower()
+if SERVER_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
 # --- Add necessary imports ---
 import json
 import requests
-import os
+import httpx # Shared keep-alive client for the OpenAI SDK used by ChatOpenAI
 import threading
 import uuid # For generating unique run IDs
 import traceback # For detailed error logging
 import re # Import regex for sanitization
 import random # <<< Import random for generating rates >>>
+import time # For cache TTLs and timing
+import sqlite3 # Default persistent backend for run results
+import base64 # Opaque pagination cursors for /results
+import hashlib # Content-addressed completion cache keys
+import gzip # Compressed /results/<run_id> bodies
+from datetime import datetime # Parsing ISO timestamps in /results filters
+import multiprocessing # For the out-of-process crew executor
+import asyncio # ResilientRequester.post_async, used by the ASGI server's hierarchy client
+import queue as queue_module # For queue.Empty from the IPC event queue
+import socket as socket_module # Host name for WORKER_ID
+from abc import ABC, abstractmethod # ResultStore interface
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque # For LRU bookkeeping and the run queue
 from dotenv import load_dotenv # To load environment variables from .env file
-from flask import Flask, request, jsonify # Import Flask
+try:
+    import brotli # Optional: "br" Content-Encoding for /results/<run_id> (gzip is used without it)
+except ImportError:
+    brotli = None
+try:
+    import msgpack # Optional: MessagePack-encoded run events for clients that opt in (SOCKETIO_MSGPACK_ENABLED)
+except ImportError:
+    msgpack = None
+from flask import Flask, Response, request, jsonify # Import Flask
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room # Import Flask-SocketIO
+from requests.adapters import HTTPAdapter
 from typing import Any, Dict, List, Union, Optional, TYPE_CHECKING
+from run_registry import ( # State shared by server workers and nodes (multi-worker mode)
+    connect as connect_run_registry, RunRegistry, RunEventLog, RedisRunEventLog, RedisResults,
+    RedisRateBuckets, RedisHierarchyEntries, RedisSimilarityFeed, RedisModelHealth, RedisSubscriberCounts,
+)
 
 # --- CrewAI Imports ---
 from crewai import Agent, Task, Crew, Process
@@ -22,6 +53,8 @@ from langchain_openai import ChatOpenAI
 # --- LangChain Callback Imports ---
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain_core.outputs import LLMResult # To access token usage
+from langchain_core.caches import BaseCache # Completion cache interface used by ChatOpenAI
+from langchain_core.load import dumps as lc_dumps, loads as lc_loads # (De)serialize cached generations
 
 # Import Task for type hinting in callbacks
 from crewai import Task as CrewTask
@@ -34,20 +67,796 @@ if TYPE_CHECKING:
 load_dotenv()
 
 # --- Configuration ---
-HIERARCHY_API_ENDPOINT = "https://api.openai.com/v1/chat/completions"
+HIERARCHY_API_ENDPOINT = os.getenv("HIERARCHY_API_ENDPOINT", "https://api.openai.com/v1/chat/completions")
 HIERARCHY_API_KEY = os.getenv("OPENAI_API_KEY")
+CREW_LLM_BASE_URL = os.getenv("CREW_LLM_BASE_URL") or None # OpenAI-compatible base URL for crew agents (e.g. the benchmark stub)
+
+# Hierarchy cache: validated hierarchy JSON keyed by normalized task description
+HIERARCHY_CACHE_ENABLED = os.getenv("HIERARCHY_CACHE_ENABLED", "True").lower() in ["true", "1", "t"]
+HIERARCHY_CACHE_MAX_ENTRIES = int(os.getenv("HIERARCHY_CACHE_MAX_ENTRIES", 256))
+HIERARCHY_CACHE_TTL_SECONDS = float(os.getenv("HIERARCHY_CACHE_TTL_SECONDS", 3600))
+# Similarity index: hierarchies of finished runs are reused for near-duplicate tasks (MinHash/LSH over task words)
+HIERARCHY_SIMILARITY_ENABLED = os.getenv("HIERARCHY_SIMILARITY_ENABLED", "True").lower() in ["true", "1", "t"]
+HIERARCHY_SIMILARITY_THRESHOLD = float(os.getenv("HIERARCHY_SIMILARITY_THRESHOLD", 0.8)) # Jaccard similarity needed for reuse
+HIERARCHY_SIMILARITY_MAX_ENTRIES = int(os.getenv("HIERARCHY_SIMILARITY_MAX_ENTRIES", 1024))
+HIERARCHY_SIMILARITY_BANDS = int(os.getenv("HIERARCHY_SIMILARITY_BANDS", 16)) # LSH bands; more bands = more candidates
+HIERARCHY_SIMILARITY_ROWS = int(os.getenv("HIERARCHY_SIMILARITY_ROWS", 4)) # MinHash values per band
+
+# Connection pooling for outbound HTTP (hierarchy call + crew LLM calls)
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 4)) # Distinct hosts kept in the requests pool
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 32)) # Keep-alive sockets per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 45))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+
+# Hierarchy call resilience: hedged duplicate after an adaptive latency percentile, jittered retries, circuit breaker
+HIERARCHY_HEDGE_ENABLED = os.getenv("HIERARCHY_HEDGE_ENABLED", "True").lower() in ["true", "1", "t"]
+HIERARCHY_HEDGE_PERCENTILE = float(os.getenv("HIERARCHY_HEDGE_PERCENTILE", 0.95)) # Hedge once a request outlives this latency percentile
+HIERARCHY_HEDGE_INITIAL_DELAY_SECONDS = float(os.getenv("HIERARCHY_HEDGE_INITIAL_DELAY_SECONDS", 8)) # Until enough latencies are observed
+HIERARCHY_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HIERARCHY_HEDGE_MIN_DELAY_SECONDS", 1))
+HIERARCHY_HEDGE_MAX_DELAY_SECONDS = float(os.getenv("HIERARCHY_HEDGE_MAX_DELAY_SECONDS", 20))
+HIERARCHY_HEDGE_MIN_SAMPLES = int(os.getenv("HIERARCHY_HEDGE_MIN_SAMPLES", 10))
+HIERARCHY_RETRY_ATTEMPTS = int(os.getenv("HIERARCHY_RETRY_ATTEMPTS", 3)) # Total attempts for transient failures
+HIERARCHY_RETRY_BASE_SECONDS = float(os.getenv("HIERARCHY_RETRY_BASE_SECONDS", 0.5)) # Full-jitter exponential backoff base
+HIERARCHY_RETRY_MAX_SECONDS = float(os.getenv("HIERARCHY_RETRY_MAX_SECONDS", 8))
+HIERARCHY_BREAKER_FAILURE_THRESHOLD = int(os.getenv("HIERARCHY_BREAKER_FAILURE_THRESHOLD", 5)) # Consecutive failed calls before opening
+HIERARCHY_BREAKER_RESET_SECONDS = float(os.getenv("HIERARCHY_BREAKER_RESET_SECONDS", 30)) # Open time before a half-open probe
+
+# OpenAI rate limiting shared by every run in the process: token buckets for requests and tokens per minute, per model.
+# RATE_LIMIT_MODELS overrides the defaults per model, e.g. {"gpt-4o": {"rpm": 500, "tpm": 30000}}; 0 = unlimited.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() in ["true", "1", "t"]
+RATE_LIMIT_DEFAULT_RPM = float(os.getenv("RATE_LIMIT_DEFAULT_RPM", 500))
+RATE_LIMIT_DEFAULT_TPM = float(os.getenv("RATE_LIMIT_DEFAULT_TPM", 200000))
+RATE_LIMIT_MODELS = os.getenv("RATE_LIMIT_MODELS", '{"gpt-4o": {"rpm": 500, "tpm": 30000}}')
+RATE_LIMIT_COMPLETION_ESTIMATE_TOKENS = int(os.getenv("RATE_LIMIT_COMPLETION_ESTIMATE_TOKENS", 500)) # When a call sets no max_tokens
+
+# Admission control for crew runs
+RUN_MAX_CONCURRENT = int(os.getenv("RUN_MAX_CONCURRENT", 4)) # Crews executing at the same time
+RUN_MAX_QUEUE = int(os.getenv("RUN_MAX_QUEUE", 32)) # Runs allowed to wait for a slot before /run rejects
+RUN_QUEUE_RETRY_AFTER_SECONDS = int(os.getenv("RUN_QUEUE_RETRY_AFTER_SECONDS", 30))
+# Single-flight: identical submissions (same sanitized task and options) attach to the run already in flight.
+# Default for runs that do not send "single_flight" themselves.
+SINGLE_FLIGHT_DEFAULT = os.getenv("SINGLE_FLIGHT_DEFAULT", "False").lower() in ["true", "1", "t"]
+
+# Crew executor: "inline" runs crews as green threads in the web worker,
+# "process" runs them in a pool of worker processes and relays events back
+CREW_EXECUTOR_MODE = os.getenv("CREW_EXECUTOR_MODE", "inline").lower()
+CREW_PROCESS_WORKERS = int(os.getenv("CREW_PROCESS_WORKERS", os.cpu_count() or 2))
+CREW_EVENT_RELAY_INTERVAL = float(os.getenv("CREW_EVENT_RELAY_INTERVAL", 0.05)) # Seconds between IPC queue drains
+CREW_RELAY_DRAIN_TIMEOUT = float(os.getenv("CREW_RELAY_DRAIN_TIMEOUT", 5.0)) # Max seconds a finished run waits for its queued events to be relayed
+
+# Socket.IO log batching (opt-in per run with "batch_logs": true, or by default via LOG_BATCH_DEFAULT)
+LOG_BATCH_DEFAULT = os.getenv("LOG_BATCH_DEFAULT", "False").lower() in ["true", "1", "t"]
+LOG_BATCH_INTERVAL = float(os.getenv("LOG_BATCH_INTERVAL", 0.25)) # Max seconds an event waits in the buffer
+LOG_BATCH_MAX_EVENTS = int(os.getenv("LOG_BATCH_MAX_EVENTS", 25)) # Buffer size that triggers an immediate flush
+
+# Token streaming (opt-in per run with "stream_tokens": true, or by default via STREAM_TOKENS_DEFAULT)
+STREAM_TOKENS_DEFAULT = os.getenv("STREAM_TOKENS_DEFAULT", "False").lower() in ["true", "1", "t"]
+STREAM_TOKEN_FLUSH_INTERVAL = float(os.getenv("STREAM_TOKEN_FLUSH_INTERVAL", 0.15)) # Seconds between llm_token frames
+STREAM_TOKEN_FLUSH_CHARS = int(os.getenv("STREAM_TOKEN_FLUSH_CHARS", 400)) # Buffered characters that force a frame
+
+# Per-run event ring buffers for resuming clients (join_room with since_seq)
+RUN_EVENT_BUFFER_SIZE = int(os.getenv("RUN_EVENT_BUFFER_SIZE", 1000)) # Events kept per run
+RUN_EVENT_LOG_MAX_RUNS = int(os.getenv("RUN_EVENT_LOG_MAX_RUNS", 200)) # Runs whose buffers are kept (LRU)
+
+# Crew execution: "sequential" (one task after another) or "level_parallel"
+# (agents sharing a hierarchy level run concurrently; each level gets the previous level's outputs)
+CREW_EXECUTION_MODE_DEFAULT = os.getenv("CREW_EXECUTION_MODE", "sequential").lower()
+CREW_EXECUTION_MODES = ("sequential", "level_parallel")
+
+# Streamed hierarchy generation (opt-in per run with "stream_hierarchy": true, or via HIERARCHY_STREAMING_DEFAULT):
+# agent objects are parsed as the completion arrives and each Agent/Task is built as soon as its object closes.
+HIERARCHY_STREAMING_DEFAULT = os.getenv("HIERARCHY_STREAMING_DEFAULT", "False").lower() in ["true", "1", "t"]
+
+# Per-agent model routing (opt-in per run with "model_routing": true, or via MODEL_ROUTING_DEFAULT).
+# Rules are tried in order (cheapest/fastest first); an agent takes the first rule its hierarchy estimates fit
+# ("max_tokens", "max_cost_per_million") whose model is healthy, else CREW_LLM_MODEL.
+MODEL_ROUTING_DEFAULT = os.getenv("MODEL_ROUTING_DEFAULT", "False").lower() in ["true", "1", "t"]
+MODEL_ROUTING_RULES = os.getenv("MODEL_ROUTING_RULES", '[{"model": "gpt-4o-mini", "max_tokens": 2000, "max_cost_per_million": 5}]')
+MODEL_ROUTING_MAX_ERROR_RATE = float(os.getenv("MODEL_ROUTING_MAX_ERROR_RATE", 0.25)) # Above this a model is skipped
+MODEL_ROUTING_MAX_LATENCY_SECONDS = float(os.getenv("MODEL_ROUTING_MAX_LATENCY_SECONDS", 30)) # EWMA call latency; 0 = no limit
+MODEL_ROUTING_MIN_SAMPLES = int(os.getenv("MODEL_ROUTING_MIN_SAMPLES", 5)) # Calls observed before health checks apply
+MODEL_ROUTING_EWMA_ALPHA = float(os.getenv("MODEL_ROUTING_EWMA_ALPHA", 0.2))
+MODEL_ROUTING_RETRY_AFTER_SECONDS = float(os.getenv("MODEL_ROUTING_RETRY_AFTER_SECONDS", 120)) # Degraded models get a fresh start after this
+
+# Context compaction between tasks: "off", "truncate", "extractive" or "summary" (cheap-model summary,
+# falls back to extractive). Outputs larger than the budget are compacted before the next task sees them.
+CONTEXT_COMPACTION_MODE_DEFAULT = os.getenv("CONTEXT_COMPACTION_MODE", "off").lower()
+CONTEXT_COMPACTION_MODES = ("off", "truncate", "extractive", "summary")
+CONTEXT_COMPACTION_BUDGET_TOKENS = int(os.getenv("CONTEXT_COMPACTION_BUDGET_TOKENS", 1500)) # Per task output handed on
+CONTEXT_COMPACTION_SUMMARY_MODEL = os.getenv("CONTEXT_COMPACTION_SUMMARY_MODEL", "gpt-4o-mini")
+
+# Result storage
+RESULT_STORE_BACKEND = os.getenv("RESULT_STORE_BACKEND", "sqlite").lower() # "sqlite", "memory" or "redis" (the run registry, for several nodes)
+RESULT_STORE_PATH = os.getenv("RESULT_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "crew_results.db"))
+RESULT_STORE_HOT_ENTRIES = int(os.getenv("RESULT_STORE_HOT_ENTRIES", 64)) # Recently used results kept in memory
+RESULT_STORE_MAX_RUNS = int(os.getenv("RESULT_STORE_MAX_RUNS", 10000)) # Oldest runs beyond this are evicted (0 = unbounded)
+RESULT_STORE_RETENTION_SECONDS = float(os.getenv("RESULT_STORE_RETENTION_SECONDS", 7 * 24 * 3600)) # 0 = keep forever
+RESULT_STORE_PRUNE_EVERY = int(os.getenv("RESULT_STORE_PRUNE_EVERY", 50)) # Writes between retention sweeps
+RESULTS_PAGE_DEFAULT_LIMIT = int(os.getenv("RESULTS_PAGE_DEFAULT_LIMIT", 100))
+RESULTS_PAGE_MAX_LIMIT = int(os.getenv("RESULTS_PAGE_MAX_LIMIT", 1000))
+RESULTS_QUERY_PARAMS = ("limit", "cursor", "status", "since", "until", "min_cost", "min_tokens", "view")
+RESULT_COMPRESSION_MIN_BYTES = int(os.getenv("RESULT_COMPRESSION_MIN_BYTES", 1024)) # Smaller /results/<run_id> bodies are sent uncompressed
+RESULT_GZIP_LEVEL = int(os.getenv("RESULT_GZIP_LEVEL", 6))
+RESULT_BROTLI_QUALITY = int(os.getenv("RESULT_BROTLI_QUALITY", 5))
+RESULT_BODY_CACHE_ENTRIES = int(os.getenv("RESULT_BODY_CACHE_ENTRIES", 8)) # Projected/compressed bodies cached per snapshot
+
+# Multi-worker mode: several gunicorn workers / nodes behind one address (the web client connects over websocket only, so no sticky sessions are needed)
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE") or None # e.g. redis://localhost:6379/0; fans emits out to clients on every worker
+RUN_REGISTRY_URL = os.getenv("RUN_REGISTRY_URL", SOCKETIO_MESSAGE_QUEUE or "") # Shared run state (event log, queue positions, single-flight); "" = this process only
+RUN_REGISTRY_TTL_SECONDS = int(os.getenv("RUN_REGISTRY_TTL_SECONDS", 24 * 3600)) # Expiry of a run's shared events and state
+RUN_REGISTRY_FLIGHT_TTL_SECONDS = int(os.getenv("RUN_REGISTRY_FLIGHT_TTL_SECONDS", 1800)) # Single-flight claims left by a crashed worker expire after this
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket_module.gethostname()}:{os.getpid()}"
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1))) # Server workers on this host; more than one needs SOCKETIO_MESSAGE_QUEUE and the run registry
+
+# MessagePack run events: clients that join_room with "encoding": "msgpack" get run events as binary frames (JSON clients are unaffected)
+SOCKETIO_MSGPACK_ENABLED = os.getenv("SOCKETIO_MSGPACK_ENABLED", "False").lower() in ["true", "1", "t"]
+MSGPACK_SUBSCRIBERS_CACHE_SECONDS = float(os.getenv("MSGPACK_SUBSCRIBERS_CACHE_SECONDS", 1.0)) # How long a worker trusts the run registry's "no msgpack subscribers elsewhere"
+
+# LLM completion cache shared across runs (opt-in per run with "use_completion_cache": true, or via COMPLETION_CACHE_DEFAULT)
+COMPLETION_CACHE_DEFAULT = os.getenv("COMPLETION_CACHE_DEFAULT", "False").lower() in ["true", "1", "t"]
+COMPLETION_CACHE_MEMORY_ENTRIES = int(os.getenv("COMPLETION_CACHE_MEMORY_ENTRIES", 512))
+COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "completion_cache.db")) # "" = memory tier only
+COMPLETION_CACHE_DISK_MAX_MB = float(os.getenv("COMPLETION_CACHE_DISK_MAX_MB", 256))
+COMPLETION_CACHE_TTL_SECONDS = float(os.getenv("COMPLETION_CACHE_TTL_SECONDS", 24 * 3600)) # 0 = no expiry
+COMPLETION_CACHE_PRUNE_EVERY = int(os.getenv("COMPLETION_CACHE_PRUNE_EVERY", 25)) # Disk writes between size/TTL sweeps
 
 # --- Flask App and SocketIO Setup ---
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag"]) # Lets browser dashboards read ETags for If-None-Match polling
 # Secret key is needed for session management used by SocketIO
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'a_default_secret_key_for_dev_123!')
 # Allow all origins for development; restrict in production!
-socketio = SocketIO(app, cors_allowed_origins="*")
+# In ASGI mode this instance only supplies the emitter interface until asgi_app binds its own (see bind_emitter)
+# With SOCKETIO_MESSAGE_QUEUE set, emits are published to the queue and delivered by whichever worker holds the client
+# (asgi_app attaches the queue to its own AsyncServer instead)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading" if SERVER_MODE == "asgi" else None, message_queue=SOCKETIO_MESSAGE_QUEUE if SERVER_MODE != "asgi" else None)
+
+# --- Metrics (Prometheus Text Exposition) ---
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class MetricsRegistry:
+    """
+    Small in-process registry of counters and histograms, rendered in the Prometheus
+    text format by /metrics. Gauges (runs in flight, queue depth, ...) are read at
+    scrape time from registered collector functions.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {} # name -> (type, help, buckets); insertion order = render order
+        self._counters: Dict[tuple, float] = {} # (name, labels) -> value
+        self._histograms: Dict[tuple, Dict[str, Any]] = {} # (name, labels) -> cumulative bucket counts, sum, count
+        self._collectors: List = []
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("counter", help_text, None)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = METRICS_LATENCY_BUCKETS) -> None:
+        self._meta[name] = ("histogram", help_text, tuple(sorted(buckets)))
+
+    def collector(self, fn):
+        """Registers fn() -> [(name, type, help, [(labels_dict, value), ...]), ...]."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _label_key(labels: Dict[str, Any]) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = (name, self._label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        buckets = self._meta[name][2]
+        key = (name, self._label_key(labels))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    entry["buckets"][index] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+        pairs = list(labels) + list(extra or ())
+        if not pairs: return ""
+        escaped = []
+        for key, value in pairs:
+            value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        return repr(float(value)) if value != int(value) else str(int(value))
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {"buckets": list(entry["buckets"]), "sum": entry["sum"], "count": entry["count"]}
+                          for key, entry in self._histograms.items()}
+        lines: List[str] = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric_name, labels), value in counters.items():
+                    if metric_name == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+                continue
+            for (metric_name, labels), entry in histograms.items():
+                if metric_name != name: continue
+                for bound, count in zip(buckets, entry["buckets"]):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', repr(float(bound))),))} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {entry['count']}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {repr(float(entry['sum']))}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {entry['count']}")
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Warning: metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{self._format_labels(self._label_key(labels))} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.counter("crew_runs_total", "Completed crew runs by final status and execution mode.")
+metrics.histogram("crew_run_phase_seconds", "Duration of crew run phases (queue_wait, llm_init, hierarchy_generation, agent_construction, crew_execution, total).")
+metrics.histogram("crew_task_seconds", "Duration of individual crew tasks.")
+metrics.histogram("crew_llm_call_seconds", "Duration of individual LLM calls made by crew agents, by model.")
+metrics.counter("crew_llm_errors_total", "Failed LLM calls made by crew agents, by model.")
+metrics.counter("crew_llm_tokens_total", "LLM tokens consumed by crew agents, by kind (prompt/completion).")
+metrics.histogram("crew_hierarchy_request_seconds", "End-to-end hierarchy API calls (hedges and retries included), by outcome.")
+metrics.histogram("crew_rate_limit_wait_seconds", "Time LLM calls queued on the shared RPM/TPM limiter before being sent, by model.")
+metrics.counter("crew_socketio_emits_total", "Socket.IO events emitted to run rooms, by event and log type.")
+metrics.counter("crew_result_responses_total", "/results/<run_id> responses by outcome (full, projected, not_modified) and content encoding.")
+
+def record_metric(kind: str, name: str, value: float = 1.0, **labels: Any) -> None:
+    """
+    Increments a counter (kind "inc") or observes a histogram sample (kind "observe").
+    Crew worker processes forward the update to the web process, which serves /metrics.
+    """
+    if in_crew_worker_process():
+        _worker_event_queue.put(("metric", kind, name, value, labels))
+        return
+    if kind == "inc":
+        metrics.inc(name, value, **labels)
+    else:
+        metrics.observe(name, value, **labels)
+
+# --- Shared Run Registry (Multi-Worker Mode) ---
+registry_redis = connect_run_registry(RUN_REGISTRY_URL, WORKER_ID, HTTP_CONNECT_TIMEOUT)
+if WEB_CONCURRENCY > 1 and (SOCKETIO_MESSAGE_QUEUE is None or registry_redis is None):
+    # Each worker would only reach its own clients, runs and results
+    print(f"CRITICAL ERROR: Cannot start server - WEB_CONCURRENCY={WEB_CONCURRENCY} needs SOCKETIO_MESSAGE_QUEUE and a reachable run registry (RUN_REGISTRY_URL). Set them, or run a single worker.")
+    raise SystemExit(1)
+
+# --- Result Storage ---
+def summarize_result(run_id: str, result_data: Dict[str, Any], created_at: float) -> Dict[str, Any]:
+    """Slim projection of a run used by the /results listing (no outputs or hierarchy)."""
+    agent_usage = result_data.get('agent_token_usage') or {}
+    total_tokens = sum(int(usage.get('total_tokens', 0) or 0) for usage in agent_usage.values())
+    if not total_tokens and isinstance(result_data.get('usage_metrics'), dict):
+        total_tokens = int(result_data['usage_metrics'].get('total_tokens', 0) or 0)
+    estimated_cost = sum(float(usage.get('estimated_cost_usd', 0) or 0) for usage in agent_usage.values())
+    task_description = result_data.get('task_description') or ''
+    return {
+        "run_id": run_id,
+        "status": 'error' if result_data.get('error') else 'success',
+        "created_at": created_at,
+        "duration_seconds": result_data.get('duration_seconds'),
+        "total_tokens": total_tokens,
+        "estimated_cost_usd": round(estimated_cost, 6),
+        "task_description": task_description[:120],
+    }
+
+def encode_results_cursor(created_at: float, run_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at!r}|{run_id}".encode('utf-8')).decode('ascii')
+
+def decode_results_cursor(cursor: str) -> tuple:
+    """Returns (created_at, run_id); raises ValueError for malformed cursors."""
+    try:
+        created_at, run_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return float(created_at), run_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Encodes a response body as "br" or "gzip" (mtime=0 keeps gzip output byte-stable)."""
+    if encoding == "br":
+        return brotli.compress(body, quality=RESULT_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=RESULT_GZIP_LEVEL, mtime=0)
+
+class ResultSnapshot:
+    """
+    Immutable view of a finished run, serialized exactly once when the run is frozen.
+    `json_bytes` is served as-is by the HTTP endpoints; `result` is parsed lazily from
+    it, so the snapshot never aliases the caller's dict, and is shared between readers
+    and must not be mutated.
+    Field projections and compressed encodings of the body are also built once and cached.
+    """
+    __slots__ = ("run_id", "status", "json_bytes", "summary", "_result", "_run_complete_payload", "_etag", "_bodies")
+
+    def __init__(self, run_id: str, status: str, json_bytes: bytes, result: Optional[Dict[str, Any]] = None, summary: Optional[Dict[str, Any]] = None):
+        self.run_id = run_id
+        self.status = status
+        self.json_bytes = json_bytes
+        self.summary = summary
+        self._result = result
+        self._run_complete_payload: Optional[Dict[str, Any]] = None
+        self._etag: Optional[str] = None
+        self._bodies: Dict[tuple, bytes] = {} # (fields, encoding) -> body
+
+    @classmethod
+    def freeze(cls, run_id: str, result_data: Dict[str, Any]) -> "ResultSnapshot":
+        status = 'error' if result_data.get('error') else 'success'
+        json_bytes = json.dumps(result_data, default=str).encode('utf-8')
+        summary = summarize_result(run_id, result_data, time.time())
+        return cls(run_id, status, json_bytes, None, summary)
+
+    @property
+    def result(self) -> Dict[str, Any]:
+        if self._result is None:
+            self._result = json.loads(self.json_bytes)
+        return self._result
+
+    def etag(self, fields: Optional[tuple] = None) -> str:
+        """
+        Weak ETag of the body (or of its `fields` projection). Derived from the stored
+        JSON, so every worker and restart agrees on it; weak because the bytes on the
+        wire also depend on the negotiated Content-Encoding.
+        """
+        if self._etag is None:
+            self._etag = hashlib.blake2b(self.json_bytes, digest_size=16).hexdigest()
+        if not fields:
+            return f'W/"{self._etag}"'
+        fields_digest = hashlib.blake2b(",".join(fields).encode('utf-8'), digest_size=4).hexdigest()
+        return f'W/"{self._etag}-{fields_digest}"'
+
+    def body(self, fields: Optional[tuple] = None, encoding: str = "identity") -> bytes:
+        """
+        The result JSON, or just its top-level `fields` (sorted names; "status" is the run
+        status, unknown names are left out), encoded as "identity", "gzip" or "br".
+        """
+        if not fields and encoding == "identity":
+            return self.json_bytes
+        key = (fields, encoding)
+        body = self._bodies.get(key)
+        if body is not None:
+            return body
+        if encoding != "identity":
+            body = compress_body(self.body(fields), encoding)
+        else:
+            result = self.result
+            projected = {name: self.status if name == "status" else result[name] for name in fields if name == "status" or name in result}
+            body = json.dumps(projected, default=str).encode('utf-8')
+        if len(self._bodies) < RESULT_BODY_CACHE_ENTRIES:
+            self._bodies[key] = body
+        return body
+
+    def run_complete_payload(self) -> Dict[str, Any]:
+        """The `run_complete` event body for replaying this run, built once per snapshot."""
+        if self._run_complete_payload is None:
+            self._run_complete_payload = {
+                'run_id': self.run_id,
+                'status': self.status,
+                'error': self.result.get('error'),
+                'final_result': self.result,
+            }
+        return self._run_complete_payload
+
+class ResultStore(ABC):
+    """
+    Storage interface for finished run results.
+    Results are frozen into ResultSnapshots on `put`. Implementations keep a
+    small hot LRU of snapshots in memory and apply retention (max age) and
+    eviction (max run count) policies. Reads of hot snapshots take no lock.
+    """
+    def __init__(self, hot_entries: int = 64, max_runs: int = 0, retention_seconds: float = 0):
+        self.hot_entries = max(0, hot_entries)
+        self.max_runs = max(0, max_runs)
+        self.retention_seconds = max(0.0, retention_seconds)
+        self._hot: "OrderedDict[str, ResultSnapshot]" = OrderedDict()
+        self._hot_lock = threading.Lock() # Guards writes/evictions only
+        self.hot_hits = 0
+        self.hot_misses = 0
+        self.evicted = 0
+
+    # Hot LRU helpers shared by all backends
+    def _hot_get(self, run_id: str) -> Optional[ResultSnapshot]:
+        snapshot = self._hot.get(run_id) # Single dict lookup, atomic under the GIL
+        if snapshot is None:
+            self.hot_misses += 1
+            return None
+        try:
+            self._hot.move_to_end(run_id) # Best-effort recency bump
+        except KeyError:
+            pass # Evicted concurrently; the snapshot we hold is still valid
+        self.hot_hits += 1
+        return snapshot
+
+    def _hot_put(self, run_id: str, snapshot: ResultSnapshot) -> None:
+        if not self.hot_entries: return
+        with self._hot_lock:
+            self._hot[run_id] = snapshot
+            self._hot.move_to_end(run_id)
+            while len(self._hot) > self.hot_entries:
+                self._hot.popitem(last=False)
+
+    def _hot_discard(self, run_ids: List[str]) -> None:
+        with self._hot_lock:
+            for run_id in run_ids:
+                self._hot.pop(run_id, None)
+
+    @abstractmethod
+    def put(self, run_id: str, result_data: Dict[str, Any]) -> ResultSnapshot: ...
+    @abstractmethod
+    def get_snapshot(self, run_id: str) -> Optional[ResultSnapshot]: ...
+    @abstractmethod
+    def contains(self, run_id: str) -> bool: ...
+    @abstractmethod
+    def list_run_ids(self) -> List[str]: ...
+    @abstractmethod
+    def prune(self) -> int: ...
+    @abstractmethod
+    def count(self) -> int: ...
+
+    @abstractmethod
+    def query_summaries(self, limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                        since: Optional[float] = None, until: Optional[float] = None,
+                        min_cost: Optional[float] = None, min_tokens: Optional[int] = None) -> tuple:
+        """
+        Returns (summaries, next_cursor), newest first. `cursor` is the opaque value
+        returned as `next_cursor` by the previous page; next_cursor is None on the last page.
+        """
+
+    def get(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the (shared, read-only) result dict for a run, if stored."""
+        snapshot = self.get_snapshot(run_id)
+        return snapshot.result if snapshot else None
+
+    def stats(self) -> Dict[str, Any]:
+        hot_size = len(self._hot)
+        return {
+            "backend": type(self).__name__,
+            "runs": self.count(),
+            "hot_size": hot_size,
+            "hot_entries": self.hot_entries,
+            "hot_hits": self.hot_hits,
+            "hot_misses": self.hot_misses,
+            "max_runs": self.max_runs,
+            "retention_seconds": self.retention_seconds,
+            "evicted": self.evicted,
+        }
 
-# --- In-memory storage (Consider replacing with DB) ---
-crew_results_storage = {}
-storage_lock = threading.Lock() # Keep using lock for this shared storage
+class MemoryResultStore(ResultStore):
+    """
+    Process-local store (lost on restart) with the same retention/eviction policies.
+    Every snapshot already lives in memory, so the hot LRU is unused and left out of stats().
+    """
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._results: "OrderedDict[str, tuple]" = OrderedDict() # run_id -> (created_at, snapshot), oldest first
+        self._lock = threading.Lock() # Guards writes/evictions only
+
+    def put(self, run_id: str, result_data: Dict[str, Any]) -> ResultSnapshot:
+        snapshot = ResultSnapshot.freeze(run_id, result_data)
+        with self._lock:
+            self._results[run_id] = (snapshot.summary["created_at"], snapshot)
+            self._results.move_to_end(run_id)
+        self.prune()
+        return snapshot
+
+    def get_snapshot(self, run_id: str) -> Optional[ResultSnapshot]:
+        entry = self._results.get(run_id)
+        return entry[1] if entry else None
+
+    def contains(self, run_id: str) -> bool:
+        return run_id in self._results
+
+    def list_run_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._results.keys())
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+    def query_summaries(self, limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                        since: Optional[float] = None, until: Optional[float] = None,
+                        min_cost: Optional[float] = None, min_tokens: Optional[int] = None) -> tuple:
+        after = decode_results_cursor(cursor) if cursor else None
+        with self._lock:
+            summaries = [snapshot.summary for _, snapshot in self._results.values()]
+        # Insertion order can disagree with created_at (stamped before the lock) and with the run_id tie-break
+        summaries.sort(key=lambda summary: (summary["created_at"], summary["run_id"]), reverse=True)
+        page: List[Dict[str, Any]] = []
+        for summary in summaries:
+            key = (summary["created_at"], summary["run_id"])
+            if after is not None and key >= after: continue
+            if status and summary["status"] != status: continue
+            if since is not None and summary["created_at"] < since: continue
+            if until is not None and summary["created_at"] > until: continue
+            if min_cost is not None and summary["estimated_cost_usd"] < min_cost: continue
+            if min_tokens is not None and summary["total_tokens"] < min_tokens: continue
+            page.append(summary)
+            if len(page) > limit: break
+        next_cursor = encode_results_cursor(page[limit - 1]["created_at"], page[limit - 1]["run_id"]) if len(page) > limit else None
+        return page[:limit], next_cursor
+
+    def prune(self) -> int:
+        removed = 0
+        cutoff = time.time() - self.retention_seconds if self.retention_seconds else None
+        with self._lock:
+            while self._results:
+                oldest_id, (created_at, _) = next(iter(self._results.items()))
+                too_old = cutoff is not None and created_at < cutoff
+                too_many = self.max_runs and len(self._results) > self.max_runs
+                if not (too_old or too_many): break
+                del self._results[oldest_id]
+                removed += 1
+            self.evicted += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        for key in ("hot_size", "hot_entries", "hot_hits", "hot_misses"):
+            del stats[key]
+        return stats
+
+class SQLiteResultStore(ResultStore):
+    """
+    SQLite-backed store (WAL mode) so results survive restarts and can be shared
+    by several worker processes on the same host. Full results are stored as JSON;
+    `run_id` (primary key) and `created_at` are indexed for lookups and retention.
+    """
+    SUMMARY_COLUMNS = {
+        "duration_seconds": "REAL",
+        "total_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "estimated_cost_usd": "REAL NOT NULL DEFAULT 0",
+        "task_summary": "TEXT NOT NULL DEFAULT ''",
+    }
+
+    def __init__(self, path: str, prune_every: int = 50, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.path = path
+        self.prune_every = max(1, prune_every)
+        self._writes_since_prune = 0
+        self._lock = threading.Lock() # sqlite3 connections must not be used concurrently
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS run_results ("
+                " run_id TEXT PRIMARY KEY,"
+                " created_at REAL NOT NULL,"
+                " status TEXT NOT NULL,"
+                " result_json TEXT NOT NULL)"
+            )
+            # Summary columns (added after the initial schema, so migrate older databases in place)
+            existing_columns = {row[1] for row in self._conn.execute("PRAGMA table_info(run_results)")}
+            added_columns = [column for column in self.SUMMARY_COLUMNS if column not in existing_columns]
+            for column in added_columns:
+                self._conn.execute(f"ALTER TABLE run_results ADD COLUMN {column} {self.SUMMARY_COLUMNS[column]}")
+            if added_columns:
+                self._backfill_summaries()
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_run_results_created_at ON run_results (created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_run_results_status_created_at ON run_results (status, created_at)")
+            self._conn.commit()
+        self.prune()
+
+    def _backfill_summaries(self) -> None:
+        """Fills the summary columns of rows stored before they existed from their result JSON (caller holds the lock)."""
+        updates = []
+        for run_id, created_at, result_json in self._conn.execute("SELECT run_id, created_at, result_json FROM run_results"):
+            try:
+                summary = summarize_result(run_id, json.loads(result_json), created_at)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Warning: Could not backfill result summary for run {run_id}: {e}")
+                continue
+            updates.append((summary["duration_seconds"], summary["total_tokens"], summary["estimated_cost_usd"], summary["task_description"], run_id))
+        self._conn.executemany(
+            "UPDATE run_results SET duration_seconds = ?, total_tokens = ?, estimated_cost_usd = ?, task_summary = ? WHERE run_id = ?",
+            updates
+        )
+        if updates:
+            print(f"Backfilled result summaries for {len(updates)} stored runs.")
+
+    def put(self, run_id: str, result_data: Dict[str, Any]) -> ResultSnapshot:
+        snapshot = ResultSnapshot.freeze(run_id, result_data)
+        with self._lock:
+            summary = snapshot.summary
+            self._conn.execute(
+                "INSERT OR REPLACE INTO run_results"
+                " (run_id, created_at, status, result_json, duration_seconds, total_tokens, estimated_cost_usd, task_summary)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, summary["created_at"], snapshot.status, snapshot.json_bytes.decode('utf-8'),
+                 summary["duration_seconds"], summary["total_tokens"], summary["estimated_cost_usd"], summary["task_description"])
+            )
+            self._conn.commit()
+            self._writes_since_prune += 1
+            prune_due = self._writes_since_prune >= self.prune_every
+        self._hot_put(run_id, snapshot)
+        if prune_due: self.prune()
+        return snapshot
+
+    def get_snapshot(self, run_id: str) -> Optional[ResultSnapshot]:
+        snapshot = self._hot_get(run_id)
+        if snapshot is not None: return snapshot
+        with self._lock:
+            row = self._conn.execute("SELECT status, result_json FROM run_results WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None: return None
+        # Stored JSON is already the serialized snapshot: no re-encode, parse only if a dict is needed
+        snapshot = ResultSnapshot(run_id, row[0], row[1].encode('utf-8'))
+        self._hot_put(run_id, snapshot)
+        return snapshot
+
+    def contains(self, run_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM run_results WHERE run_id = ?", (run_id,)).fetchone() is not None
+
+    def list_run_ids(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT run_id FROM run_results ORDER BY created_at").fetchall()
+        return [row[0] for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM run_results").fetchone()[0]
+
+    def query_summaries(self, limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                        since: Optional[float] = None, until: Optional[float] = None,
+                        min_cost: Optional[float] = None, min_tokens: Optional[int] = None) -> tuple:
+        clauses: List[str] = []
+        params: List[Any] = []
+        if cursor:
+            cursor_created_at, cursor_run_id = decode_results_cursor(cursor)
+            clauses.append("(created_at < ? OR (created_at = ? AND run_id < ?))")
+            params += [cursor_created_at, cursor_created_at, cursor_run_id]
+        if status:
+            clauses.append("status = ?"); params.append(status)
+        if since is not None:
+            clauses.append("created_at >= ?"); params.append(since)
+        if until is not None:
+            clauses.append("created_at <= ?"); params.append(until)
+        if min_cost is not None:
+            clauses.append("estimated_cost_usd >= ?"); params.append(min_cost)
+        if min_tokens is not None:
+            clauses.append("total_tokens >= ?"); params.append(min_tokens)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = (
+            "SELECT run_id, status, created_at, duration_seconds, total_tokens, estimated_cost_usd, task_summary"
+            f" FROM run_results {where} ORDER BY created_at DESC, run_id DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit + 1]).fetchall()
+        summaries = [{
+            "run_id": row[0], "status": row[1], "created_at": row[2], "duration_seconds": row[3],
+            "total_tokens": row[4], "estimated_cost_usd": row[5], "task_description": row[6],
+        } for row in rows[:limit]]
+        next_cursor = encode_results_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+        return summaries, next_cursor
+
+    def prune(self) -> int:
+        removed_ids: List[str] = []
+        with self._lock:
+            self._writes_since_prune = 0
+            if self.retention_seconds:
+                cutoff = time.time() - self.retention_seconds
+                removed_ids += [row[0] for row in self._conn.execute("SELECT run_id FROM run_results WHERE created_at < ?", (cutoff,))]
+                self._conn.execute("DELETE FROM run_results WHERE created_at < ?", (cutoff,))
+            if self.max_runs:
+                overflow = self._conn.execute("SELECT COUNT(*) FROM run_results").fetchone()[0] - self.max_runs
+                if overflow > 0:
+                    oldest = [row[0] for row in self._conn.execute("SELECT run_id FROM run_results ORDER BY created_at LIMIT ?", (overflow,))]
+                    self._conn.executemany("DELETE FROM run_results WHERE run_id = ?", [(run_id,) for run_id in oldest])
+                    removed_ids += oldest
+            self._conn.commit()
+            self.evicted += len(removed_ids)
+        if removed_ids:
+            self._hot_discard(removed_ids)
+            print(f"Result store pruned {len(removed_ids)} run(s).")
+        return len(removed_ids)
+
+class RedisResultStore(ResultStore):
+    """
+    Store kept in the run registry's Redis (run_registry.RedisResults), so results
+    are shared by every worker and node. Hot snapshots stay per process.
+    """
+    def __init__(self, client: Any, prune_every: int = 50, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.results = RedisResults(client)
+        self.prune_every = max(1, prune_every)
+        self._writes_since_prune = 0
+        self._lock = threading.Lock() # Guards the prune counter only; Redis serializes the writes
+        self.prune()
+
+    def put(self, run_id: str, result_data: Dict[str, Any]) -> ResultSnapshot:
+        snapshot = ResultSnapshot.freeze(run_id, result_data)
+        self.results.write(run_id, snapshot.status, snapshot.json_bytes, snapshot.summary)
+        self._hot_put(run_id, snapshot)
+        with self._lock:
+            self._writes_since_prune += 1
+            prune_due = self._writes_since_prune >= self.prune_every
+        if prune_due: self.prune()
+        return snapshot
+
+    def get_snapshot(self, run_id: str) -> Optional[ResultSnapshot]:
+        snapshot = self._hot_get(run_id)
+        if snapshot is not None: return snapshot
+        stored = self.results.read(run_id)
+        if stored is None: return None
+        snapshot = ResultSnapshot(run_id, *stored)
+        self._hot_put(run_id, snapshot)
+        return snapshot
+
+    def contains(self, run_id: str) -> bool:
+        return run_id in self._hot or self.results.exists(run_id)
+
+    def list_run_ids(self) -> List[str]:
+        return self.results.run_ids()
+
+    def count(self) -> int:
+        return self.results.count()
+
+    def query_summaries(self, limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                        since: Optional[float] = None, until: Optional[float] = None,
+                        min_cost: Optional[float] = None, min_tokens: Optional[int] = None) -> tuple:
+        after = decode_results_cursor(cursor) if cursor else None
+        page = self.results.query(limit, after, status=status, since=since, until=until, min_cost=min_cost, min_tokens=min_tokens)
+        next_cursor = encode_results_cursor(page[limit - 1]["created_at"], page[limit - 1]["run_id"]) if len(page) > limit else None
+        return page[:limit], next_cursor
+
+    def prune(self) -> int:
+        with self._lock:
+            self._writes_since_prune = 0
+        removed_ids = self.results.stale_run_ids(self.retention_seconds, self.max_runs)
+        if removed_ids:
+            self.results.remove(removed_ids)
+            self.evicted += len(removed_ids)
+            self._hot_discard(removed_ids)
+            print(f"Result store pruned {len(removed_ids)} run(s).")
+        return len(removed_ids)
+
+def create_result_store() -> ResultStore:
+    """Builds the configured result store, falling back to SQLite if Redis is unavailable and to memory if SQLite cannot be opened."""
+    policy = dict(hot_entries=RESULT_STORE_HOT_ENTRIES, max_runs=RESULT_STORE_MAX_RUNS, retention_seconds=RESULT_STORE_RETENTION_SECONDS)
+    if RESULT_STORE_BACKEND == "redis":
+        if registry_redis is not None:
+            return RedisResultStore(registry_redis, prune_every=RESULT_STORE_PRUNE_EVERY, **policy)
+        print("Warning: RESULT_STORE_BACKEND=redis needs a reachable RUN_REGISTRY_URL. Falling back to SQLite.")
+    if RESULT_STORE_BACKEND in ("sqlite", "redis"):
+        try:
+            return SQLiteResultStore(RESULT_STORE_PATH, prune_every=RESULT_STORE_PRUNE_EVERY, **policy)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open SQLite result store at {RESULT_STORE_PATH}: {e}. Falling back to memory.")
+    return MemoryResultStore(**policy)
+
+result_store = create_result_store()
+
+# In crew worker processes this forwards results to the web process instead of storing locally
+_result_sink = None
+
+def save_run_result(run_id: str, result_data: Dict[str, Any]) -> None:
+    """
+    Freezes and stores a finished run's result (or forwards it when running inside
+    a crew worker process). `result_data` must not be mutated after this call.
+    """
+    if _result_sink is not None:
+        _result_sink(run_id, result_data)
+        return
+    result_store.put(run_id, result_data)
 
 # --- LLM Configuration for CrewAI ---
 # Check for API key existence
@@ -70,15 +879,1300 @@ def check_api_key(key, key_name="API Key"):
     # Add more sophisticated checks if needed (e.g., placeholder values)
     return True, None
 
-# --- Hierarchy Generation Function (Unchanged) ---
-def create_agent_hierarchy_with_ai(task_description: str) -> str:
-    """Generates agent hierarchy JSON using an AI model."""
-    key_ok, error_msg = check_api_key(HIERARCHY_API_KEY, "Hierarchy Generation API Key (OPENAI_API_KEY)")
-    if not key_ok:
-         print(f"Warning: {error_msg}")
-         # Return error as JSON string, consistent with other returns
-         return json.dumps({"error": error_msg})
+# --- Pooled HTTP Clients ---
+class PooledHttpClients:
+    """
+    Process-wide keep-alive HTTP clients.
+    - `session()` is a pooled `requests.Session` used for the hierarchy call.
+    - `llm_http_client()` is a pooled `httpx.Client` handed to every ChatOpenAI
+      instance so per-run LLM objects (each with their own callbacks) share sockets.
+    Both are created lazily and reused for the lifetime of the worker.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._llm_http_client: Optional[httpx.Client] = None
+        self._counters = {"session_requests": 0, "llm_requests": 0}
+
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """POST through the shared session with the configured (connect, read) timeouts."""
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        with self._lock:
+            self._counters["session_requests"] += 1
+        return self.session().post(url, **kwargs)
+
+    def _on_llm_request(self, request: httpx.Request) -> None:
+        with self._lock:
+            self._counters["llm_requests"] += 1
+
+    def llm_http_client(self) -> httpx.Client:
+        with self._lock:
+            if self._llm_http_client is None:
+                self._llm_http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=HTTP_POOL_MAXSIZE,
+                        max_keepalive_connections=HTTP_POOL_MAXSIZE,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                    ),
+                    timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                    event_hooks={"request": [self._on_llm_request]},
+                )
+            return self._llm_http_client
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = {
+                "config": {
+                    "pool_connections": HTTP_POOL_CONNECTIONS,
+                    "pool_maxsize": HTTP_POOL_MAXSIZE,
+                    "connect_timeout": HTTP_CONNECT_TIMEOUT,
+                    "read_timeout": HTTP_READ_TIMEOUT,
+                    "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+                },
+                **self._counters,
+                "session_pools": [],
+                "llm_pool": None,
+            }
+            session, llm_client = self._session, self._llm_http_client
+
+        # urllib3 pools: num_connections counts sockets opened, num_requests counts requests sent over them
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                pool_manager = getattr(adapter, "poolmanager", None)
+                if pool_manager is None: continue
+                for pool_key in list(pool_manager.pools.keys()):
+                    pool = pool_manager.pools.get(pool_key)
+                    if pool is None: continue
+                    stats["session_pools"].append({
+                        "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                        "connections_opened": pool.num_connections,
+                        "requests": pool.num_requests,
+                        "idle_connections": pool.pool.qsize() if pool.pool is not None else 0,
+                    })
+
+        # httpcore pool internals are not public API, so read them defensively
+        if llm_client is not None:
+            connection_pool = getattr(getattr(llm_client, "_transport", None), "_pool", None)
+            connections = list(getattr(connection_pool, "connections", []) or [])
+            stats["llm_pool"] = {
+                "open_connections": len(connections),
+                "idle_connections": sum(1 for conn in connections if getattr(conn, "is_idle", lambda: False)()),
+            }
+        return stats
+
+http_clients = PooledHttpClients()
+
+
+# --- Resilient Hierarchy Requests ---
+TRANSIENT_HTTP_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised without touching the network while the hierarchy circuit breaker is open."""
+
+def latency_percentile(samples: List[float], percentile: float) -> Optional[float]:
+    """Nearest-rank percentile (0-1) of `samples`, or None when there are none."""
+    if not samples: return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(percentile * len(ordered))) - 1))]
+
+class ResilientRequester:
+    """
+    POSTs through `http_clients` with three layers of protection for a single upstream:
+    - hedging: if an attempt is still pending after the observed latency percentile
+      (clamped to [min_delay, max_delay]), a duplicate is sent and the first usable
+      response wins; the loser's response is closed when it arrives,
+    - retries: connection errors, timeouts and 408/429/5xx are retried with full-jitter
+      exponential backoff (honouring Retry-After up to max_backoff),
+    - circuit breaker: after `failure_threshold` consecutive failed calls the breaker opens
+      and calls fail fast with CircuitOpenError until `reset_seconds` pass; one probe call
+      is then let through (half-open) and closes the breaker on success.
+    Streamed calls (stream=True) return at the response headers, so their latencies drive a
+    separate hedge window and stay out of the end-to-end call latency stats.
+    """
+    def __init__(self, name: str, hedge_enabled: bool = True, hedge_percentile: float = 0.95, initial_hedge_delay: float = 8.0,
+                 min_hedge_delay: float = 1.0, max_hedge_delay: float = 20.0, min_samples: int = 10, max_attempts: int = 3,
+                 backoff_base: float = 0.5, max_backoff: float = 8.0, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.min_samples = max(1, min_samples)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._attempt_latencies: deque = deque(maxlen=200) # Successful single-request latencies (drive the hedge delay)
+        self._stream_attempt_latencies: deque = deque(maxlen=200) # Same, time to headers of streamed requests
+        self._call_latencies: deque = deque(maxlen=500) # End-to-end call latencies incl. hedges and retries (not streamed)
+        self._breaker_state = "closed" # closed | open | half_open
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self.counters = {"calls": 0, "succeeded": 0, "failed": 0, "attempts": 0, "retries": 0,
+                         "hedges_sent": 0, "hedge_wins": 0, "short_circuited": 0, "breaker_opened": 0}
+
+    def hedge_delay(self, streamed: bool = False) -> float:
+        with self._lock:
+            samples = list(self._stream_attempt_latencies if streamed else self._attempt_latencies)
+        if len(samples) < self.min_samples:
+            return self.initial_hedge_delay
+        return min(self.max_hedge_delay, max(self.min_hedge_delay, latency_percentile(samples, self.hedge_percentile)))
+
+    def _backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(self.max_backoff, retry_after))
+        return delay
+
+    def _allow_call(self) -> bool:
+        with self._lock:
+            self.counters["calls"] += 1
+            if self._breaker_state == "open":
+                if time.monotonic() - self._opened_at < self.reset_seconds:
+                    self.counters["short_circuited"] += 1
+                    return False
+                self._breaker_state = "half_open"
+                return True # This call is the probe
+            if self._breaker_state == "half_open":
+                self.counters["short_circuited"] += 1 # A probe is already in flight
+                return False
+            return True
+
+    def _finish_call(self, succeeded: bool, started: float, streamed: bool = False) -> None:
+        duration = time.perf_counter() - started
+        with self._lock:
+            if not streamed: self._call_latencies.append(duration)
+            if succeeded:
+                self.counters["succeeded"] += 1
+                self._consecutive_failures = 0
+                self._breaker_state = "closed"
+            else:
+                self.counters["failed"] += 1
+                self._consecutive_failures += 1
+                if self._breaker_state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                    if self._breaker_state != "open": self.counters["breaker_opened"] += 1
+                    self._breaker_state = "open"
+                    self._opened_at = time.monotonic()
+        if not streamed or not succeeded: # A streamed success is timed by the caller once the body is read
+            record_metric("observe", "crew_hierarchy_request_seconds", duration, outcome="success" if succeeded else "error")
+
+    @staticmethod
+    def _usable(response: Optional[requests.Response]) -> bool:
+        return response is not None and response.status_code not in TRANSIENT_HTTP_STATUSES
+
+    def _hedged_post(self, url: str, kwargs: Dict[str, Any], reserve_extra=None) -> requests.Response:
+        """
+        One logical attempt: the primary request plus, if it is slow, a hedge. Raises the last error if neither is usable.
+        The hedge is only sent if `reserve_extra(blocking=False)` admits it.
+        """
+        streamed = bool(kwargs.get("stream"))
+        results: "queue_module.Queue" = queue_module.Queue()
+        settled = {"done": False}
+        settle_lock = threading.Lock()
+
+        def send(is_hedge: bool) -> None:
+            started = time.perf_counter()
+            try:
+                item = (is_hedge, http_clients.post(url, **kwargs), None, time.perf_counter() - started)
+            except Exception as e:
+                item = (is_hedge, None, e, time.perf_counter() - started)
+            with settle_lock:
+                if not settled["done"]:
+                    results.put(item)
+                    return
+            if item[1] is not None: item[1].close() # Lost the race after the call settled
+
+        def launch(is_hedge: bool) -> None:
+            with self._lock:
+                self.counters["attempts"] += 1
+                if is_hedge: self.counters["hedges_sent"] += 1
+            threading.Thread(target=send, args=(is_hedge,), daemon=True).start()
+
+        launch(False)
+        outstanding = 1
+        hedged = not self.hedge_enabled
+        winner = None
+        failures: List[tuple] = []
+        while outstanding and winner is None:
+            try:
+                item = results.get(timeout=None if hedged else self.hedge_delay(streamed))
+            except queue_module.Empty:
+                hedged = True
+                if reserve_extra is not None and not reserve_extra(blocking=False):
+                    continue # The duplicate would have to queue on the rate limiter: keep waiting on the primary
+                launch(True)
+                outstanding += 1
+                continue
+            outstanding -= 1
+            if self._usable(item[1]):
+                winner = item
+            else:
+                failures.append(item) # A fast failure with nothing outstanding is left to the retry loop
+
+        with settle_lock:
+            settled["done"] = True
+        while True: # Close responses that arrived while the winner was being picked
+            try:
+                leftover = results.get_nowait()
+            except queue_module.Empty:
+                break
+            if leftover[1] is not None: leftover[1].close()
+
+        if winner is not None:
+            is_hedge, response, _, latency = winner
+            with self._lock:
+                (self._stream_attempt_latencies if streamed else self._attempt_latencies).append(latency)
+                if is_hedge: self.counters["hedge_wins"] += 1
+            for failed in failures:
+                if failed[1] is not None: failed[1].close()
+            return response
+        _, response, error, _ = failures[-1]
+        for failed in failures[:-1]:
+            if failed[1] is not None: failed[1].close()
+        if error is not None: raise error
+        return response # Transient status: the retry loop decides what to do with it
+
+    def post(self, url: str, reserve_extra=None, **kwargs: Any) -> requests.Response:
+        """
+        Resilient equivalent of `http_clients.post`. Returns the first usable response (the caller
+        still checks the status); raises CircuitOpenError or the last transient error/response status.
+        `reserve_extra(blocking)` is called before every request beyond the first (hedges with
+        blocking=False, which may refuse; retries with blocking=True), e.g. to take rate-limit quota.
+        """
+        if not self._allow_call():
+            raise CircuitOpenError(f"{self.name} circuit breaker is open; failing fast")
+        streamed = bool(kwargs.get("stream"))
+        started = time.perf_counter()
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_attempts):
+            retry_after = None
+            if attempt and reserve_extra is not None:
+                reserve_extra(blocking=True)
+            try:
+                response = self._hedged_post(url, kwargs, reserve_extra)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                last_error = e
+            except Exception:
+                self._finish_call(False, started, streamed)
+                raise
+            else:
+                if self._usable(response):
+                    # Non-transient 4xx responses mean the upstream is up: they do not trip the breaker
+                    self._finish_call(True, started, streamed)
+                    return response
+                header = response.headers.get("Retry-After")
+                retry_after = float(header) if header and header.isdigit() else None
+                last_error = requests.exceptions.HTTPError(f"{response.status_code} transient error from {self.name}", response=response)
+                response.close()
+            if attempt + 1 < self.max_attempts:
+                with self._lock:
+                    self.counters["retries"] += 1
+                time.sleep(self._backoff(attempt, retry_after))
+        self._finish_call(False, started, streamed)
+        raise last_error
+
+    async def _hedged_post_async(self, send, reserve_extra=None, streamed: bool = False) -> Any:
+        """asyncio counterpart of `_hedged_post`: the slower request of a hedged pair is cancelled once the other settles."""
+        async def attempt(is_hedge: bool) -> tuple:
+            started = time.perf_counter()
+            try:
+                return (is_hedge, await send(), None, time.perf_counter() - started)
+            except Exception as e:
+                return (is_hedge, None, e, time.perf_counter() - started)
+
+        def launch(is_hedge: bool) -> "asyncio.Task":
+            with self._lock:
+                self.counters["attempts"] += 1
+                if is_hedge: self.counters["hedges_sent"] += 1
+            return asyncio.ensure_future(attempt(is_hedge))
+
+        pending = {launch(False)}
+        hedged = not self.hedge_enabled
+        winner = None
+        failures: List[tuple] = []
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, timeout=None if hedged else self.hedge_delay(streamed), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if reserve_extra is None or reserve_extra(blocking=False):
+                    pending.add(launch(True))
+                continue
+            for task in done:
+                item = task.result()
+                if winner is None and self._usable(item[1]):
+                    winner = item
+                else:
+                    failures.append(item)
+        for task in pending:
+            task.cancel()
+
+        if winner is not None:
+            is_hedge, response, _, latency = winner
+            with self._lock:
+                (self._stream_attempt_latencies if streamed else self._attempt_latencies).append(latency)
+                if is_hedge: self.counters["hedge_wins"] += 1
+            for failed in failures:
+                if failed[1] is not None: await failed[1].aclose()
+            return response
+        _, response, error, _ = failures[-1]
+        for failed in failures[:-1]:
+            if failed[1] is not None: await failed[1].aclose()
+        if error is not None: raise error
+        return response
+
+    async def post_async(self, send, retry_errors: tuple, reserve_extra=None, streamed: bool = False) -> Any:
+        """
+        `post` for asyncio callers, with the same breaker, retry and hedge policy and the same stats.
+        `send()` returns an awaitable httpx response (e.g. a partial of httpx.AsyncClient.post);
+        `retry_errors` are the exception types worth retrying. When every attempt got a transient
+        status, the last response is returned for the caller's raise_for_status().
+        """
+        if not self._allow_call():
+            raise CircuitOpenError(f"{self.name} circuit breaker is open; failing fast")
+        started = time.perf_counter()
+        last_error: Optional[Exception] = None
+        response = None
+        for attempt in range(self.max_attempts):
+            retry_after = None
+            if attempt and reserve_extra is not None:
+                await asyncio.to_thread(reserve_extra, blocking=True) # The limiter sleeps while queued
+            try:
+                response = await self._hedged_post_async(send, reserve_extra, streamed)
+            except retry_errors as e:
+                last_error, response = e, None
+            except Exception:
+                self._finish_call(False, started, streamed)
+                raise
+            else:
+                if self._usable(response):
+                    self._finish_call(True, started, streamed)
+                    return response
+                header = response.headers.get("Retry-After")
+                retry_after = float(header) if header and header.isdigit() else None
+            if attempt + 1 < self.max_attempts:
+                with self._lock:
+                    self.counters["retries"] += 1
+                if response is not None: await response.aclose()
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+        self._finish_call(False, started, streamed)
+        if response is not None: return response
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            call_latencies = list(self._call_latencies)
+            counters = dict(self.counters)
+            breaker = {"state": self._breaker_state, "consecutive_failures": self._consecutive_failures,
+                       "failure_threshold": self.failure_threshold, "reset_seconds": self.reset_seconds}
+        return {
+            **counters,
+            "hedge_enabled": self.hedge_enabled,
+            "hedge_delay_seconds": round(self.hedge_delay(), 3),
+            "stream_hedge_delay_seconds": round(self.hedge_delay(streamed=True), 3),
+            "hedge_win_rate": round(counters["hedge_wins"] / counters["hedges_sent"], 4) if counters["hedges_sent"] else 0.0,
+            "latency_seconds": {
+                label: round(value, 3) if value is not None else None
+                for label, value in (("p50", latency_percentile(call_latencies, 0.5)), ("p95", latency_percentile(call_latencies, 0.95)),
+                                     ("p99", latency_percentile(call_latencies, 0.99)), ("max", max(call_latencies) if call_latencies else None))
+            },
+            "breaker": breaker,
+        }
+
+hierarchy_requests = ResilientRequester(
+    "hierarchy API",
+    hedge_enabled=HIERARCHY_HEDGE_ENABLED,
+    hedge_percentile=HIERARCHY_HEDGE_PERCENTILE,
+    initial_hedge_delay=HIERARCHY_HEDGE_INITIAL_DELAY_SECONDS,
+    min_hedge_delay=HIERARCHY_HEDGE_MIN_DELAY_SECONDS,
+    max_hedge_delay=HIERARCHY_HEDGE_MAX_DELAY_SECONDS,
+    min_samples=HIERARCHY_HEDGE_MIN_SAMPLES,
+    max_attempts=HIERARCHY_RETRY_ATTEMPTS,
+    backoff_base=HIERARCHY_RETRY_BASE_SECONDS,
+    max_backoff=HIERARCHY_RETRY_MAX_SECONDS,
+    failure_threshold=HIERARCHY_BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=HIERARCHY_BREAKER_RESET_SECONDS,
+)
+
+
+# --- OpenAI Rate Limiting ---
+class ModelRateLimiter:
+    """
+    Process-wide requests-per-minute and tokens-per-minute token buckets per model.
+    `acquire` reserves one request and the estimated tokens up front; buckets may go
+    into debt, and the caller sleeps until its reservation is covered, so concurrent
+    callers are spaced out in arrival order instead of bursting into 429s.
+    `reconcile` corrects the token reservation once the real usage is known.
+    Buckets are per process: the limits are divided across server workers (WEB_CONCURRENCY)
+    and crew worker processes (see `scale`). With a `shared` backend (run_registry.RedisRateBuckets)
+    the unscaled limits hold for all workers and nodes together; the local buckets then only
+    count this process's calls and stand in while the registry is unreachable.
+    """
+    def __init__(self, default_rpm: float, default_tpm: float, overrides: Dict[str, Dict[str, float]], enabled: bool = True, shared: Any = None):
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.overrides = overrides
+        self.enabled = enabled
+        self.shared = shared
+        self.scale_factor = 1.0
+        self.shared_errors = 0
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, Any]] = {} # model -> {"requests": [level, updated], "tokens": [...], limits, counters}
+
+    @staticmethod
+    def parse_overrides(raw: str) -> Dict[str, Dict[str, float]]:
+        try:
+            overrides = json.loads(raw) if raw else {}
+            if not isinstance(overrides, dict): raise ValueError("expected a JSON object")
+            return {model: limits for model, limits in overrides.items() if isinstance(limits, dict)}
+        except ValueError as e:
+            print(f"Warning: ignoring invalid RATE_LIMIT_MODELS ({e}); default limits apply to every model.")
+            return {}
+
+    @staticmethod
+    def estimate(texts: List[str], max_tokens: Optional[int] = None) -> int:
+        """Prompt tokens of `texts` plus the completion budget (max_tokens or the configured estimate)."""
+        return sum(estimate_tokens(text) for text in texts) + int(max_tokens or RATE_LIMIT_COMPLETION_ESTIMATE_TOKENS)
+
+    def scale(self, factor: float) -> None:
+        with self._lock:
+            self.scale_factor = max(0.0, factor)
+            self._buckets.clear()
+
+    def _limits(self, model: str) -> tuple:
+        """Unscaled (rpm, tpm) configured for a model."""
+        limits = self.overrides.get(model, {})
+        return float(limits.get("rpm", self.default_rpm)), float(limits.get("tpm", self.default_tpm))
+
+    def _bucket(self, model: str) -> Dict[str, Any]:
+        bucket = self._buckets.get(model)
+        if bucket is None:
+            rpm, tpm = (limit * self.scale_factor for limit in self._limits(model))
+            now = time.monotonic()
+            bucket = self._buckets[model] = {
+                "rpm": rpm, "tpm": tpm, "requests": [rpm, now], "tokens": [tpm, now],
+                "calls": 0, "throttled": 0, "wait_seconds": 0.0, "reconciled_tokens": 0,
+            }
+        return bucket
+
+    @staticmethod
+    def _refill(level_and_time: List[float], per_minute: float, now: float) -> None:
+        level, updated = level_and_time
+        level_and_time[0] = min(per_minute, level + (now - updated) * per_minute / 60.0)
+        level_and_time[1] = now
+
+    def _shared_update(self, model: str, mode: str, requests_amount: float, tokens_amount: float) -> Optional[tuple]:
+        """(wait, requests level, tokens level) from the shared buckets, or None without them or when the registry fails."""
+        if self.shared is None: return None
+        rpm, tpm = self._limits(model)
+        try:
+            return self.shared.update(model, mode, rpm, requests_amount, tpm, tokens_amount)
+        except Exception as e:
+            with self._lock:
+                self.shared_errors += 1
+            print(f"Warning: Shared rate limiter {mode} for {model} failed: {e}. Using this process's buckets.")
+            return None
+
+    def acquire(self, model: Optional[str], tokens: int) -> float:
+        """Reserves a request and `tokens` for `model`, sleeping until they are available. Returns the seconds waited."""
+        if not self.enabled: return 0.0
+        model = model or "unknown"
+        shared = self._shared_update(model, "acquire", 1, tokens)
+        with self._lock:
+            bucket = self._bucket(model)
+            now = time.monotonic()
+            wait = shared[0] if shared is not None else 0.0
+            for kind, per_minute, amount in (("requests", bucket["rpm"], 1), ("tokens", bucket["tpm"], tokens)) if shared is None else ():
+                if per_minute <= 0: continue # Unlimited
+                level = bucket[kind]
+                self._refill(level, per_minute, now)
+                level[0] -= min(amount, per_minute) # A single call never waits longer than a full minute
+                if level[0] < 0:
+                    wait = max(wait, -level[0] * 60.0 / per_minute)
+            bucket["calls"] += 1
+            if wait > 0:
+                bucket["throttled"] += 1
+                bucket["wait_seconds"] += wait
+        if wait > 0:
+            record_metric("observe", "crew_rate_limit_wait_seconds", wait, model=model)
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self, model: Optional[str], tokens: int) -> bool:
+        """Like `acquire`, but only reserves when nothing would have to wait; returns whether it did."""
+        if not self.enabled: return True
+        model = model or "unknown"
+        shared = self._shared_update(model, "try", 1, tokens)
+        with self._lock:
+            bucket = self._bucket(model)
+            if shared is not None:
+                if shared[0] < 0: return False
+            else:
+                now = time.monotonic()
+                limits = [(bucket[kind], per_minute, min(amount, per_minute))
+                          for kind, per_minute, amount in (("requests", bucket["rpm"], 1), ("tokens", bucket["tpm"], tokens)) if per_minute > 0]
+                for level, per_minute, amount in limits:
+                    self._refill(level, per_minute, now)
+                    if level[0] < amount: return False
+                for level, _, amount in limits:
+                    level[0] -= amount
+            bucket["calls"] += 1
+        return True
+
+    def reconcile(self, model: Optional[str], estimated_tokens: int, actual_tokens: int, request_sent: bool = True) -> None:
+        """Returns over-reserved tokens to (or charges the shortfall from) the bucket; un-sent requests are refunded."""
+        if not self.enabled: return
+        model = model or "unknown"
+        shared = self._shared_update(model, "credit", 0 if request_sent else 1, estimated_tokens - actual_tokens)
+        with self._lock:
+            bucket = self._bucket(model)
+            now = time.monotonic()
+            if shared is None and bucket["tpm"] > 0:
+                self._refill(bucket["tokens"], bucket["tpm"], now)
+                bucket["tokens"][0] = min(bucket["tpm"], bucket["tokens"][0] + estimated_tokens - actual_tokens)
+            if shared is None and not request_sent and bucket["rpm"] > 0:
+                self._refill(bucket["requests"], bucket["rpm"], now)
+                bucket["requests"][0] = min(bucket["rpm"], bucket["requests"][0] + 1)
+            bucket["reconciled_tokens"] += estimated_tokens - actual_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            models = {}
+            for model, bucket in self._buckets.items():
+                for kind, per_minute in (("requests", bucket["rpm"]), ("tokens", bucket["tpm"])):
+                    if per_minute > 0: self._refill(bucket[kind], per_minute, now)
+                models[model] = {
+                    "rpm": bucket["rpm"], "tpm": bucket["tpm"],
+                    "requests_available": round(bucket["requests"][0], 2), "tokens_available": round(bucket["tokens"][0]),
+                    "calls": bucket["calls"], "throttled": bucket["throttled"], "wait_seconds": round(bucket["wait_seconds"], 3),
+                    "over_reserved_tokens": bucket["reconciled_tokens"],
+                }
+        stats = {"enabled": self.enabled, "scale": self.scale_factor, "default_rpm": self.default_rpm, "default_tpm": self.default_tpm, "models": models}
+        if self.shared is None: return stats
+        for model, model_stats in models.items():
+            shared = self._shared_update(model, "peek", 0, 0)
+            if shared is None: continue
+            rpm, tpm = self._limits(model)
+            model_stats.update(rpm=rpm, tpm=tpm, requests_available=round(shared[1], 2), tokens_available=round(shared[2]))
+        return dict(stats, backend="redis", errors=self.shared_errors)
+
+rate_limiter = ModelRateLimiter(RATE_LIMIT_DEFAULT_RPM, RATE_LIMIT_DEFAULT_TPM, ModelRateLimiter.parse_overrides(RATE_LIMIT_MODELS), enabled=RATE_LIMIT_ENABLED,
+                                shared=RedisRateBuckets(registry_redis) if registry_redis is not None else None)
+rate_limiter.scale(1.0 / WEB_CONCURRENCY) # Local buckets only: each server worker gets its share of the limits
+
+RATE_LIMIT_RESERVED_EVENT = "rate_limit_reserved" # LangChain custom event: {"model", "estimated_tokens", "wait_seconds"}
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that takes its quota from `rate_limiter` right before the request is sent,
+    i.e. after LangChain's cache lookup, so completion cache hits never queue. The
+    reservation is reported to the callbacks as a RATE_LIMIT_RESERVED_EVENT custom event,
+    which WebSocketCallbackHandler keeps for reconciliation in on_llm_end / on_llm_error.
+    """
+    def _reserve_rate_limit(self, messages: List[Any], run_manager: Any, kwargs: Dict[str, Any]) -> None:
+        estimated_tokens = rate_limiter.estimate([str(message.content) for message in messages], kwargs.get('max_tokens') or self.max_tokens)
+        waited = rate_limiter.acquire(self.model_name, estimated_tokens)
+        if run_manager is not None:
+            run_manager.on_custom_event(RATE_LIMIT_RESERVED_EVENT, {"model": self.model_name, "estimated_tokens": estimated_tokens, "wait_seconds": waited})
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Any:
+        if not self.streaming: # A streaming ChatOpenAI generates through _stream, which reserves
+            self._reserve_rate_limit(messages, run_manager, kwargs)
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Any:
+        self._reserve_rate_limit(messages, run_manager, kwargs)
+        yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+def build_crew_llm(model_name: str, api_key: str, callbacks: Optional[List[BaseCallbackHandler]] = None, streaming: bool = False,
+                   cache: Optional[BaseCache] = None) -> ChatOpenAI:
+    """
+    Creates a ChatOpenAI bound to the per-run callbacks but backed by the shared,
+    pooled HTTP client, so a new run does not pay for a fresh TLS handshake.
+    With `streaming`, tokens are delivered through `on_llm_new_token` and usage is
+    requested on the final stream chunk so token accounting keeps working.
+    With `cache` (see CompletionCache), identical calls are answered from the cache.
+    Calls that reach the API take their quota from `rate_limiter` (see RateLimitedChatOpenAI).
+    """
+    llm_kwargs: Dict[str, Any] = {}
+    if cache is not None:
+        llm_kwargs.update(cache=cache)
+    if streaming:
+        llm_kwargs.update(streaming=True, stream_usage=True)
+    if CREW_LLM_BASE_URL:
+        llm_kwargs.update(base_url=CREW_LLM_BASE_URL)
+    return RateLimitedChatOpenAI(
+        model=model_name,
+        openai_api_key=api_key,
+        callbacks=callbacks or [],
+        http_client=http_clients.llm_http_client(),
+        timeout=HTTP_READ_TIMEOUT,
+        **llm_kwargs,
+    )
+
+# --- Hierarchy Cache ---
+class HierarchyCache:
+    """
+    Thread-safe LRU cache with TTL expiry for generated hierarchy JSON strings.
+    Only successfully validated hierarchies should be stored here; error payloads
+    are never cached so a transient upstream failure is retried on the next run.
+    With a `shared` backend (run_registry.RedisHierarchyEntries) entries are reused by
+    every worker; the local entries then only serve while the registry is unreachable.
+    Hit/miss counters are this process's own.
+    """
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600, shared: Any = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict() # key -> (stored_at, hierarchy_json_str)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.shared_errors = 0
+
+    @staticmethod
+    def normalize_key(task_description: str) -> str:
+        """Case-folds, collapses whitespace and drops trailing punctuation so near-identical prompts share an entry."""
+        normalized = re.sub(r'\s+', ' ', task_description.casefold()).strip()
+        return normalized.rstrip(' .,!?-')
+
+    def _shared_failed(self, action: str, e: Exception) -> None:
+        with self._lock:
+            self.shared_errors += 1
+        print(f"Warning: Shared hierarchy cache {action} failed: {e}. Using this process's cache.")
+
+    def get(self, task_description: str) -> Optional[str]:
+        key = self.normalize_key(task_description)
+        if self.shared is not None:
+            try:
+                hierarchy_json_str, expired = self.shared.get(key)
+            except Exception as e:
+                self._shared_failed("lookup", e)
+            else:
+                with self._lock:
+                    self.hits += hierarchy_json_str is not None
+                    self.misses += hierarchy_json_str is None
+                    self.expirations += expired
+                return hierarchy_json_str
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, hierarchy_json_str = entry
+            if self.ttl_seconds > 0 and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return hierarchy_json_str
+
+    def put(self, task_description: str, hierarchy_json_str: str) -> None:
+        key = self.normalize_key(task_description)
+        if self.shared is not None:
+            try:
+                evicted = self.shared.put(key, hierarchy_json_str, self.ttl_seconds, self.max_entries)
+            except Exception as e:
+                self._shared_failed("store", e)
+            else:
+                with self._lock:
+                    self.evictions += evicted
+                return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), hierarchy_json_str)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        size = None
+        if self.shared is not None:
+            try:
+                size = self.shared.size()
+            except Exception as e:
+                self._shared_failed("size read", e)
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "enabled": HIERARCHY_CACHE_ENABLED,
+                "size": len(self._entries) if size is None else size,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+            if self.shared is not None:
+                stats.update(backend="redis", errors=self.shared_errors)
+            return stats
+
+hierarchy_cache = HierarchyCache(HIERARCHY_CACHE_MAX_ENTRIES, HIERARCHY_CACHE_TTL_SECONDS,
+                                 shared=RedisHierarchyEntries(registry_redis) if registry_redis is not None else None)
+
+
+# --- Hierarchy Similarity Index ---
+class HierarchySimilarityIndex:
+    """
+    Bounded LRU index of task description -> hierarchy JSON for finished runs, queried
+    for near-duplicate tasks. Task words are MinHashed and banded (LSH) so a lookup only
+    scores the entries sharing a band; candidates are ranked by exact Jaccard similarity
+    of their word sets. Entries are added incrementally via `add` as runs succeed.
+    With a `shared` feed (run_registry.RedisSimilarityFeed) `add` also publishes the entry,
+    and each lookup first indexes the entries other workers published since the last one.
+    """
+    _MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = 0.8, max_entries: int = 1024, bands: int = 16, rows: int = 4, seed: int = 1, shared: Any = None):
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.bands = max(1, bands)
+        self.rows = max(1, rows)
+        rng = random.Random(seed) # Fixed seed: signatures must be comparable across lookups
+        self._permutations = [(rng.randrange(1, self._MERSENNE_PRIME), rng.randrange(0, self._MERSENNE_PRIME))
+                              for _ in range(self.bands * self.rows)]
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict() # normalized task -> entry
+        self._buckets: Dict[tuple, set] = {} # (band, band signature) -> normalized tasks
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.candidates_scored = 0
+        self.evictions = 0
+        self.shared = shared
+        self.shared_errors = 0
+
+    @staticmethod
+    def tokenize(task_description: str) -> frozenset:
+        words = re.findall(r"[a-z0-9]+", HierarchyCache.normalize_key(task_description))
+        return frozenset(word for word in words if len(word) > 2 and word not in COMPACTION_STOPWORDS)
+
+    def _band_keys(self, tokens: frozenset) -> List[tuple]:
+        hashes = [int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big") for token in tokens]
+        signature = [min((a * h + b) % self._MERSENNE_PRIME for h in hashes) for a, b in self._permutations]
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        for band_key in entry["band_keys"]:
+            bucket = self._buckets.get(band_key)
+            if bucket is None: continue
+            bucket.discard(key)
+            if not bucket: del self._buckets[band_key]
+
+    def _shared_failed(self, action: str, e: Exception) -> None:
+        with self._lock:
+            self.shared_errors += 1
+        print(f"Warning: Shared hierarchy similarity index {action} failed: {e}")
+
+    def add(self, task_description: str, hierarchy_json_str: str) -> None:
+        self._index(task_description, hierarchy_json_str) # Usable here right away; the feed hands it back harmlessly
+        if self.shared is None: return
+        try:
+            self.shared.publish(task_description, hierarchy_json_str, self.max_entries)
+        except Exception as e:
+            self._shared_failed("add", e)
 
+    def sync(self) -> int:
+        """Indexes the entries published to the shared feed since the last sync; returns how many."""
+        if self.shared is None: return 0
+        try:
+            entries = self.shared.read_new(self.max_entries)
+        except Exception as e:
+            self._shared_failed("sync", e)
+            return 0
+        for task_description, hierarchy_json_str in entries:
+            self._index(task_description, hierarchy_json_str)
+        return len(entries)
+
+    def _index(self, task_description: str, hierarchy_json_str: str) -> None:
+        tokens = self.tokenize(task_description)
+        if not tokens: return
+        key = HierarchyCache.normalize_key(task_description)
+        band_keys = self._band_keys(tokens)
+        with self._lock:
+            if key in self._entries: self._remove(key)
+            self._entries[key] = {"task_description": task_description, "tokens": tokens, "band_keys": band_keys, "hierarchy": hierarchy_json_str}
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def lookup(self, task_description: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the most similar indexed task as {"hierarchy", "score", "matched_task", "reused"},
+        or None when no entry shares an LSH band. `reused` is True when score >= threshold.
+        """
+        self.sync()
+        tokens = self.tokenize(task_description)
+        if not tokens: return None
+        band_keys = self._band_keys(tokens)
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self._buckets.get(band_key, ()))
+            self.candidates_scored += len(candidates)
+            best_key, best_score = None, 0.0
+            for key in candidates:
+                indexed_tokens = self._entries[key]["tokens"]
+                score = len(tokens & indexed_tokens) / len(tokens | indexed_tokens)
+                if score > best_score: best_key, best_score = key, score
+            if best_key is None: return None
+            entry = self._entries[best_key]
+            reused = best_score >= self.threshold
+            if reused:
+                self._entries.move_to_end(best_key)
+                self.hits += 1
+            return {"hierarchy": entry["hierarchy"], "score": round(best_score, 4), "matched_task": entry["task_description"], "reused": reused}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "enabled": HIERARCHY_SIMILARITY_ENABLED,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "bands": self.bands,
+                "rows": self.rows,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "avg_candidates": round(self.candidates_scored / self.lookups, 2) if self.lookups else 0.0,
+                "evictions": self.evictions,
+            }
+            if self.shared is not None:
+                stats.update(backend="redis", errors=self.shared_errors)
+            return stats
+
+hierarchy_similarity_index = HierarchySimilarityIndex(
+    HIERARCHY_SIMILARITY_THRESHOLD, HIERARCHY_SIMILARITY_MAX_ENTRIES, HIERARCHY_SIMILARITY_BANDS, HIERARCHY_SIMILARITY_ROWS,
+    shared=RedisSimilarityFeed(registry_redis) if registry_redis is not None else None,
+)
+
+
+# --- LLM Completion Cache ---
+class CompletionCache(BaseCache):
+    """
+    Content-addressed LangChain cache for crew LLM completions, shared across runs.
+    Keys are a SHA-256 of the model parameters, call options and prompt messages;
+    values are the serialized generations. A bounded in-memory LRU sits in front of
+    an optional SQLite tier (shared by worker processes) that is trimmed least
+    recently used once it exceeds its size budget. Both tiers honour the TTL.
+    Generations served from the cache are tagged with `completion_cache` = tier in
+    their response_metadata so WebSocketCallbackHandler can account for hits.
+    """
+    # ChatOpenAI constructor arguments that do not change the completion
+    VOLATILE_LLM_KWARGS = {"callbacks", "http_client", "http_async_client", "openai_api_key", "api_key",
+                           "streaming", "stream_usage", "timeout", "request_timeout", "max_retries", "cache"}
+
+    def __init__(self, memory_entries: int = 512, path: Optional[str] = None, disk_max_bytes: int = 256 * 1024 * 1024,
+                 ttl_seconds: float = 0, prune_every: int = 25):
+        self.memory_entries = max(0, memory_entries)
+        self.path = path or None
+        self.disk_max_bytes = max(0, int(disk_max_bytes))
+        self.ttl_seconds = max(0.0, ttl_seconds)
+        self.prune_every = max(1, prune_every)
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict() # key -> (created_at, payload)
+        self._lock = threading.Lock() # Guards the memory tier and counters
+        self._disk_lock = threading.Lock() # sqlite3 connections must not be used concurrently
+        self._conn: Optional[sqlite3.Connection] = None # Opened on first use so the cache costs nothing when unused
+        self._writes_since_prune = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def make_key(cls, prompt: str, llm_string: str) -> str:
+        """
+        `llm_string` is LangChain's serialized model followed by the call options. Only the
+        parameters that shape the completion are kept, so per-run callbacks, clients and
+        streaming settings do not split the cache.
+        """
+        try:
+            serialized, end = json.JSONDecoder().raw_decode(llm_string)
+            llm_kwargs = {key: value for key, value in (serialized.get("kwargs") or {}).items() if key not in cls.VOLATILE_LLM_KWARGS}
+            identity = json.dumps({"llm": serialized.get("id"), "kwargs": llm_kwargs, "call": llm_string[end:]}, sort_keys=True, default=str)
+        except (ValueError, AttributeError):
+            identity = llm_string
+        identity = re.sub(r" at 0x[0-9a-fA-F]+", "", identity) # Object reprs differ between processes
+        return hashlib.sha256(f"{identity}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - created_at > self.ttl_seconds
+
+    def _memory_get(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None: return None
+            if self._expired(entry[0], now):
+                del self._memory[key]
+                self.expirations += 1
+                return None
+            self._memory.move_to_end(key)
+            return entry[1]
+
+    def _memory_put(self, key: str, payload: str, created_at: float) -> None:
+        if not self.memory_entries: return
+        with self._lock:
+            self._memory[key] = (created_at, payload)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+                self.evictions += 1
+
+    def _disk(self) -> Optional[sqlite3.Connection]:
+        """Returns the SQLite connection, opening it on first use; call with _disk_lock held."""
+        if self.path is None: return None
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completion_cache ("
+                " key TEXT PRIMARY KEY,"
+                " payload TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_completion_cache_last_access ON completion_cache (last_access)")
+            self._conn.commit()
+        return self._conn
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple]:
+        with self._disk_lock:
+            conn = self._disk()
+            if conn is None: return None
+            row = conn.execute("SELECT payload, created_at FROM completion_cache WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            if self._expired(row[1], now):
+                conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+                conn.commit()
+                with self._lock: self.expirations += 1
+                return None
+            conn.execute("UPDATE completion_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return row[0], row[1]
+
+    def _disk_put(self, key: str, payload: str, now: float) -> None:
+        with self._disk_lock:
+            conn = self._disk()
+            if conn is None: return
+            conn.execute(
+                "INSERT OR REPLACE INTO completion_cache (key, payload, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now)
+            )
+            conn.commit()
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= self.prune_every:
+                self._writes_since_prune = 0
+                self._prune_disk(conn, now)
+
+    def _prune_disk(self, conn: sqlite3.Connection, now: float) -> None:
+        """Drops expired rows, then least recently used rows until the tier fits its size budget."""
+        removed = 0
+        if self.ttl_seconds:
+            removed += conn.execute("DELETE FROM completion_cache WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completion_cache").fetchone()[0]
+        if self.disk_max_bytes and total_bytes > self.disk_max_bytes:
+            excess = total_bytes - self.disk_max_bytes
+            victims: List[str] = []
+            for key, size in conn.execute("SELECT key, size FROM completion_cache ORDER BY last_access"):
+                victims.append(key)
+                excess -= size
+                if excess <= 0: break
+            conn.executemany("DELETE FROM completion_cache WHERE key = ?", [(key,) for key in victims])
+            removed += len(victims)
+        conn.commit()
+        with self._lock: self.evictions += removed
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[List[Any]]:
+        key = self.make_key(prompt, llm_string)
+        now = time.time()
+        tier = "memory"
+        payload = self._memory_get(key, now)
+        if payload is None:
+            tier = "disk"
+            disk_entry = self._disk_get(key, now)
+            if disk_entry is not None:
+                payload = disk_entry[0]
+                self._memory_put(key, payload, disk_entry[1])
+        with self._lock:
+            if payload is None: self.misses += 1
+            elif tier == "memory": self.memory_hits += 1
+            else: self.disk_hits += 1
+        if payload is None: return None
+        generations = [lc_loads(item) for item in json.loads(payload)] # Fresh objects per hit: callers may mutate them
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None:
+                message.response_metadata = dict(message.response_metadata or {}, completion_cache=tier)
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: List[Any]) -> None:
+        try:
+            payload = json.dumps([lc_dumps(generation) for generation in return_val])
+        except Exception as e:
+            print(f"Warning: completion not cached, could not serialize generations: {e}")
+            return
+        key = self.make_key(prompt, llm_string)
+        now = time.time()
+        self._memory_put(key, payload, now)
+        try:
+            self._disk_put(key, payload, now)
+        except sqlite3.Error as e:
+            print(f"Warning: completion cache disk write failed: {e}")
+        with self._lock: self.writes += 1
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._memory.clear()
+        with self._disk_lock:
+            conn = self._disk()
+            if conn is not None:
+                conn.execute("DELETE FROM completion_cache")
+                conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        disk = None
+        if self._conn is not None:
+            with self._disk_lock:
+                entries, total_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completion_cache").fetchone()
+            disk = {"path": self.path, "entries": entries, "bytes": total_bytes, "max_bytes": self.disk_max_bytes}
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "default_enabled": COMPLETION_CACHE_DEFAULT,
+                "memory_size": len(self._memory),
+                "memory_entries": self.memory_entries,
+                "disk": disk,
+                "ttl_seconds": self.ttl_seconds,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+completion_cache = CompletionCache(
+    memory_entries=COMPLETION_CACHE_MEMORY_ENTRIES,
+    path=COMPLETION_CACHE_PATH,
+    disk_max_bytes=int(COMPLETION_CACHE_DISK_MAX_MB * 1024 * 1024),
+    ttl_seconds=COMPLETION_CACHE_TTL_SECONDS,
+    prune_every=COMPLETION_CACHE_PRUNE_EVERY,
+)
+
+# --- Model Routing ---
+class ModelRouter:
+    """
+    Chooses the chat model for each agent from the hierarchy's `tokens` and
+    `cost_per_million` estimates and the observed health of each model.
+    Rules are ordered cheapest/fastest first; an agent gets the first rule whose
+    limits it fits and whose model is healthy (error rate and EWMA latency within
+    bounds once enough calls were seen). The run's default model closes the list.
+    If every candidate is degraded the least-bad one (error rate, then latency) wins.
+    A degraded model that has not been called for `retry_after_seconds` has its
+    statistics reset so it can be tried again.
+    Observations come from WebSocketCallbackHandler for every crew LLM call.
+    With a `shared` backend (run_registry.RedisModelHealth) every worker routes on the
+    calls observed by all of them; the process's own statistics are used while it fails.
+    """
+    def __init__(self, rules: List[Dict[str, Any]], max_error_rate: float = 0.25, max_latency_seconds: float = 30,
+                 min_samples: int = 5, ewma_alpha: float = 0.2, retry_after_seconds: float = 120, shared: Any = None):
+        self.rules = rules
+        self.max_error_rate = max_error_rate
+        self.max_latency_seconds = max_latency_seconds
+        self.min_samples = max(1, min_samples)
+        self.ewma_alpha = min(1.0, max(0.01, ewma_alpha))
+        self.retry_after_seconds = max(0.0, retry_after_seconds)
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict[str, Any]] = {} # model -> calls, errors, ewma_latency, last_observed
+        self.routed: Dict[str, int] = {} # model -> agents routed to it
+        self.shared = shared
+        self.shared_errors = 0
+
+    @staticmethod
+    def parse_rules(raw: str) -> List[Dict[str, Any]]:
+        try:
+            rules = json.loads(raw) if raw else []
+            if not isinstance(rules, list): raise ValueError("expected a JSON array")
+            return [rule for rule in rules if isinstance(rule, dict) and isinstance(rule.get("model"), str)]
+        except ValueError as e:
+            print(f"Warning: ignoring invalid MODEL_ROUTING_RULES ({e}); all agents use the default model.")
+            return []
+
+    @staticmethod
+    def _estimate(agent_info: Dict[str, Any], key: str) -> Optional[float]:
+        try:
+            return float(agent_info.get(key))
+        except (TypeError, ValueError):
+            return None
+
+    def _fits(self, rule: Dict[str, Any], agent_info: Dict[str, Any]) -> bool:
+        """An agent without the estimate a limit needs does not fit (it stays on the stronger model)."""
+        for limit_key, estimate_key in (("max_tokens", "tokens"), ("max_cost_per_million", "cost_per_million")):
+            if limit_key not in rule: continue
+            estimate = self._estimate(agent_info, estimate_key)
+            if estimate is None or estimate > float(rule[limit_key]): return False
+        return True
+
+    def _judge(self, calls: int, errors: int, latency: Optional[float], idle_seconds: float, latency_limit: Optional[float]) -> tuple:
+        """Returns (healthy, error_rate, ewma_latency, stale); stale degraded models should have their statistics reset."""
+        error_rate = errors / calls if calls else 0.0
+        if calls < self.min_samples: return True, error_rate, latency, False
+        healthy = error_rate <= self.max_error_rate and not (latency_limit and latency is not None and latency > latency_limit)
+        return healthy, error_rate, latency, not healthy and idle_seconds > self.retry_after_seconds
+
+    def _shared_failed(self, action: str, e: Exception) -> None:
+        with self._lock:
+            self.shared_errors += 1
+        print(f"Warning: Shared model health {action} failed: {e}. Routing on this process's statistics.")
+
+    def _health(self, model: str, max_latency_seconds: Optional[float] = None) -> tuple:
+        """Returns (healthy, error_rate, ewma_latency) for a model."""
+        latency_limit = self.max_latency_seconds if max_latency_seconds is None else max_latency_seconds
+        if self.shared is not None:
+            try:
+                entry = self.shared.read(model)
+            except Exception as e:
+                self._shared_failed("read", e)
+            else:
+                if not entry: return True, 0.0, None
+                healthy, error_rate, latency, stale = self._judge(entry["calls"], entry["errors"], entry["ewma_latency"], entry["idle_seconds"], latency_limit)
+                if stale:
+                    try:
+                        self.shared.reset(model)
+                    except Exception as e:
+                        self._shared_failed("reset", e)
+                    return True, 0.0, None
+                return healthy, error_rate, latency
+        with self._lock:
+            entry = self._models.get(model)
+            if entry is None: return True, 0.0, None
+            healthy, error_rate, latency, stale = self._judge(entry["calls"], entry["errors"], entry["ewma_latency"],
+                                                              time.monotonic() - entry["last_observed"], latency_limit)
+            if stale:
+                entry.update(calls=0, errors=0, ewma_latency=None) # Unused for a while: give it another chance
+                return True, 0.0, None
+        return healthy, error_rate, latency
+
+    def route(self, agent_info: Dict[str, Any], default_model: str) -> Dict[str, Any]:
+        """Returns {"model", "reason", "observed_error_rate", "observed_latency_seconds"} for an agent."""
+        candidates = [(rule["model"], f"rule {index}", rule.get("max_latency_seconds"))
+                      for index, rule in enumerate(self.rules) if self._fits(rule, agent_info)]
+        candidates.append((default_model, "default model", None))
+        choice, degraded = None, []
+        for model, reason, max_latency in candidates:
+            healthy, error_rate, latency = self._health(model, max_latency)
+            if healthy:
+                choice = (model, reason, error_rate, latency)
+                break
+            degraded.append((error_rate, latency if latency is not None else 0.0, model))
+        if choice is None:
+            error_rate, latency, model = min(degraded)
+            choice = (model, "all candidates degraded; least-bad", error_rate, latency)
+        elif degraded:
+            choice = (choice[0], f"{choice[1]} (skipped degraded: {', '.join(model for _, _, model in degraded)})", choice[2], choice[3])
+        model, reason, error_rate, latency = choice
+        with self._lock:
+            self.routed[model] = self.routed.get(model, 0) + 1
+        return {
+            "model": model,
+            "reason": reason,
+            "observed_error_rate": round(error_rate, 4),
+            "observed_latency_seconds": round(latency, 4) if latency is not None else None,
+        }
+
+    def observe(self, model: Optional[str], seconds: float, ok: bool = True) -> None:
+        if not model: return
+        with self._lock:
+            entry = self._models.setdefault(model, {"calls": 0, "errors": 0, "ewma_latency": None, "last_observed": 0.0})
+            entry["calls"] += 1
+            entry["last_observed"] = time.monotonic()
+            if ok:
+                previous = entry["ewma_latency"]
+                entry["ewma_latency"] = seconds if previous is None else previous + self.ewma_alpha * (seconds - previous)
+            else:
+                entry["errors"] += 1 # Failed calls say little about latency
+        if self.shared is None: return
+        try:
+            self.shared.observe(model, seconds, ok, self.ewma_alpha)
+        except Exception as e:
+            self._shared_failed("update", e)
+
+    @staticmethod
+    def _model_stats(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "calls": entry["calls"],
+            "errors": entry["errors"],
+            "error_rate": round(entry["errors"] / entry["calls"], 4) if entry["calls"] else 0.0,
+            "ewma_latency_seconds": round(entry["ewma_latency"], 4) if entry["ewma_latency"] is not None else None,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {model: self._model_stats(entry) for model, entry in self._models.items()}
+            stats = {"default_enabled": MODEL_ROUTING_DEFAULT, "rules": self.rules, "models": models, "routed_agents": dict(self.routed)}
+        if self.shared is None: return stats
+        for model in set(models) | {rule["model"] for rule in self.rules}:
+            try:
+                entry = self.shared.read(model)
+            except Exception as e:
+                self._shared_failed("read", e)
+                break
+            if entry: models[model] = self._model_stats(entry)
+        return dict(stats, backend="redis", errors=self.shared_errors)
+
+model_router = ModelRouter(
+    ModelRouter.parse_rules(MODEL_ROUTING_RULES),
+    max_error_rate=MODEL_ROUTING_MAX_ERROR_RATE,
+    max_latency_seconds=MODEL_ROUTING_MAX_LATENCY_SECONDS,
+    min_samples=MODEL_ROUTING_MIN_SAMPLES,
+    ewma_alpha=MODEL_ROUTING_EWMA_ALPHA,
+    retry_after_seconds=MODEL_ROUTING_RETRY_AFTER_SECONDS,
+    shared=RedisModelHealth(registry_redis, RUN_REGISTRY_TTL_SECONDS) if registry_redis is not None else None,
+)
+
+
+# --- Hierarchy Generation Function ---
+def build_hierarchy_request(task_description: str, stream: bool = False) -> tuple:
+    """Returns (headers, payload) for the hierarchy-generation chat completion."""
     prompt = f"""
     Generate a hierarchical multi-agent system consisting 2 to 4 agents to plan to accomplish the following task: "{task_description}"
 
@@ -114,48 +2208,488 @@ def create_agent_hierarchy_with_ai(task_description: str) -> str:
         "temperature": 0.5,
         "max_tokens": 500
     }
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True} # Usage arrives in a final chunk, for rate-limit reconciliation
+    return headers, payload
 
+def extract_hierarchy_json(generated_text: str) -> Optional[str]:
+    """
+    Returns the JSON array in a hierarchy completion (bare or wrapped in text), or
+    None if there is none. A bare array that fails to parse raises json.JSONDecodeError.
+    """
+    # Basic validation and cleanup
+    if generated_text.startswith('[') and generated_text.endswith(']'):
+        json.loads(generated_text) # Attempt to load to ensure it's valid JSON
+        return generated_text
+    # Try to extract JSON if wrapped in text
+    start = generated_text.find('[')
+    end = generated_text.rfind(']')
+    if start != -1 and end != -1 and start < end:
+        potential_json = generated_text[start:end+1]
+        try:
+            json.loads(potential_json) # Validate
+            print("Warning: Extracted JSON from potentially noisy AI response.")
+            return potential_json
+        except json.JSONDecodeError:
+            pass # Fall through if extraction fails
+    return None
+
+def is_cacheable_hierarchy(hierarchy_json: str) -> bool:
+    """True only for a non-empty JSON array of agent objects; anything else is not worth reusing from the cache."""
     try:
-        response = requests.post(HIERARCHY_API_ENDPOINT, headers=headers, json=payload, timeout=45)
-        response.raise_for_status()
-        api_response_data = response.json()
-        generated_text = api_response_data['choices'][0]['message']['content'].strip()
+        hierarchy_data = json.loads(hierarchy_json)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(hierarchy_data, list) and bool(hierarchy_data) and all(isinstance(item, dict) for item in hierarchy_data)
 
-        # Basic validation and cleanup
-        if generated_text.startswith('[') and generated_text.endswith(']'):
-             # Attempt to load to ensure it's valid JSON
-             json.loads(generated_text)
-             return generated_text
-        else:
-            # Try to extract JSON if wrapped in text
-            start = generated_text.find('[')
-            end = generated_text.rfind(']')
-            if start != -1 and end != -1 and start < end:
-                potential_json = generated_text[start:end+1]
-                try:
-                    json.loads(potential_json) # Validate
-                    print("Warning: Extracted JSON from potentially noisy AI response.")
-                    return potential_json
-                except json.JSONDecodeError:
-                    pass # Fall through if extraction fails
+def begin_hierarchy_generation(task_description: str, use_cache: bool) -> tuple:
+    """
+    Shared start of the hierarchy generators. Returns (cached hierarchy JSON, error JSON),
+    at most one of them set; the API is only called when both are None.
+    """
+    if use_cache:
+        cached_hierarchy = hierarchy_cache.get(task_description)
+        if cached_hierarchy is not None:
+            print(f"Hierarchy cache hit for task: '{task_description[:50]}'")
+            return cached_hierarchy, None
 
-            print(f"Error: AI response was not a valid JSON array. Response:\n{generated_text}")
-            return json.dumps({"error": "AI response was not a valid JSON array.", "raw_response": generated_text})
+    key_ok, error_msg = check_api_key(HIERARCHY_API_KEY, "Hierarchy Generation API Key (OPENAI_API_KEY)")
+    if not key_ok:
+         print(f"Warning: {error_msg}")
+         # Return error as JSON string, consistent with other returns
+         return None, json.dumps({"error": error_msg})
+    return None, None
+
+def reserve_hierarchy_call(payload: Dict[str, Any], on_rate_limit_wait=None) -> int:
+    """Takes the hierarchy request's estimated tokens from `rate_limiter`; returns the estimate for reconciliation."""
+    estimated_tokens = rate_limiter.estimate([message["content"] for message in payload["messages"]], payload.get("max_tokens"))
+    waited = rate_limiter.acquire(payload["model"], estimated_tokens)
+    if on_rate_limit_wait is not None: on_rate_limit_wait(waited)
+    return estimated_tokens
+
+def finish_hierarchy_generation(task_description: str, generated_text: str, use_cache: bool) -> str:
+    """
+    Shared end of the hierarchy generators: returns the hierarchy JSON found in the completion
+    text (cached if it is a usable hierarchy) or the {"error": ...} JSON string for invalid output.
+    """
+    try:
+        hierarchy_json = extract_hierarchy_json(generated_text)
+    except json.JSONDecodeError as json_err:
+        # This handles cases where the AI *claims* it's JSON but isn't
+        print(f"Error: AI response was not valid JSON after basic checks. Error: {json_err}. Response:\n{generated_text}")
+        return json.dumps({"error": f"AI response was not valid JSON: {json_err}", "raw_response": generated_text})
+    if hierarchy_json is None:
+        print(f"Error: AI response was not a valid JSON array. Response:\n{generated_text}")
+        return json.dumps({"error": "AI response was not a valid JSON array.", "raw_response": generated_text})
+    if use_cache and is_cacheable_hierarchy(hierarchy_json): hierarchy_cache.put(task_description, hierarchy_json)
+    return hierarchy_json
+
+def hierarchy_extra_request_reserver(payload: Dict[str, Any], estimated_tokens: int):
+    """`reserve_extra` for hierarchy_requests: hedges and retries of the call take the same quota as the first request."""
+    def reserve(blocking: bool) -> bool:
+        if blocking:
+            rate_limiter.acquire(payload["model"], estimated_tokens)
+            return True
+        return rate_limiter.try_acquire(payload["model"], estimated_tokens)
+    return reserve
+
+def create_agent_hierarchy_with_ai(task_description: str, use_cache: bool = True, on_rate_limit_wait=None) -> str:
+    """
+    Generates agent hierarchy JSON using an AI model.
+    Validated hierarchies are served from / stored in `hierarchy_cache` unless
+    `use_cache` is False or caching is disabled globally.
+    `on_rate_limit_wait(seconds)` is told how long the call queued on the shared rate limiter.
+    """
+    use_cache = use_cache and HIERARCHY_CACHE_ENABLED
+    cached_hierarchy, error_json = begin_hierarchy_generation(task_description, use_cache)
+    if cached_hierarchy is not None or error_json is not None:
+        return cached_hierarchy or error_json
+
+    headers, payload = build_hierarchy_request(task_description)
+    estimated_tokens = reserve_hierarchy_call(payload, on_rate_limit_wait)
+    actual_tokens = estimated_tokens # Until the response reports usage (or the request fails)
 
+    try:
+        response = hierarchy_requests.post(HIERARCHY_API_ENDPOINT, headers=headers, json=payload,
+                                           reserve_extra=hierarchy_extra_request_reserver(payload, estimated_tokens))
+        response.raise_for_status()
+        api_response_data = response.json()
+        usage = api_response_data.get('usage') or {}
+        if usage.get('total_tokens') is not None:
+            actual_tokens = int(usage['total_tokens'])
+        generated_text = api_response_data['choices'][0]['message']['content'].strip()
     except requests.exceptions.RequestException as req_err:
+        actual_tokens = 0 # Nothing was generated
         print(f"Error during API request for hierarchy: {req_err}")
         return json.dumps({"error": f"API request failed: {req_err}"})
     except (KeyError, IndexError) as key_err:
          print(f"Error: Unexpected API response structure for hierarchy. Error: {key_err}. Response:\n{api_response_data}")
          return json.dumps({"error": f"Unexpected API response structure: {key_err}", "raw_response": api_response_data})
-    except json.JSONDecodeError as json_err:
-            # This handles cases where the AI *claims* it's JSON but isn't
-            print(f"Error: AI response was not valid JSON after basic checks. Error: {json_err}. Response:\n{generated_text}")
-            return json.dumps({"error": f"AI response was not valid JSON: {json_err}", "raw_response": generated_text})
     except Exception as e:
         print(f"An unexpected error occurred during hierarchy generation: {e}")
         traceback.print_exc()
         return json.dumps({"error": f"An unexpected error occurred: {e}"})
+    finally:
+        rate_limiter.reconcile(payload["model"], estimated_tokens, actual_tokens)
+    return finish_hierarchy_generation(task_description, generated_text, use_cache)
+
+
+class HierarchyStreamParser:
+    """
+    Incrementally extracts the objects of the top-level JSON array in a streamed
+    completion. `feed` returns (array index, object) for the objects completed by the
+    new text; anything before the opening '[' (a preamble or code fence) is skipped.
+    Indexes count every array element, so they line up with the final parsed array.
+    """
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0 # Next character to scan
+        self._started = False # Seen the opening '['
+        self._depth = 0 # Nesting depth inside the array
+        self._in_string = False
+        self._escape = False
+        self._object_start: Optional[int] = None
+        self._index = 0 # Array index of the element being scanned (top-level commas seen)
+        self.finished = False # Seen the closing ']'
+
+    def feed(self, chunk: str) -> List[tuple]:
+        self._buffer += chunk
+        completed: List[tuple] = []
+        buffer = self._buffer
+        while self._pos < len(buffer) and not self.finished:
+            char = buffer[self._pos]
+            if not self._started:
+                if char == '[': self._started = True
+            elif self._in_string:
+                if self._escape: self._escape = False
+                elif char == '\\': self._escape = True
+                elif char == '"': self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == ',' and self._depth == 0:
+                self._index += 1
+            elif char in '{[':
+                if self._depth == 0 and char == '{': self._object_start = self._pos
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 0:
+                    self.finished = char == ']'
+                else:
+                    self._depth -= 1
+                    if self._depth == 0 and char == '}' and self._object_start is not None:
+                        try:
+                            parsed = json.loads(buffer[self._object_start:self._pos + 1])
+                            if isinstance(parsed, dict): completed.append((self._index, parsed))
+                        except json.JSONDecodeError:
+                            pass # Left for the final validation to report
+                        self._object_start = None
+            self._pos += 1
+        return completed
+
+def stream_agent_hierarchy(task_description: str, on_agent, use_cache: bool = True, on_rate_limit_wait=None) -> str:
+    """
+    Streaming variant of create_agent_hierarchy_with_ai: reads the completion as
+    server-sent events and calls `on_agent(index, agent_info)` for each agent object
+    as soon as it is complete, `index` being its position in the hierarchy array
+    (cached hierarchies replay all agents at once).
+    Returns the same JSON string (hierarchy or {"error": ...}) as the blocking version.
+    """
+    use_cache = use_cache and HIERARCHY_CACHE_ENABLED
+    cached_hierarchy, error_json = begin_hierarchy_generation(task_description, use_cache)
+    if error_json is not None:
+        return error_json
+    if cached_hierarchy is not None:
+        for index, agent_info in enumerate(json.loads(cached_hierarchy)):
+            if isinstance(agent_info, dict): on_agent(index, agent_info)
+        return cached_hierarchy
+
+    headers, payload = build_hierarchy_request(task_description, stream=True)
+    estimated_tokens = reserve_hierarchy_call(payload, on_rate_limit_wait)
+    parser = HierarchyStreamParser()
+    text_parts: List[str] = []
+    usage: Dict[str, Any] = {}
+    actual_tokens = estimated_tokens # Until the final chunk reports usage (or the request fails)
+    started = time.perf_counter()
+    try:
+        with hierarchy_requests.post(HIERARCHY_API_ENDPOINT, headers=headers, json=payload, stream=True,
+                                     reserve_extra=hierarchy_extra_request_reserver(payload, estimated_tokens)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'): continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]': break
+                chunk = json.loads(data)
+                usage = chunk.get('usage') or usage # Final chunk when stream_options.include_usage is set
+                choices = chunk.get('choices') or []
+                content = (choices[0].get('delta') or {}).get('content') if choices else None
+                if not content: continue
+                text_parts.append(content)
+                for index, agent_info in parser.feed(content):
+                    on_agent(index, agent_info)
+    except requests.exceptions.RequestException as req_err:
+        actual_tokens = 0
+        print(f"Error during streaming API request for hierarchy: {req_err}")
+        return json.dumps({"error": f"API request failed: {req_err}"})
+    except (ValueError, KeyError, IndexError, AttributeError) as parse_err:
+        print(f"Error: Unexpected streaming response structure for hierarchy. Error: {parse_err}")
+        return json.dumps({"error": f"Unexpected API response structure: {parse_err}", "raw_response": "".join(text_parts)})
+    finally:
+        if usage.get('total_tokens') is not None:
+            actual_tokens = int(usage['total_tokens'])
+        rate_limiter.reconcile(payload["model"], estimated_tokens, actual_tokens)
+    record_metric("observe", "crew_hierarchy_request_seconds", time.perf_counter() - started, outcome="success")
+
+    return finish_hierarchy_generation(task_description, "".join(text_parts).strip(), use_cache)
+
+
+# --- Log Batching ---
+class LogBatchingEmitter:
+    """
+    Wraps a SocketIO-like emitter for a run. `log_update` payloads are buffered per
+    room and sent as one `log_batch` frame ({"run_id", "events": [...]}) every
+    `interval` seconds or once `max_events` are buffered. A newer `agent_usage_update`
+    for an agent replaces the buffered one. Terminal log types flush immediately, and
+    any other event (e.g. `run_complete`) flushes the room first so ordering holds.
+    """
+    TERMINAL_TYPES = frozenset({'error', 'run_complete'})
+    totals = {"frames_sent": 0, "events_buffered": 0, "events_collapsed": 0} # Process-wide counters for /stats
+    _totals_lock = threading.Lock() # Shared by every run's emitter (and their flush timers)
+
+    @classmethod
+    def _count(cls, key: str) -> None:
+        with cls._totals_lock:
+            cls.totals[key] += 1
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        with cls._totals_lock:
+            return dict(cls.totals)
+
+    def __init__(self, emitter: Any, interval: float = 0.25, max_events: int = 25):
+        self._emitter = emitter
+        self.interval = interval
+        self.max_events = max(1, max_events)
+        self._lock = threading.RLock() # Held across flush emits so frames leave in buffer order
+        self._buffers: Dict[str, List[Dict[str, Any]]] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        # sleep(), start_background_task() etc. pass straight through
+        return getattr(self._emitter, name)
+
+    def emit(self, event: str, data: Any = None, room: Optional[str] = None, **kwargs: Any) -> None:
+        if event != 'log_update' or room is None or not isinstance(data, dict):
+            if room is not None: self.flush(room)
+            self._emitter.emit(event, data, room=room, **kwargs)
+            return
+
+        event_type = data.get('type')
+        with self._lock:
+            buffer = self._buffers.setdefault(room, [])
+            if event_type == 'agent_usage_update':
+                agent_name = (data.get('data') or {}).get('agent_name')
+                for index, pending in enumerate(buffer):
+                    if pending.get('type') == 'agent_usage_update' and (pending.get('data') or {}).get('agent_name') == agent_name:
+                        del buffer[index]
+                        self._count("events_collapsed")
+                        break
+            buffer.append(data)
+            self._count("events_buffered")
+            flush_now = event_type in self.TERMINAL_TYPES or len(buffer) >= self.max_events
+            if not flush_now and room not in self._timers:
+                timer = threading.Timer(self.interval, self.flush, args=(room,))
+                timer.daemon = True
+                self._timers[room] = timer
+                timer.start()
+            if flush_now:
+                self.flush(room)
+
+    def flush(self, room: str) -> None:
+        with self._lock:
+            buffer = self._buffers.pop(room, None)
+            timer = self._timers.pop(room, None)
+            if timer is not None and timer is not threading.current_thread():
+                timer.cancel()
+            if not buffer: return
+            try:
+                self._emitter.emit('log_batch', {'run_id': room, 'events': buffer}, room=room)
+                self._count("frames_sent")
+            except Exception as e:
+                print(f"[Log Batching {room}] ERROR emitting log_batch ({len(buffer)} events): {e}")
+                traceback.print_exc()
+
+    def close(self) -> None:
+        """Flushes every room; call when the run is finished."""
+        with self._lock:
+            rooms = list(self._buffers.keys())
+        for room in rooms:
+            self.flush(room)
+
+
+# --- Run Event Log (Resume Support) ---
+run_event_log = (RedisRunEventLog(registry_redis, RUN_EVENT_BUFFER_SIZE, RUN_EVENT_LOG_MAX_RUNS, RUN_REGISTRY_TTL_SECONDS)
+                 if registry_redis is not None else RunEventLog(RUN_EVENT_BUFFER_SIZE, RUN_EVENT_LOG_MAX_RUNS))
+
+class SequencedEmitter:
+    """
+    Wraps a run's emitter: every room event gets the run's next `seq` and its emit
+    time `ts` (epoch seconds) and, in the web process, is recorded in `run_event_log`
+    before it is emitted.
+    """
+    def __init__(self, emitter: Any, event_log: RunEventLog, record: bool = True):
+        self._emitter = emitter
+        self._event_log = event_log
+        self._record = record
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._emitter, name)
+
+    def emit(self, event: str, data: Any = None, room: Optional[str] = None, **kwargs: Any) -> None:
+        if room is None or not isinstance(data, dict):
+            self._emitter.emit(event, data, room=room, **kwargs)
+            return
+        with self._event_log.lock_for(room):
+            payload = self._event_log.sequence(room, event, data, record=self._record)
+            if self._record:
+                metrics.inc("crew_socketio_emits_total", event=event, type=data.get('type', ''))
+            self._emitter.emit(event, payload, room=room, **kwargs)
+
+
+# --- Event Encoding (MessagePack Rooms) ---
+EVENT_ENCODINGS = ("json", "msgpack")
+MSGPACK_EVENTS_ENABLED = SOCKETIO_MSGPACK_ENABLED and msgpack is not None
+if SOCKETIO_MSGPACK_ENABLED and msgpack is None:
+    print("Warning: SOCKETIO_MSGPACK_ENABLED is set but msgpack is not installed. Run events stay JSON-only.")
+
+def negotiate_event_encoding(requested: str) -> str:
+    """The encoding a join_room request gets: "msgpack" only when enabled server-side, else "json"."""
+    return "msgpack" if requested == "msgpack" and MSGPACK_EVENTS_ENABLED else "json"
+
+def event_room(run_id: str, encoding: str = "json") -> str:
+    """Room a client subscribes to for `run_id`; MessagePack subscribers use the run's twin room."""
+    return run_id if encoding == "json" else f"{run_id}#{encoding}"
+
+def encode_event_payload(payload: Any, encoding: str = "json") -> Any:
+    """Payload as sent to a client: as-is for JSON (Socket.IO serializes it), packed bytes for MessagePack."""
+    if encoding != "msgpack": return payload
+    return msgpack.packb(payload, default=str, use_bin_type=True)
+
+class MsgpackSubscribers:
+    """
+    Counts the msgpack subscribers of each run, maintained by join_run_room, leave_run_room
+    and the disconnect handlers, so runs nobody follows in MessagePack are not packed.
+    Each client counts once per run however often it joins. With a `shared` backend
+    (run_registry.RedisSubscriberCounts) the counts also cover other workers; a run without local
+    subscribers checks them at most every `cache_seconds` (clients joining through
+    another worker can resume with `since_seq` to replay what that delay skipped).
+    """
+    def __init__(self, cache_seconds: float = 1.0, shared: Any = None):
+        self.shared = shared
+        self.cache_seconds = max(0.0, cache_seconds)
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {} # run_id -> local msgpack subscribers
+        self._runs_by_client: Dict[str, set] = {} # sid -> run_ids joined in msgpack
+        self._shared_checks: Dict[str, tuple] = {} # run_id -> (checked_at, subscribed on any worker)
+        self.errors = 0
+
+    def _publish(self, run_id: str, delta: int) -> None:
+        if self.shared is None: return
+        try:
+            self.shared.add(run_id, delta)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Warning: Run registry msgpack subscriber update for {run_id} failed: {e}")
+
+    def join(self, sid: str, run_id: str) -> None:
+        with self._lock:
+            runs = self._runs_by_client.setdefault(sid, set())
+            if run_id in runs: return
+            runs.add(run_id)
+            self._counts[run_id] = self._counts.get(run_id, 0) + 1
+        self._publish(run_id, 1)
+
+    def leave(self, sid: str, run_id: str) -> None:
+        with self._lock:
+            runs = self._runs_by_client.get(sid)
+            if not runs or run_id not in runs: return
+            runs.discard(run_id)
+            if not runs: del self._runs_by_client[sid]
+            self._counts[run_id] -= 1
+            if not self._counts[run_id]: del self._counts[run_id]
+        self._publish(run_id, -1)
+
+    def disconnect(self, sid: str) -> None:
+        with self._lock:
+            runs = list(self._runs_by_client.get(sid, ()))
+        for run_id in runs:
+            self.leave(sid, run_id)
+
+    def active(self, run_id: str) -> bool:
+        """Whether any client, on this worker or (with a registry) another one, follows `run_id` in msgpack."""
+        with self._lock:
+            if self._counts.get(run_id): return True
+            if self.shared is None: return False
+            cached = self._shared_checks.get(run_id)
+            if cached is not None and time.monotonic() - cached[0] < self.cache_seconds: return cached[1]
+        try:
+            subscribed = self.shared.count(run_id) > 0
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Warning: Run registry msgpack subscriber read for {run_id} failed: {e}")
+            subscribed = True # Pack rather than drop events
+        with self._lock:
+            self._shared_checks[run_id] = (time.monotonic(), subscribed)
+            if len(self._shared_checks) > 1024: self._shared_checks.pop(next(iter(self._shared_checks)))
+        return subscribed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"runs": len(self._counts), "subscribers": sum(self._counts.values()), "shared": self.shared is not None, "errors": self.errors}
+
+msgpack_subscribers = MsgpackSubscribers(MSGPACK_SUBSCRIBERS_CACHE_SECONDS,
+                                         shared=RedisSubscriberCounts(registry_redis, RUN_REGISTRY_TTL_SECONDS) if registry_redis is not None else None)
+
+class MsgpackRoomEmitter:
+    """
+    Wraps the process-wide Socket.IO emitter when MessagePack events are enabled.
+    Every room emit still goes to the JSON room and, when the run has msgpack
+    subscribers (see MsgpackSubscribers), is additionally packed once and sent to the
+    room's msgpack twin, where it travels as a binary attachment.
+    """
+    totals = {"events": 0, "bytes": 0, "encode_seconds": 0.0, "skipped_events": 0} # Process-wide counters for /stats
+    _totals_lock = threading.Lock() # Shared by every thread emitting through the wrapper
+
+    def __init__(self, emitter: Any, subscribers: Optional[MsgpackSubscribers] = None):
+        self._emitter = emitter
+        self._subscribers = subscribers or msgpack_subscribers
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._emitter, name)
+
+    @classmethod
+    def _count(cls, **increments: float) -> None:
+        with cls._totals_lock:
+            for key, value in increments.items():
+                cls.totals[key] += value
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        with cls._totals_lock:
+            return dict(cls.totals)
+
+    def emit(self, event: str, data: Any = None, room: Optional[str] = None, **kwargs: Any) -> None:
+        self._emitter.emit(event, data, room=room, **kwargs)
+        if room is None: return
+        if not self._subscribers.active(room):
+            self._count(skipped_events=1)
+            return
+        started = time.perf_counter()
+        packed = encode_event_payload(data, "msgpack")
+        self._count(encode_seconds=time.perf_counter() - started, events=1, bytes=len(packed))
+        self._emitter.emit(event, packed, room=event_room(room, "msgpack"), **kwargs)
 
 
 # --- Custom WebSocket Callback Handler (Keep As Is) ---
@@ -163,28 +2697,75 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
     """
     LangChain Callback Handler that emits messages via SocketIO,
     tracks task I/O, cumulative agent token usage, and per-task token usage.
+    Agent/task state is tracked per task (keyed by task id), so tasks running
+    concurrently in level-parallel mode each keep their own context; LLM
+    callbacks resolve their task through `task_key` (see TaskScopedCallbackHandler)
+    or fall back to the most recently started task in sequential mode.
     Includes enhanced debugging and error handling within callbacks.
     """
-    def __init__(self, socketio_instance, run_id: str):
+    COMPACTION_TASK_KEY = "context_compaction"
+    COMPACTION_AGENT_NAME = "Context Compaction"
+
+    def __init__(self, socketio_instance, run_id: str, completion_cache_enabled: bool = False):
         print(f"[Callback Handler {run_id}] Initialized.") # DEBUG PRINT
         self.socketio = socketio_instance
         self.run_id = run_id
         self.agent_token_usage: Dict[str, Dict[str, int]] = {}
         self.task_io_log: List[Dict[str, Any]] = []
-        self._current_agent_name: Optional[str] = None
-        self._current_task_description: Optional[str] = None
-        self._current_task_tokens: Dict[str, int] = self._reset_task_token_counter()
+        self._lock = threading.RLock() # Concurrent tasks update the shared usage/log structures
+        self._task_states: Dict[str, Dict[str, Any]] = {} # task_key -> per-task state
+        self._current_task_key: Optional[str] = None # Latest started task (sequential mode)
+        self._idle_state: Dict[str, Any] = self._new_task_state(None, None) # LLM calls outside any task
+        self._ended_task_keys: set = set() # Guards against a task being ended twice
+        self._log_prefix_key: Optional[tuple] = None # (agent, task) the cached prefix was built for
+        self._log_prefix: str = f"Run({run_id})"
+        self._llm_call_started: Dict[Any, tuple] = {} # LangChain call run_id (or task key) -> (perf_counter at start, model)
+        self.agent_llm_latency: Dict[str, List[float]] = {} # agent -> [calls, total seconds]
+        self.llm_call_durations: List[float] = []
+        self.task_durations: List[float] = []
+        self.completion_cache_enabled = completion_cache_enabled
+        self.completion_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "tokens_saved": 0}
+        self._rate_limit_reservations: Dict[Any, tuple] = {} # LangChain call run_id (or task key) -> (model, estimated tokens)
+        self.rate_limited_calls = 0 # LLM calls (and the hierarchy call) that went through rate_limiter
+        self.rate_limit_waits: List[float] = [] # Seconds queued on rate_limiter, one entry per call that had to wait
 
     def _reset_task_token_counter(self) -> Dict[str, int]:
         return {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
 
-    def _emit_log(self, event_type: str, data: Dict[str, Any]):
-        agent_name_context = data.get("agent_name") or self._current_agent_name
-        task_desc = data.get("task_description", None) or self._current_task_description
-        log_prefix = f"Run({self.run_id})"
-        if agent_name_context: log_prefix += f" Agent({agent_name_context})"
-        if task_desc: log_prefix += f" Task({task_desc[:30]}...)"
-        payload = { "type": event_type, "run_id": self.run_id, "log_prefix": log_prefix, "data": data }
+    def _new_task_state(self, agent_name: Optional[str], task_description: Optional[str]) -> Dict[str, Any]:
+        return {
+            "agent_name": agent_name,
+            "task_description": task_description,
+            "tokens": self._reset_task_token_counter(),
+            "started_at": time.perf_counter(),
+            "llm_calls": 0,
+            "context_tokens_removed": 0, # Context tokens the compaction stage removed from this task's input
+            # Token streaming micro-batch state (only used when the LLM streams)
+            "token_buffer": [],
+            "token_buffer_chars": 0,
+            "token_last_flush": time.monotonic(),
+            "token_chunk_index": 0,
+        }
+
+    @staticmethod
+    def task_key_for(task: CrewTask) -> str:
+        return str(getattr(task, 'id', None) or id(task))
+
+    def _state(self, task_key: Optional[str] = None) -> Dict[str, Any]:
+        key = task_key or self._current_task_key
+        return self._task_states.get(key) if key in self._task_states else self._idle_state
+
+    def _emit_log(self, event_type: str, data: Dict[str, Any], state: Optional[Dict[str, Any]] = None):
+        state = state or self._state()
+        agent_name_context = data.get("agent_name") or state["agent_name"]
+        task_desc = data.get("task_description", None) or state["task_description"]
+        if (agent_name_context, task_desc) != self._log_prefix_key:
+            log_prefix = f"Run({self.run_id})"
+            if agent_name_context: log_prefix += f" Agent({agent_name_context})"
+            if task_desc: log_prefix += f" Task({task_desc[:30]}...)"
+            self._log_prefix_key = (agent_name_context, task_desc)
+            self._log_prefix = log_prefix
+        payload = { "type": event_type, "run_id": self.run_id, "log_prefix": self._log_prefix, "data": data }
         try:
             self.socketio.emit('log_update', payload, room=self.run_id)
             # print(f"[Callback Handler {self.run_id}] Emitted log: {event_type}") # Optional: Verbose log emission
@@ -193,25 +2774,80 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
             traceback.print_exc() # Print detailed error for emit failure
 
     def on_llm_start(
-        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+        self, serialized: Dict[str, Any], prompts: List[str], task_key: Optional[str] = None, **kwargs: Any
     ) -> None:
-        # print(f"[Callback Handler {self.run_id}] DEBUG: on_llm_start triggered. Current Agent: {self._current_agent_name}, Current Task: {self._current_task_description}") # DEBUG PRINT
         try:
+            call_key = kwargs.get('run_id') or task_key or self._current_task_key
+            model = self._model_name(serialized, kwargs)
+            state = self._state(task_key)
+            self._llm_call_started[call_key] = (time.perf_counter(), model)
             self._emit_log("llm_start", {
-                "agent_name": self._current_agent_name,
-                "task_description": self._current_task_description,
+                "agent_name": state["agent_name"],
+                "task_description": state["task_description"],
                 "prompts_summary": [p[:100]+"..." for p in prompts]
-            })
+            }, state)
         except Exception as e:
             print(f"[Callback Handler {self.run_id}] ERROR in on_llm_start: {e}")
             traceback.print_exc() # Print detailed error
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        # print(f"[Callback Handler {self.run_id}] DEBUG: on_llm_end triggered. Current Agent: {self._current_agent_name}, Current Task: {self._current_task_description}") # DEBUG PRINT
+    def on_custom_event(self, name: str, data: Any, *, run_id: Any = None, task_key: Optional[str] = None, **kwargs: Any) -> None:
+        if name != RATE_LIMIT_RESERVED_EVENT: return
+        try:
+            # Sent by RateLimitedChatOpenAI after a cache miss, just before the request goes out
+            call_key = run_id or task_key or self._current_task_key
+            state = self._state(task_key)
+            waited = data["wait_seconds"]
+            self._rate_limit_reservations[call_key] = (data["model"], data["estimated_tokens"])
+            self.record_rate_limit_wait(waited)
+            call_started = self._llm_call_started.get(call_key)
+            if call_started is not None and waited > 0:
+                self._llm_call_started[call_key] = (call_started[0] + waited, call_started[1]) # The wait is not part of the call latency
+            if waited > 0:
+                self._emit_log("rate_limit_wait", {"agent_name": state["agent_name"], "model": data["model"], "wait_seconds": round(waited, 3)}, state)
+        except Exception as e:
+            print(f"[Callback Handler {self.run_id}] ERROR in on_custom_event: {e}")
+            traceback.print_exc()
+
+    def _flush_tokens(self, state: Dict[str, Any]) -> None:
+        """Emits a task's buffered stream tokens as a single `llm_token` event."""
+        if not state["token_buffer"]: return
+        text = "".join(state["token_buffer"])
+        state["token_buffer"] = []
+        state["token_buffer_chars"] = 0
+        state["token_last_flush"] = time.monotonic()
+        self._emit_log("llm_token", {
+            "agent_name": state["agent_name"],
+            "task_description": state["task_description"],
+            "chunk_index": state["token_chunk_index"],
+            "text": text,
+        }, state)
+        state["token_chunk_index"] += 1
+
+    def on_llm_new_token(self, token: str, task_key: Optional[str] = None, **kwargs: Any) -> None:
+        try:
+            if not token: return
+            state = self._state(task_key)
+            state["token_buffer"].append(token)
+            state["token_buffer_chars"] += len(token)
+            # Throttle: one frame per interval, or sooner if a lot of text has built up
+            if (state["token_buffer_chars"] >= STREAM_TOKEN_FLUSH_CHARS
+                    or time.monotonic() - state["token_last_flush"] >= STREAM_TOKEN_FLUSH_INTERVAL):
+                self._flush_tokens(state)
+        except Exception as e:
+            print(f"[Callback Handler {self.run_id}] ERROR in on_llm_new_token: {e}")
+            traceback.print_exc()
+
+    def on_llm_end(self, response: LLMResult, task_key: Optional[str] = None, **kwargs: Any) -> None:
         # print(f"[Callback Handler {self.run_id}] DEBUG: LLM Output: {response.llm_output}") # DEBUG PRINT - Check for token_usage here
         try:
+            state = self._state(task_key)
+            agent_name = state["agent_name"]
+            task_description = state["task_description"]
+            self._flush_tokens(state) # Tail of a streamed response goes out before llm_end
+            state["token_chunk_index"] = 0
             token_usage = {}
             llm_output_data = response.llm_output or {}
+            streamed_usage = self._streamed_usage_metadata(response)
             if 'token_usage' in llm_output_data:
                 raw_usage = llm_output_data['token_usage']
                 token_usage = {
@@ -220,54 +2856,163 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
                     'completion_tokens': int(raw_usage.get('completion_tokens', 0)),
                 }
                 # print(f"[Callback Handler {self.run_id}] DEBUG: Parsed token_usage: {token_usage}") # DEBUG PRINT
+            elif streamed_usage:
+                # Streaming responses report usage on the message instead of llm_output
+                token_usage = {
+                    'total_tokens': int(streamed_usage.get('total_tokens', 0)),
+                    'prompt_tokens': int(streamed_usage.get('input_tokens', 0)),
+                    'completion_tokens': int(streamed_usage.get('output_tokens', 0)),
+                }
             else:
                  print(f"[Callback Handler {self.run_id}] WARNING: 'token_usage' not found in llm_output.") # DEBUG WARNING
 
-            # Accumulate for TASK
-            if token_usage and self._current_task_description:
-                self._current_task_tokens['total_tokens'] += token_usage.get('total_tokens', 0)
-                self._current_task_tokens['prompt_tokens'] += token_usage.get('prompt_tokens', 0)
-                self._current_task_tokens['completion_tokens'] += token_usage.get('completion_tokens', 0)
-                # print(f"[Callback Handler {self.run_id}] DEBUG: Accumulated task tokens: {self._current_task_tokens}") # DEBUG PRINT
-            elif token_usage:
-                 print(f"[Callback Handler {self.run_id}] DEBUG: Token usage found but no current task description set.") # DEBUG PRINT
-
-            # Accumulate for AGENT
-            if self._current_agent_name and token_usage:
-                agent_usage = self.agent_token_usage.setdefault(self._current_agent_name, self._reset_task_token_counter()) # Use reset helper for consistency
-                agent_usage['total_tokens'] += token_usage.get('total_tokens', 0)
-                agent_usage['prompt_tokens'] += token_usage.get('prompt_tokens', 0)
-                agent_usage['completion_tokens'] += token_usage.get('completion_tokens', 0)
-                # print(f"[Callback Handler {self.run_id}] DEBUG: Accumulated agent '{self._current_agent_name}' tokens: {agent_usage}") # DEBUG PRINT
-
+            # Completion cache hits carry the original call's usage but cost nothing:
+            # count them as saved tokens instead of billing them to the task/agent
+            cache_tier = self._completion_cache_tier(response)
+            cached_usage = {}
+            if cache_tier:
+                cached_usage, token_usage = token_usage, {}
+                with self._lock:
+                    self.completion_cache_stats["hits"] += 1
+                    self.completion_cache_stats["tokens_saved"] += cached_usage.get('total_tokens', 0)
+            elif self.completion_cache_enabled:
+                with self._lock:
+                    self.completion_cache_stats["misses"] += 1
+
+            call_key = kwargs.get('run_id') or task_key or self._current_task_key
+            reservation = self._rate_limit_reservations.pop(call_key, None) # None for cache hits: they reserve nothing
+            if reservation is not None and token_usage:
+                rate_limiter.reconcile(reservation[0], reservation[1], token_usage.get('total_tokens', 0))
+
+            call_started = self._llm_call_started.pop(call_key, None)
+            if call_started is not None:
+                call_seconds = time.perf_counter() - call_started[0]
+                with self._lock:
+                    self.llm_call_durations.append(call_seconds)
+                    if agent_name and not cache_tier:
+                        agent_latency = self.agent_llm_latency.setdefault(agent_name, [0, 0.0])
+                        agent_latency[0] += 1
+                        agent_latency[1] += call_seconds
+                record_metric("observe", "crew_llm_call_seconds", call_seconds, model=call_started[1] or "unknown")
+                if not cache_tier: model_router.observe(call_started[1], call_seconds, ok=True)
+            if token_usage:
+                record_metric("inc", "crew_llm_tokens_total", token_usage.get('prompt_tokens', 0), kind="prompt")
+                record_metric("inc", "crew_llm_tokens_total", token_usage.get('completion_tokens', 0), kind="completion")
+
+            with self._lock:
+                state["llm_calls"] += 1
+                # Accumulate for TASK
+                task_tokens = state["tokens"]
+                if token_usage and task_description:
+                    task_tokens['total_tokens'] += token_usage.get('total_tokens', 0)
+                    task_tokens['prompt_tokens'] += token_usage.get('prompt_tokens', 0)
+                    task_tokens['completion_tokens'] += token_usage.get('completion_tokens', 0)
+                elif token_usage:
+                     print(f"[Callback Handler {self.run_id}] DEBUG: Token usage found but no current task description set.") # DEBUG PRINT
+
+                # Accumulate for AGENT
+                agent_usage = None
+                if agent_name and cached_usage:
+                    agent_usage = self.agent_token_usage.setdefault(agent_name, self._reset_task_token_counter())
+                    agent_usage['cached_tokens'] = agent_usage.get('cached_tokens', 0) + cached_usage.get('total_tokens', 0)
+                if agent_name and token_usage:
+                    agent_usage = self.agent_token_usage.setdefault(agent_name, self._reset_task_token_counter()) # Use reset helper for consistency
+                    agent_usage['total_tokens'] += token_usage.get('total_tokens', 0)
+                    agent_usage['prompt_tokens'] += token_usage.get('prompt_tokens', 0)
+                    agent_usage['completion_tokens'] += token_usage.get('completion_tokens', 0)
+                elif token_usage:
+                    print(f"[Callback Handler {self.run_id}] DEBUG: Token usage found but no current agent name set.") # DEBUG PRINT
+
+            if agent_usage is not None:
                 # Emit agent usage update
                 self._emit_log("agent_usage_update", {
-                    "agent_name": self._current_agent_name,
-                    "cumulative_usage": self.agent_token_usage[self._current_agent_name]
-                })
-            elif token_usage:
-                print(f"[Callback Handler {self.run_id}] DEBUG: Token usage found but no current agent name set.") # DEBUG PRINT
+                    "agent_name": agent_name,
+                    "cumulative_usage": agent_usage
+                }, state)
 
             generations_summary = [[gen.text[:100] + '...' if len(gen.text) > 100 else gen.text
                                     for gen in gen_list]
                                    for gen_list in response.generations]
             self._emit_log("llm_end", {
-                "agent_name": self._current_agent_name,
-                "task_description": self._current_task_description,
+                "agent_name": agent_name,
+                "task_description": task_description,
                 "token_usage_for_call": token_usage,
-                "cumulative_agent_usage": self.agent_token_usage.get(self._current_agent_name, {}),
-                "accumulated_task_usage": self._current_task_tokens if self._current_task_description else {},
+                "completion_cache": cache_tier,
+                "cached_usage_for_call": cached_usage,
+                "cumulative_agent_usage": self.agent_token_usage.get(agent_name, {}),
+                "accumulated_task_usage": task_tokens if task_description else {},
                 "generations_summary": generations_summary
-            })
+            }, state)
 
         except Exception as e:
             print(f"[Callback Handler {self.run_id}] ERROR in on_llm_end: {e}")
             traceback.print_exc() # Print detailed error
 
-    def on_task_start( self, task: CrewTask, **kwargs: Any ) -> Any:
-        # print(f"\n[Callback Handler {self.run_id}] DEBUG: ****** on_task_start triggered ******") # DEBUG PRINT
-        # print(f"[Callback Handler {self.run_id}] DEBUG: Task Description: {getattr(task, 'description', 'N/A')}") # DEBUG PRINT
-        # print(f"[Callback Handler {self.run_id}] DEBUG: Task Agent Role: {getattr(task.agent, 'role', 'N/A') if task.agent else 'No Agent Object'}") # DEBUG PRINT
+    def on_llm_error(self, error: BaseException, task_key: Optional[str] = None, **kwargs: Any) -> None:
+        try:
+            call_key = kwargs.get('run_id') or task_key or self._current_task_key
+            reservation = self._rate_limit_reservations.pop(call_key, None)
+            if reservation is not None:
+                rate_limiter.reconcile(reservation[0], reservation[1], 0) # Failed calls generate no tokens
+            call_started = self._llm_call_started.pop(call_key, None)
+            model = call_started[1] if call_started else None
+            if call_started is not None:
+                model_router.observe(model, time.perf_counter() - call_started[0], ok=False)
+            record_metric("inc", "crew_llm_errors_total", model=model or "unknown")
+            state = self._state(task_key)
+            self._emit_log("llm_error", {
+                "agent_name": state["agent_name"],
+                "task_description": state["task_description"],
+                "model": model,
+                "error": str(error)[:500],
+            }, state)
+        except Exception as e:
+            print(f"[Callback Handler {self.run_id}] ERROR in on_llm_error: {e}")
+            traceback.print_exc()
+
+    @staticmethod
+    def _model_name(serialized: Optional[Dict[str, Any]], kwargs: Dict[str, Any]) -> Optional[str]:
+        """Model of an LLM call, from the invocation params LangChain passes to on_llm_start."""
+        params = kwargs.get('invocation_params') or {}
+        model = params.get('model_name') or params.get('model')
+        if not model and serialized:
+            serialized_kwargs = serialized.get('kwargs') or {}
+            model = serialized_kwargs.get('model_name') or serialized_kwargs.get('model')
+        return model if isinstance(model, str) else None
+
+    def agent_latency_report(self) -> Dict[str, Dict[str, Any]]:
+        """Per-agent count and mean latency of the LLM calls that actually went to the model."""
+        with self._lock:
+            return {agent: {"llm_calls": calls, "avg_llm_latency_seconds": round(total / calls, 4) if calls else None}
+                    for agent, (calls, total) in self.agent_llm_latency.items()}
+
+    @staticmethod
+    def _completion_cache_tier(response: LLMResult) -> Optional[str]:
+        """Returns "memory"/"disk" when the response was served by CompletionCache."""
+        for gen_list in response.generations:
+            for gen in gen_list:
+                metadata = getattr(getattr(gen, 'message', None), 'response_metadata', None) or {}
+                if metadata.get('completion_cache'): return metadata['completion_cache']
+        return None
+
+    def completion_cache_report(self) -> Dict[str, Any]:
+        """Per-run completion cache hit/miss counts for result_data."""
+        with self._lock:
+            report = dict(self.completion_cache_stats, enabled=self.completion_cache_enabled)
+        lookups = report["hits"] + report["misses"]
+        report["hit_rate"] = round(report["hits"] / lookups, 4) if lookups else 0.0
+        return report
+
+    @staticmethod
+    def _streamed_usage_metadata(response: LLMResult) -> Optional[Dict[str, Any]]:
+        for gen_list in response.generations:
+            for gen in gen_list:
+                usage = getattr(getattr(gen, 'message', None), 'usage_metadata', None)
+                if usage: return usage
+        return None
+
+    def on_task_start( self, task: CrewTask, task_key: Optional[str] = None, context_text: Optional[str] = None,
+                       context_compaction: Optional[Dict[str, Any]] = None, **kwargs: Any ) -> Any:
         # print(f"[Callback Handler {self.run_id}] DEBUG: Kwargs: {kwargs}") # See if useful info is passed
         try:
             agent_role = "Unknown Agent"
@@ -276,58 +3021,71 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
             else:
                  print(f"[Callback Handler {self.run_id}] Warning: Task started without agent role: {task.description}")
 
-            self._current_agent_name = agent_role
-            self._current_task_description = task.description
-            self._current_task_tokens = self._reset_task_token_counter()
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Set current_agent='{self._current_agent_name}', current_task='{self._current_task_description}', reset task tokens.") # DEBUG PRINT
-
-            self.agent_token_usage.setdefault(self._current_agent_name, self._reset_task_token_counter())
+            task_key = task_key or self.task_key_for(task)
+            if task_key in self._task_states: return # Already started
+            state = self._new_task_state(agent_role, task.description)
+            if context_compaction:
+                state["context_tokens_removed"] = context_compaction.get("tokens_removed", 0)
 
             input_context_summary = "Context analysis unavailable or empty."
-            if task.context:
+            if context_text:
+                input_context_summary = f"Context provided (length: {len(context_text)}, type: {type(context_text).__name__})"
+            elif task.context:
                 context_str = str(task.context)
                 input_context_summary = f"Context provided (length: {len(context_str)}, type: {type(task.context).__name__})"
 
+            with self._lock:
+                self._task_states[task_key] = state
+                self._current_task_key = task_key
+                self.agent_token_usage.setdefault(agent_role, self._reset_task_token_counter())
+                # Append to task_io_log
+                self.task_io_log.append({
+                    "task_description": task.description,
+                    "agent_name": agent_role,
+                    "input_context_summary": input_context_summary,
+                    "output": None,
+                    "token_usage": None,
+                    "duration_seconds": None,
+                    "context_compaction": context_compaction,
+                    "prompt_tokens_saved": 0
+                })
 
-            log_data = {
-                "task_description": self._current_task_description,
-                "agent_name": self._current_agent_name,
-                "input_context_summary": input_context_summary,
-            }
-            self._emit_log("task_start", log_data)
-
-            # Append to task_io_log
-            task_log_entry = {
-                "task_description": self._current_task_description,
-                "agent_name": self._current_agent_name,
+            self._emit_log("task_start", {
+                "task_description": task.description,
+                "agent_name": agent_role,
                 "input_context_summary": input_context_summary,
-                "output": None,
-                "token_usage": None
-            }
-            self.task_io_log.append(task_log_entry)
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Appended to task_io_log: {task_log_entry}") # DEBUG PRINT
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Current task_io_log length: {len(self.task_io_log)}") # DEBUG PRINT
+                "context_compaction": context_compaction,
+            }, state)
 
         except Exception as e:
             print(f"[Callback Handler {self.run_id}] ERROR in on_task_start: {e}")
             traceback.print_exc() # Print detailed error
 
-    def on_task_end( self, task: CrewTask, output: Any, **kwargs: Any ) -> Any:
-        # print(f"\n[Callback Handler {self.run_id}] DEBUG: ****** on_task_end triggered ******") # DEBUG PRINT
-        # print(f"[Callback Handler {self.run_id}] DEBUG: Task Description: {getattr(task, 'description', 'N/A')}") # DEBUG PRINT
-        # print(f"[Callback Handler {self.run_id}] DEBUG: Task Agent Role: {getattr(task.agent, 'role', 'N/A') if task.agent else 'No Agent Object'}") # DEBUG PRINT
+    def on_task_end( self, task: CrewTask, output: Any, task_key: Optional[str] = None, **kwargs: Any ) -> Any:
         # print(f"[Callback Handler {self.run_id}] DEBUG: Output type: {type(output)}") # DEBUG PRINT
-        # print(f"[Callback Handler {self.run_id}] DEBUG: Kwargs: {kwargs}") # See if useful info is passed
         try:
-            # Use self._current_agent_name if available, fallback to task.agent.role
-            agent_role = self._current_agent_name if self._current_agent_name else "Unknown Agent (End)"
+            task_key = task_key or self.task_key_for(task)
+            if task_key in self._ended_task_keys: return
+            state = self._task_states.get(task_key)
+            if state is None and self._current_task_key in self._task_states:
+                # Task object changed between start and end: fall back to the latest started task
+                state = self._task_states[self._current_task_key]
+                task_key = self._current_task_key
+            state = state or self._new_task_state(None, task.description)
+
+            # Use the tracked agent name if available, fallback to task.agent.role
+            agent_role = state["agent_name"] if state["agent_name"] else "Unknown Agent (End)"
             # Correct agent role if task object seems more reliable
             if task.agent and task.agent.role and task.agent.role != agent_role:
                 print(f"[Callback Handler {self.run_id}] Warning: Task end agent role '{task.agent.role}' differs from tracked '{agent_role}' for task: {task.description}. Using task object role.")
                 agent_role = task.agent.role
 
-            final_task_tokens = self._current_task_tokens.copy()
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Final tokens for this task: {final_task_tokens}") # DEBUG PRINT
+            self._flush_tokens(state)
+            final_task_tokens = state["tokens"].copy()
+            task_seconds = round(time.perf_counter() - state["started_at"], 4)
+            record_metric("observe", "crew_task_seconds", task_seconds)
+            # The removed context would have been part of the prompt of every LLM call the task made
+            prompt_tokens_saved = state["context_tokens_removed"] * max(1, state["llm_calls"]) if state["context_tokens_removed"] else 0
 
             print(f"[Callback Handler {self.run_id}] TASK COMPLETE - Task: '{task.description[:50]}...', Agent: {agent_role}, Tokens Used (Task): {final_task_tokens}")
 
@@ -338,40 +3096,43 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
                 "task_description": task.description,
                 "agent_name": agent_role,
                 "output_summary": output_summary_log,
-                "token_usage_for_task": final_task_tokens
+                "token_usage_for_task": final_task_tokens,
+                "duration_seconds": task_seconds,
+                "prompt_tokens_saved": prompt_tokens_saved
             }
-            self._emit_log("task_end", log_data)
-
-            entry_updated = False
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Searching task_io_log (len {len(self.task_io_log)}) for task '{task.description}' to update.") # DEBUG PRINT
-            for i in range(len(self.task_io_log) - 1, -1, -1):
-                entry = self.task_io_log[i]
-                # Match primarily on description, ensure output/tokens not set yet
-                if entry["task_description"] == task.description and entry["output"] is None and entry["token_usage"] is None:
-                    # print(f"[Callback Handler {self.run_id}] DEBUG: Found matching task_io_log entry at index {i}.") # DEBUG PRINT
-                    entry["output"] = output_str
-                    entry["token_usage"] = final_task_tokens
-                    if entry["agent_name"] != agent_role:
-                        print(f"[Callback Handler {self.run_id}] Notice: Updating agent name in task log from '{entry['agent_name']}' to '{agent_role}' on task end.")
-                        entry["agent_name"] = agent_role
-                    entry_updated = True
-                    break # Stop searching once updated
-
-            if not entry_updated:
-                print(f"[Callback Handler {self.run_id}] Warning: Could not find matching task_start entry in task_io_log for task: {task.description}. Appending new.")
-                self.task_io_log.append({ # Append even if start missed
-                    "task_description": task.description, "agent_name": agent_role,
-                    "input_context_summary": "Task start log missing/mismatched",
-                    "output": output_str, "token_usage": final_task_tokens
-                })
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Updated task_io_log length: {len(self.task_io_log)}") # DEBUG PRINT
-
-            # Clear current task/agent trackers
-            # print(f"[Callback Handler {self.run_id}] DEBUG: Clearing current task ('{self._current_task_description}') and agent ('{self._current_agent_name}').") # DEBUG PRINT
-            self._current_task_description = None
-            self._current_agent_name = None
-            # Resetting counter isn't strictly necessary as on_task_start does it
-            # self._current_task_tokens = self._reset_task_token_counter()
+            self._emit_log("task_end", log_data, state)
+
+            with self._lock:
+                self._ended_task_keys.add(task_key)
+                self.task_durations.append(task_seconds)
+                entry_updated = False
+                for i in range(len(self.task_io_log) - 1, -1, -1):
+                    entry = self.task_io_log[i]
+                    # Match primarily on description, ensure output/tokens not set yet
+                    if entry["task_description"] == task.description and entry["output"] is None and entry["token_usage"] is None:
+                        entry["output"] = output_str
+                        entry["token_usage"] = final_task_tokens
+                        entry["duration_seconds"] = task_seconds
+                        entry["prompt_tokens_saved"] = prompt_tokens_saved
+                        if entry["agent_name"] != agent_role:
+                            print(f"[Callback Handler {self.run_id}] Notice: Updating agent name in task log from '{entry['agent_name']}' to '{agent_role}' on task end.")
+                            entry["agent_name"] = agent_role
+                        entry_updated = True
+                        break # Stop searching once updated
+
+                if not entry_updated:
+                    print(f"[Callback Handler {self.run_id}] Warning: Could not find matching task_start entry in task_io_log for task: {task.description}. Appending new.")
+                    self.task_io_log.append({ # Append even if start missed
+                        "task_description": task.description, "agent_name": agent_role,
+                        "input_context_summary": "Task start log missing/mismatched",
+                        "output": output_str, "token_usage": final_task_tokens,
+                        "duration_seconds": task_seconds, "prompt_tokens_saved": prompt_tokens_saved
+                    })
+
+                # Clear this task's tracker
+                self._task_states.pop(task_key, None)
+                if self._current_task_key == task_key:
+                    self._current_task_key = None
 
         except Exception as e:
             print(f"[Callback Handler {self.run_id}] ERROR in on_task_end: {e}")
@@ -385,9 +3146,336 @@ class WebSocketCallbackHandler(BaseCallbackHandler):
          # print(f"[Callback Handler {self.run_id}] DEBUG: get_task_io_log called. Returning log with {len(self.task_io_log)} entries.") # DEBUG PRINT
          return self.task_io_log
 
+    def timing_summary(self) -> Dict[str, Dict[str, Any]]:
+        """Count/total/max seconds of the LLM calls and tasks seen by this handler."""
+        def summarize(durations: List[float]) -> Dict[str, Any]:
+            return {
+                "count": len(durations),
+                "total_seconds": round(sum(durations), 4),
+                "max_seconds": round(max(durations), 4) if durations else 0.0,
+            }
+        with self._lock:
+            return {"llm_calls": summarize(self.llm_call_durations), "tasks": summarize(self.task_durations),
+                    "rate_limit_wait": summarize(self.rate_limit_waits)}
+
+    def record_rate_limit_wait(self, seconds: float) -> None:
+        """Counts one call through rate_limiter and, if it had to queue, how long it waited."""
+        with self._lock:
+            self.rate_limited_calls += 1
+            if seconds > 0: self.rate_limit_waits.append(seconds)
+
+    def rate_limit_report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": rate_limiter.enabled,
+                "calls": self.rate_limited_calls,
+                "throttled_calls": len(self.rate_limit_waits),
+                "wait_seconds": round(sum(self.rate_limit_waits), 4),
+                "max_wait_seconds": round(max(self.rate_limit_waits), 4) if self.rate_limit_waits else 0.0,
+            }
+
+    def for_task(self, task_key: str) -> "TaskScopedCallbackHandler":
+        """Returns a callback handler that attributes LLM events to the given task."""
+        return TaskScopedCallbackHandler(self, task_key)
+
+    def for_compaction(self) -> "TaskScopedCallbackHandler":
+        """Returns a callback handler for context summary calls, billed to the COMPACTION_AGENT_NAME pseudo-agent."""
+        with self._lock:
+            self._task_states.setdefault(self.COMPACTION_TASK_KEY, self._new_task_state(self.COMPACTION_AGENT_NAME, None))
+        return self.for_task(self.COMPACTION_TASK_KEY)
+
+
+class TaskScopedCallbackHandler(BaseCallbackHandler):
+    """
+    Thin LangChain callback that forwards LLM events to a WebSocketCallbackHandler
+    together with a fixed `task_key`. Each concurrently running agent gets its own
+    LLM instance with one of these, so usage and streamed tokens land on the right task.
+    """
+    def __init__(self, parent: WebSocketCallbackHandler, task_key: str):
+        self.parent = parent
+        self.task_key = task_key
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        self.parent.on_llm_start(serialized, prompts, task_key=self.task_key, **kwargs)
+
+    def on_custom_event(self, name: str, data: Any, **kwargs: Any) -> None:
+        self.parent.on_custom_event(name, data, task_key=self.task_key, **kwargs)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.parent.on_llm_new_token(token, task_key=self.task_key, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        self.parent.on_llm_end(response, task_key=self.task_key, **kwargs)
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        self.parent.on_llm_error(error, task_key=self.task_key, **kwargs)
+
+
+# --- Inter-Task Context Compaction ---
+COMPACTION_STOPWORDS = frozenset(
+    "the and for that with this from have will your their there which into about been were they them "
+    "than then also such these those what when where while would could should must more most other".split()
+)
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Approximate token count (~4 characters per token for English text with OpenAI tokenizers)."""
+    return (len(text) + 3) // 4 if text else 0
+
+def task_output_text(output: Any) -> Optional[str]:
+    """Raw text of a CrewAI TaskOutput (or a plain string)."""
+    if output is None: return None
+    if isinstance(output, str): return output
+    for attr in ('raw', 'raw_output'):
+        value = getattr(output, attr, None)
+        if isinstance(value, str): return value
+    return str(output)
+
+def set_task_output_text(output: Any, text: str) -> bool:
+    """Replaces a TaskOutput's raw text, which CrewAI hands to later tasks as context. Returns False if immutable."""
+    for attr in ('raw', 'raw_output'):
+        if isinstance(getattr(output, attr, None), str):
+            try:
+                setattr(output, attr, text)
+                return True
+            except (AttributeError, TypeError, ValueError):
+                return False
+    return False
+
+class ContextCompactor:
+    """
+    Keeps the output one task hands to the next under a token budget.
+    Modes:
+      truncate   - keep the head and tail of the output around an omission marker,
+      extractive - keep the highest-scoring sentences (term frequency) in their original order,
+      summary    - ask a cheap model for a summary within the budget (falls back to extractive).
+    Summary calls go through `callbacks` like the crew's own LLM calls (rate limiting, usage, cost).
+    `compact` returns the text to hand on and a record of the savings (None if untouched).
+    """
+    def __init__(self, mode: str = "off", budget_tokens: int = 1500, api_key: Optional[str] = None,
+                 summary_model: str = CONTEXT_COMPACTION_SUMMARY_MODEL, callbacks: Optional[List[BaseCallbackHandler]] = None):
+        self.mode = mode if mode in CONTEXT_COMPACTION_MODES else "off"
+        self.budget_tokens = max(1, budget_tokens)
+        self.api_key = api_key
+        self.summary_model = summary_model
+        self.callbacks = callbacks
+        self._lock = threading.Lock()
+        self.compactions = 0
+        self.tokens_removed = 0
+        self.summary_failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _truncate(self, text: str) -> str:
+        budget_chars = self.budget_tokens * 4
+        head_chars = budget_chars * 2 // 3
+        tail_chars = budget_chars - head_chars
+        omitted = estimate_tokens(text[head_chars:len(text) - tail_chars])
+        return f"{text[:head_chars].rstrip()}\n[... about {omitted} tokens omitted ...]\n{text[len(text) - tail_chars:].lstrip()}"
+
+    def _extractive(self, text: str) -> str:
+        sentences = [piece.strip() for piece in re.split(r'(?<=[.!?])\s+|\n+', text) if piece.strip()]
+        if len(sentences) < 2: return self._truncate(text)
+        frequencies: Dict[str, int] = {}
+        sentence_words = []
+        for sentence in sentences:
+            words = [word for word in re.findall(r'[a-z0-9]+', sentence.lower()) if len(word) > 3 and word not in COMPACTION_STOPWORDS]
+            sentence_words.append(words)
+            for word in words: frequencies[word] = frequencies.get(word, 0) + 1
+        scores = []
+        for index, words in enumerate(sentence_words):
+            score = sum(frequencies[word] for word in words) / (len(words) + 1)
+            if index == 0 or sentences[index].startswith(('#', '-', '*')): score *= 1.5 # Openers and headings/bullets carry structure
+            scores.append((score, index))
+        budget_chars = self.budget_tokens * 4
+        kept, used_chars = set(), 0
+        for _, index in sorted(scores, reverse=True):
+            length = len(sentences[index]) + 1
+            if used_chars + length > budget_chars: continue
+            kept.add(index)
+            used_chars += length
+        if not kept: return self._truncate(text)
+        return "\n".join(sentences[index] for index in sorted(kept))
+
+    def _summarize(self, text: str) -> Optional[tuple]:
+        """Returns (summary, usage) from the summary model, or None on any failure."""
+        if not self.api_key: return None
+        messages = [
+            ("system", "You compress work handed between AI agents. Keep every fact, figure, decision and open item the next agent needs; drop repetition and filler."),
+            ("human", f"Summarize the following in at most {self.budget_tokens} tokens:\n\n{text}"),
+        ]
+        try:
+            llm = build_crew_llm(self.summary_model, self.api_key, callbacks=self.callbacks)
+            message = llm.bind(temperature=0, max_tokens=self.budget_tokens).invoke(messages)
+            summary = (message.content or "").strip()
+            usage_metadata = getattr(message, 'usage_metadata', None) or {}
+            usage = {
+                "prompt_tokens": int(usage_metadata.get('input_tokens', 0)),
+                "completion_tokens": int(usage_metadata.get('output_tokens', 0)),
+                "total_tokens": int(usage_metadata.get('total_tokens', 0)),
+            }
+            return (summary, usage) if summary else None
+        except Exception as e:
+            print(f"Warning: context summary failed, falling back to extractive compaction: {e}")
+            return None
+
+    def compact(self, text: Optional[str]) -> tuple:
+        original_tokens = estimate_tokens(text)
+        if not self.enabled or original_tokens <= self.budget_tokens:
+            return text, None
+        mode_used, summary_usage = self.mode, None
+        if self.mode == "summary":
+            summarized = self._summarize(text)
+            if summarized is None:
+                with self._lock: self.summary_failures += 1
+                mode_used, compacted = "extractive", self._extractive(text)
+            else:
+                compacted, summary_usage = summarized
+        elif self.mode == "extractive":
+            compacted = self._extractive(text)
+        else:
+            compacted = self._truncate(text)
+        compacted_tokens = estimate_tokens(compacted)
+        if compacted_tokens >= original_tokens:
+            return text, None
+        record = {
+            "mode": mode_used,
+            "budget_tokens": self.budget_tokens,
+            "original_tokens": original_tokens,
+            "compacted_tokens": compacted_tokens,
+            "tokens_removed": original_tokens - compacted_tokens,
+        }
+        if summary_usage: record["summary_usage"] = summary_usage
+        with self._lock:
+            self.compactions += 1
+            self.tokens_removed += record["tokens_removed"]
+        return compacted, record
+
+    @staticmethod
+    def combine(records: List[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """Aggregates the records of several outputs handed to one task (level-parallel context)."""
+        records = [record for record in records if record]
+        if not records: return None
+        combined = {"mode": records[0]["mode"], "budget_tokens": records[0]["budget_tokens"], "sources": len(records)}
+        for key in ("original_tokens", "compacted_tokens", "tokens_removed"):
+            combined[key] = sum(record[key] for record in records)
+        return combined
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "budget_tokens": self.budget_tokens,
+                "compactions": self.compactions,
+                "context_tokens_removed": self.tokens_removed,
+                "summary_failures": self.summary_failures,
+            }
+
+
+def emit_context_compacted(socketio_instance: Any, run_id: str, agent_name: str, record: Dict[str, Any]) -> None:
+    socketio_instance.emit('log_update', {'type': 'context_compacted', 'run_id': run_id, 'data': dict(record, agent_name=agent_name, message=(
+        f"Compacted {agent_name}'s output from ~{record['original_tokens']} to ~{record['compacted_tokens']} tokens ({record['mode']}).")
+    )}, room=run_id)
+
+
+# --- Level-Parallel Execution ---
+def hierarchy_level(agent_info: Dict[str, Any], default: int) -> int:
+    """Reads an agent's integer `level`, falling back to `default` when missing or invalid."""
+    try:
+        level = int(agent_info.get('level'))
+        return level if level > 0 else default
+    except (TypeError, ValueError):
+        return default
+
+def crew_output_text(crew_output_obj: Any) -> Optional[str]:
+    """Extracts the raw text from a CrewAI kickoff result."""
+    if crew_output_obj is None: return None
+    if isinstance(crew_output_obj, str): return crew_output_obj
+    if getattr(crew_output_obj, 'raw', None) is not None: return crew_output_obj.raw
+    if getattr(crew_output_obj, 'result', None) is not None: return crew_output_obj.result
+    return str(crew_output_obj)
+
+def execute_hierarchy_levels(agent_plan: List[Dict[str, Any]], callback_handler: WebSocketCallbackHandler,
+                             run_id: str, socketio_instance: Any, compactor: Optional["ContextCompactor"] = None) -> tuple:
+    """
+    Runs the planned tasks level by level. Tasks on the same level run concurrently,
+    each as a single-task crew; a level starts once the whole previous level finished,
+    and its tasks already list the previous level's tasks as CrewAI `context`.
+    With an enabled `compactor`, each level's outputs are compacted before the next level reads them.
+    Returns (final_output, usage_metrics); raises RuntimeError if any task of a level fails.
+    """
+    levels = sorted({entry['level'] for entry in agent_plan})
+    usage_totals = {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'successful_requests': 0}
+    previous_outputs: List[tuple] = [] # (agent_role, output_text) of the last finished level
+    previous_compaction: Optional[Dict[str, Any]] = None # Combined compaction record of those outputs
+
+    for level_index, level in enumerate(levels):
+        level_entries = [entry for entry in agent_plan if entry['level'] == level]
+        context_text = "\n\n".join(f"[{role}]\n{output}" for role, output in previous_outputs) or None
+        socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {
+            'message': f'Starting level {level} with {len(level_entries)} agent(s) in parallel...',
+            'level': level, 'agents': [entry['agent'].role for entry in level_entries]
+        }}, room=run_id)
+
+        outputs: List[Optional[tuple]] = [None] * len(level_entries)
+        errors: List[str] = []
+
+        def run_entry(index: int, entry: Dict[str, Any]) -> None:
+            task = entry['task']
+            try:
+                callback_handler.on_task_start(task, task_key=entry['task_key'], context_text=context_text, context_compaction=previous_compaction)
+                crew = Crew(agents=[entry['agent']], tasks=[task], process=Process.sequential, verbose=False)
+                crew_output_obj = crew.kickoff(inputs=None)
+                output_text = crew_output_text(crew_output_obj)
+                callback_handler.on_task_end(task, output_text, task_key=entry['task_key'])
+                usage = getattr(crew_output_obj, 'token_usage', None) or getattr(crew, 'usage_metrics', None)
+                outputs[index] = (entry['agent'].role, output_text, usage)
+            except Exception as e:
+                print(f"Error (Run ID: {run_id}): Task for agent '{entry['agent'].role}' on level {level} failed: {e}")
+                traceback.print_exc()
+                errors.append(f"{entry['agent'].role}: {e}")
+
+        # Threads are green under eventlet, so concurrent LLM calls overlap on network I/O
+        workers = [threading.Thread(target=run_entry, args=(index, entry), daemon=True) for index, entry in enumerate(level_entries)]
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+
+        for output in outputs:
+            if output is None or not output[2]: continue
+            usage = output[2]
+            for key in usage_totals:
+                value = usage.get(key, 0) if isinstance(usage, dict) else getattr(usage, key, 0)
+                usage_totals[key] += int(value or 0)
+
+        if errors:
+            raise RuntimeError(f"Level {level} failed: " + "; ".join(errors))
+        previous_outputs = [(role, text) for role, text, _ in outputs]
+        previous_compaction = None
+        if compactor is not None and compactor.enabled and level_index + 1 < len(levels):
+            records = []
+            for position, (entry, (role, text)) in enumerate(zip(level_entries, previous_outputs)):
+                compacted, record = compactor.compact(text)
+                if record and record.get("summary_usage"):
+                    # The summary call is part of the run's spend even though no task made it
+                    for key in ('total_tokens', 'prompt_tokens', 'completion_tokens'):
+                        usage_totals[key] += record["summary_usage"].get(key, 0)
+                    usage_totals['successful_requests'] += 1
+                if record and not set_task_output_text(getattr(entry['task'], 'output', None), compacted):
+                    record = None # CrewAI will still hand on the full output
+                if record:
+                    previous_outputs[position] = (role, compacted)
+                    emit_context_compacted(socketio_instance, run_id, role, record)
+                records.append(record)
+            previous_compaction = ContextCompactor.combine(records)
+
+    if len(previous_outputs) == 1:
+        return previous_outputs[0][1], usage_totals
+    return "\n\n".join(f"## {role}\n{text}" for role, text in previous_outputs), usage_totals
+
 
 # --- Background Crew Execution Function (MODIFIED) ---
-def run_crew_background(task_description: str, run_id: str, socketio_instance: SocketIO):
+def run_crew_background(task_description: str, run_id: str, socketio_instance: SocketIO, use_hierarchy_cache: bool = True, queue_wait_seconds: float = 0.0, batch_logs: bool = LOG_BATCH_DEFAULT, stream_tokens: bool = STREAM_TOKENS_DEFAULT, execution_mode: str = CREW_EXECUTION_MODE_DEFAULT, use_completion_cache: bool = COMPLETION_CACHE_DEFAULT, context_compaction: str = CONTEXT_COMPACTION_MODE_DEFAULT, model_routing: bool = MODEL_ROUTING_DEFAULT, stream_hierarchy: bool = HIERARCHY_STREAMING_DEFAULT, generate_hierarchy=None):
     """
     Runs the CrewAI process in the background, tracks usage per agent and per task,
     assigns random token rates and calculates costs per agent, and emits updates via SocketIO.
@@ -397,11 +3485,77 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
         task_description: The user-provided task for the crew.
         run_id: The unique identifier for this execution run.
         socketio_instance: The Flask-SocketIO instance used for emitting messages.
+        use_hierarchy_cache: Whether a cached hierarchy may be reused for this run.
+        queue_wait_seconds: Time the run spent in the scheduler queue before starting.
+        batch_logs: Coalesce log_update events into periodic log_batch frames.
+        stream_tokens: Stream LLM output and forward it to the room as throttled llm_token events.
+        execution_mode: "sequential" or "level_parallel" (agents on the same hierarchy level run concurrently).
+        use_completion_cache: Answer repeated agent LLM calls from the shared completion cache.
+        context_compaction: How task outputs over CONTEXT_COMPACTION_BUDGET_TOKENS are compacted before
+            the next task reads them ("off", "truncate", "extractive" or "summary").
+        model_routing: Pick each agent's model with `model_router` instead of using CREW_LLM_MODEL for all.
+        stream_hierarchy: Stream the hierarchy completion, emitting hierarchy_agent events and building each
+            agent while the rest of the hierarchy is still being generated.
+        generate_hierarchy: Optional replacement for create_agent_hierarchy_with_ai with the same signature and
+            return contract (the ASGI server passes one backed by its async HTTP client).
     """
     print(f"--- Starting background crew run (ID: {run_id}) for task: '{task_description}' ---")
+    if batch_logs:
+        # Every emit below (and in the callback handler) goes through the batcher so ordering is kept
+        socketio_instance = LogBatchingEmitter(socketio_instance, interval=LOG_BATCH_INTERVAL, max_events=LOG_BATCH_MAX_EVENTS)
+    # Sequence numbers are assigned per event (outside the batcher) so replays are event-granular.
+    # In crew worker processes the web process records relayed events instead.
+    socketio_instance = SequencedEmitter(socketio_instance, run_event_log, record=not in_crew_worker_process())
     socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': 'Crew run starting...'}}, room=run_id)
 
-    callback_handler = WebSocketCallbackHandler(socketio_instance, run_id)
+    run_started_at = time.time()
+    run_started_perf = time.perf_counter()
+    callback_handler = WebSocketCallbackHandler(socketio_instance, run_id, completion_cache_enabled=use_completion_cache)
+    llm_cache = completion_cache if use_completion_cache else None
+    compactor = ContextCompactor(context_compaction, CONTEXT_COMPACTION_BUDGET_TOKENS, api_key=os.getenv("OPENAI_API_KEY"),
+                                 callbacks=[callback_handler.for_compaction()] if context_compaction == "summary" else None)
+
+    def compaction_report() -> Dict[str, Any]:
+        report = compactor.report()
+        report["prompt_tokens_saved"] = sum(entry.get("prompt_tokens_saved") or 0 for entry in callback_handler.get_task_io_log())
+        return report
+    phase_timings: Dict[str, Any] = {}
+
+    def record_phase(phase: str, started: float) -> None:
+        """Stores a phase's duration (perf_counter start -> now) for result_data and the phase histogram."""
+        elapsed = time.perf_counter() - started
+        phase_timings[phase] = round(elapsed, 4)
+        record_metric("observe", "crew_run_phase_seconds", elapsed, phase=phase)
+
+    def finalize_timings(status: str) -> Dict[str, Any]:
+        record_phase("total", run_started_perf)
+        record_metric("inc", "crew_runs_total", status=status, execution_mode=execution_mode)
+        return dict(phase_timings, **callback_handler.timing_summary())
+
+    def build_result_data(error: Optional[str] = None, hierarchy: Optional[List[Dict[str, Any]]] = None, final_output: Any = None,
+                          agent_token_usage: Optional[Dict[str, Any]] = None, hierarchy_similarity: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """The run's stored/emitted result (usage_metrics is filled in by the caller); closes the phase timings."""
+        return {
+            "run_id": run_id,
+            "task_description": task_description,
+            "agent_hierarchy": hierarchy,
+            "final_output": final_output,
+            "task_flow": callback_handler.get_task_io_log(),
+            "usage_metrics": None,
+            "agent_token_usage": callback_handler.get_agent_token_usage() if agent_token_usage is None else agent_token_usage,
+            "queue_wait_seconds": queue_wait_seconds,
+            "started_at": run_started_at,
+            "duration_seconds": round(time.time() - run_started_at, 3),
+            "phase_timings": finalize_timings('error' if error else 'success'),
+            "completion_cache": callback_handler.completion_cache_report(),
+            "context_compaction": compaction_report(),
+            "rate_limit": callback_handler.rate_limit_report(),
+            "hierarchy_similarity": hierarchy_similarity,
+            "error": error,
+        }
+
+    phase_timings["queue_wait"] = round(queue_wait_seconds, 4)
+    record_metric("observe", "crew_run_phase_seconds", queue_wait_seconds, phase="queue_wait")
 
     # --- Check API Key for Crew's LLM ---
     crew_llm_key = os.getenv("OPENAI_API_KEY")
@@ -411,52 +3565,143 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
         print(f"Error (Run ID: {run_id}): {error_occurred}")
         socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_occurred}}, room=run_id)
         # Store error before exiting
-        result_data = {
-            "run_id": run_id, 
-            "task_description": task_description, 
-            "agent_hierarchy": None,
-            "final_output": None, 
-            "task_flow": callback_handler.get_task_io_log(),
-            "usage_metrics": None, 
-            "agent_token_usage": callback_handler.get_agent_token_usage(),
-            "error": error_occurred
-        }
-        with storage_lock: crew_results_storage[run_id] = result_data
+        result_data = build_result_data(error=error_occurred)
+        save_run_result(run_id, result_data)
         socketio_instance.emit('run_complete', {'run_id': run_id, 'status': 'error', 'error': error_occurred, 'final_result': result_data}, room=run_id)
         return
 
     # --- Instantiate LLM with Callback ---
     llm_model_name = os.getenv("CREW_LLM_MODEL", "gpt-4o")
     llm_with_callbacks = None
+    phase_started = time.perf_counter()
     try:
-        llm_with_callbacks = ChatOpenAI(
-            model=llm_model_name,
-            openai_api_key=crew_llm_key,
-            callbacks=[callback_handler]
-        )
-        socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'LLM ({llm_model_name}) initialized with callbacks.'}}, room=run_id)
+        llm_with_callbacks = build_crew_llm(llm_model_name, crew_llm_key, callbacks=[callback_handler], streaming=stream_tokens, cache=llm_cache)
+        socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'LLM ({llm_model_name}) initialized with callbacks{" (streaming)" if stream_tokens else ""}{" (completion cache)" if llm_cache else ""}.'}}, room=run_id)
     except Exception as e:
         error_occurred = f"Failed to initialize LLM ({llm_model_name}): {e}"
         print(f"Error (Run ID: {run_id}): {error_occurred}")
         traceback.print_exc()
         socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_occurred}}, room=run_id)
-        result_data = {
-            "run_id": run_id, 
-            "task_description": task_description, 
-            "agent_hierarchy": None,
-            "final_output": None, 
-            "task_flow": callback_handler.get_task_io_log(),
-            "usage_metrics": None, 
-            "agent_token_usage": callback_handler.get_agent_token_usage(),
-            "error": error_occurred
-        }
-        with storage_lock: crew_results_storage[run_id] = result_data
+        result_data = build_result_data(error=error_occurred)
+        save_run_result(run_id, result_data)
         socketio_instance.emit('run_complete', {'run_id': run_id, 'status': 'error', 'error': error_occurred, 'final_result': result_data}, room=run_id)
         return
+    record_phase("llm_init", phase_started)
+
+    # --- Agent/Task Construction ---
+    agents: List[Agent] = []
+    tasks: List[CrewTask] = []
+    agent_plan: List[Dict[str, Any]] = [] # level_parallel: agent, task, level and task_key per hierarchy entry
+    agent_routes: Dict[str, Dict[str, Any]] = {} # agent role -> model routing decision
+    level_parallel = execution_mode == "level_parallel"
+
+    def build_agent(i: int, agent_info: Any) -> None:
+        """Builds the Agent and CrewTask for hierarchy entry `i`; invalid entries are skipped with a warning."""
+        try:
+            if not isinstance(agent_info, dict):
+                 raise TypeError(f"Agent data item {i} is not a dictionary: {agent_info}")
+            agent_name = agent_info.get('agent_name')
+            description = agent_info.get('description')
+            if not agent_name or not isinstance(agent_name, str):
+                raise KeyError(f"Missing or invalid 'agent_name' in agent data item {i}: {agent_info}")
+            if not description or not isinstance(description, str):
+                 raise KeyError(f"Missing or invalid 'description' in agent data item {i}: {agent_info}")
+
+            agent_role = agent_name.replace('_', ' ')
+            # print(f"[Crew Run {run_id}] DEBUG: Assigning LLM instance ID {id(llm_with_callbacks)} to Agent '{agent_role}'")
+
+            agent_llm = llm_with_callbacks
+            task_key = f"{run_id}:{i}"
+            route = model_router.route(agent_info, default_model=llm_model_name) if model_routing else {"model": llm_model_name, "reason": "routing disabled"}
+            agent_routes[agent_role] = route
+            if level_parallel:
+                # Concurrent agents need their own LLM so callbacks can tell their tasks apart
+                agent_llm = build_crew_llm(route["model"], crew_llm_key, callbacks=[callback_handler.for_task(task_key)], streaming=stream_tokens, cache=llm_cache)
+            elif route["model"] != llm_model_name:
+                agent_llm = build_crew_llm(route["model"], crew_llm_key, callbacks=[callback_handler], streaming=stream_tokens, cache=llm_cache)
+
+            agent = Agent(
+                role=agent_role,
+                goal=f"Fulfill role: {description}, contributing to the overall task: '{task_description}'",
+                backstory=(
+                    f"You are an AI agent named {agent_role}. Your expertise lies in {description}. "
+                    f"You are part of a team working sequentially on the task: '{task_description}'. Focus strictly on your defined role "
+                    f"and ensure your output is clear and directly usable by the next agent or as a final result component."
+                ),
+                verbose=False,
+                allow_delegation=False,
+                llm=agent_llm,
+                max_iter=15
+            )
+            agents.append(agent)
+
+            task = CrewTask(
+                description=(
+                    f"Execute your role as {agent.role}. Your specific focus is: {description}. "
+                    f"Use the context provided (output from the previous agent, if any) to perform your part of the overall goal: '{task_description}'. "
+                    f"Your output must be self-contained and ready for the next step."
+                ),
+                expected_output=(
+                    f"A clear, concise, and well-formatted result from your work on '{description}'. "
+                    f"This output should directly address your assigned part of the task and be suitable for use by subsequent agents or as a final output component."
+                ),
+                agent=agent,
+                async_execution=False
+            )
+            tasks.append(task)
+            level = hierarchy_level(agent_info, default=i + 1)
+            agent_plan.append({'agent': agent, 'task': task, 'level': level, 'task_key': task_key})
+            socketio_instance.emit('log_update', {
+                'type': 'agent_created', 'run_id': run_id,
+                'data': {'agent_name': agent.role, 'task_description': task.description, 'level': level,
+                         'model': route["model"], 'routing_reason': route["reason"]}
+                }, room=run_id)
+
+        except (KeyError, TypeError) as e:
+            error_msg = f"Error processing agent data item {i}: {e}. Agent Info: {agent_info}. Skipping this agent/task."
+            print(f"Warning (Run ID: {run_id}): {error_msg}")
+            socketio_instance.emit('log_update', {'type': 'warning', 'run_id': run_id, 'data': {'message': error_msg}}, room=run_id)
+        except Exception as e:
+             error_msg = f"Unexpected error creating agent/task for {agent_info.get('agent_name', 'Unknown')}: {e}"
+             print(f"Error (Run ID: {run_id}): {error_msg}")
+             traceback.print_exc()
+             socketio_instance.emit('log_update', {'type': 'warning', 'run_id': run_id, 'data': {'message': f"Skipping agent {agent_info.get('agent_name', 'Unknown')} due to error: {e}"}}, room=run_id)
 
     # --- Generate Hierarchy ---
-    socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': 'Generating agent hierarchy...'}}, room=run_id)
-    hierarchy_json_str = create_agent_hierarchy_with_ai(task_description)
+    streamed_agents: Dict[int, Any] = {} # Hierarchy array index -> entry already built while the completion streamed in
+
+    def on_hierarchy_agent(index: int, agent_info: Dict[str, Any]) -> None:
+        streamed_agents[index] = agent_info
+        socketio_instance.emit('log_update', {'type': 'hierarchy_agent', 'run_id': run_id, 'data': {'index': index, 'agent': agent_info}}, room=run_id)
+        build_agent(index, agent_info)
+
+    phase_started = time.perf_counter()
+    similarity_match = None
+    try:
+        if use_hierarchy_cache and HIERARCHY_SIMILARITY_ENABLED:
+            similarity_match = hierarchy_similarity_index.lookup(task_description)
+        if similarity_match is not None and similarity_match["reused"]:
+            # Near-duplicate of a finished task: reuse its hierarchy without calling the LLM
+            socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Reusing the hierarchy of a similar task (similarity {similarity_match["score"]:.2f})...'}}, room=run_id)
+            hierarchy_json_str = similarity_match["hierarchy"]
+            if stream_hierarchy:
+                for index, agent_info in enumerate(json.loads(hierarchy_json_str)):
+                    on_hierarchy_agent(index, agent_info)
+        else:
+            socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Generating agent hierarchy{" (streaming)" if stream_hierarchy else ""}...'}}, room=run_id)
+            if stream_hierarchy:
+                hierarchy_json_str = stream_agent_hierarchy(task_description, on_hierarchy_agent, use_cache=use_hierarchy_cache,
+                                                            on_rate_limit_wait=callback_handler.record_rate_limit_wait)
+            else:
+                hierarchy_json_str = (generate_hierarchy or create_agent_hierarchy_with_ai)(task_description, use_cache=use_hierarchy_cache,
+                                                                                            on_rate_limit_wait=callback_handler.record_rate_limit_wait)
+    except Exception as e:
+        # Reported like any other hierarchy error below, so the run still stores a result and emits run_complete
+        print(f"Error (Run ID: {run_id}): Hierarchy generation raised: {e}")
+        traceback.print_exc()
+        hierarchy_json_str = json.dumps({"error": f"An unexpected error occurred: {e}"})
+    hierarchy_similarity = {key: similarity_match[key] for key in ("score", "matched_task", "reused")} if similarity_match else None
+    record_phase("hierarchy_generation", phase_started)
     print(hierarchy_json_str)
     hierarchy_data = None
     final_result_raw = None
@@ -477,7 +3722,7 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
              error_occurred = error_msg
              hierarchy_data = None
         else:
-             socketio_instance.emit('log_update', {'type': 'hierarchy_generated', 'run_id': run_id, 'data': {'hierarchy': hierarchy_data}}, room=run_id)
+             socketio_instance.emit('log_update', {'type': 'hierarchy_generated', 'run_id': run_id, 'data': {'hierarchy': hierarchy_data, 'similarity': hierarchy_similarity}}, room=run_id)
 
     except json.JSONDecodeError as e:
         error_msg = f"Error decoding JSON hierarchy: {e}. Received: {hierarchy_json_str}"
@@ -492,25 +3737,17 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
     if error_occurred:
         print(f"Error (Run ID: {run_id}): Halting run due to hierarchy error: {error_occurred}")
         socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_occurred, 'raw_hierarchy_response': hierarchy_json_str if isinstance(hierarchy_json_str, str) else None}}, room=run_id)
-        result_data = {
-            "run_id": run_id, 
-            "task_description": task_description, 
-            "agent_hierarchy": None,
-            "final_output": None, 
-            "task_flow": callback_handler.get_task_io_log(),
-            "usage_metrics": None, 
-            "agent_token_usage": callback_handler.get_agent_token_usage(),
-            "error": error_occurred
-        }
-        with storage_lock: crew_results_storage[run_id] = result_data
+        result_data = build_result_data(error=error_occurred, hierarchy_similarity=hierarchy_similarity)
+        save_run_result(run_id, result_data)
         socketio_instance.emit('run_complete', {'run_id': run_id, 'status': 'error', 'error': error_occurred, 'final_result': result_data}, room=run_id)
         return
 
     # --- Create Agents and Tasks ---
-    agents: List[Agent] = []
-    tasks: List[CrewTask] = []
+    phase_started = time.perf_counter()
     if hierarchy_data:
-        socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Creating {len(hierarchy_data)} agents and tasks...'}}, room=run_id)
+        remaining = sum(1 for i in range(len(hierarchy_data)) if i not in streamed_agents)
+        if remaining > 0:
+            socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Creating {remaining} agents and tasks...'}}, room=run_id)
 
         # if llm_with_callbacks:
         #      print(f"[Crew Run {run_id}] DEBUG: LLM instance (before Agent loop) ID: {id(llm_with_callbacks)}, Callbacks: {llm_with_callbacks.callbacks}")
@@ -518,67 +3755,61 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
         #      print(f"[Crew Run {run_id}] DEBUG: LLM instance (before Agent loop) is None!")
 
         for i, agent_info in enumerate(hierarchy_data):
-            try:
-                if not isinstance(agent_info, dict):
-                     raise TypeError(f"Agent data item {i} is not a dictionary: {agent_info}")
-                agent_name = agent_info.get('agent_name')
-                description = agent_info.get('description')
-                if not agent_name or not isinstance(agent_name, str):
-                    raise KeyError(f"Missing or invalid 'agent_name' in agent data item {i}: {agent_info}")
-                if not description or not isinstance(description, str):
-                     raise KeyError(f"Missing or invalid 'description' in agent data item {i}: {agent_info}")
-
-                agent_role = agent_name.replace('_', ' ')
-                # print(f"[Crew Run {run_id}] DEBUG: Assigning LLM instance ID {id(llm_with_callbacks)} to Agent '{agent_role}'")
-
-                agent = Agent(
-                    role=agent_role,
-                    goal=f"Fulfill role: {description}, contributing to the overall task: '{task_description}'",
-                    backstory=(
-                        f"You are an AI agent named {agent_role}. Your expertise lies in {description}. "
-                        f"You are part of a team working sequentially on the task: '{task_description}'. Focus strictly on your defined role "
-                        f"and ensure your output is clear and directly usable by the next agent or as a final result component."
-                    ),
-                    verbose=False,
-                    allow_delegation=False,
-                    llm=llm_with_callbacks,
-                    max_iter=15
-                )
-                agents.append(agent)
-
-                task = CrewTask(
-                    description=(
-                        f"Execute your role as {agent.role}. Your specific focus is: {description}. "
-                        f"Use the context provided (output from the previous agent, if any) to perform your part of the overall goal: '{task_description}'. "
-                        f"Your output must be self-contained and ready for the next step."
-                    ),
-                    expected_output=(
-                        f"A clear, concise, and well-formatted result from your work on '{description}'. "
-                        f"This output should directly address your assigned part of the task and be suitable for use by subsequent agents or as a final output component."
-                    ),
-                    agent=agent,
-                    async_execution=False
-                )
-                tasks.append(task)
-                socketio_instance.emit('log_update', {
-                    'type': 'agent_created', 'run_id': run_id,
-                    'data': {'agent_name': agent.role, 'task_description': task.description}
-                    }, room=run_id)
-
-            except (KeyError, TypeError) as e:
-                error_msg = f"Error processing agent data item {i}: {e}. Agent Info: {agent_info}. Skipping this agent/task."
-                print(f"Warning (Run ID: {run_id}): {error_msg}")
-                socketio_instance.emit('log_update', {'type': 'warning', 'run_id': run_id, 'data': {'message': error_msg}}, room=run_id)
-            except Exception as e:
-                 error_msg = f"Unexpected error creating agent/task for {agent_info.get('agent_name', 'Unknown')}: {e}"
-                 print(f"Error (Run ID: {run_id}): {error_msg}")
-                 traceback.print_exc()
-                 socketio_instance.emit('log_update', {'type': 'warning', 'run_id': run_id, 'data': {'message': f"Skipping agent {agent_info.get('agent_name', 'Unknown')} due to error: {e}"}}, room=run_id)
+            if i not in streamed_agents: build_agent(i, agent_info)
+
+        if level_parallel:
+            # Each task receives the outputs of every task on the previous level as context
+            tasks_by_level: Dict[int, List[CrewTask]] = {}
+            for entry in agent_plan:
+                tasks_by_level.setdefault(entry['level'], []).append(entry['task'])
+            ordered_levels = sorted(tasks_by_level)
+            for previous_level, level in zip(ordered_levels, ordered_levels[1:]):
+                for task in tasks_by_level[level]:
+                    task.context = list(tasks_by_level[previous_level])
+    record_phase("agent_construction", phase_started)
 
     # --- Run Crew ---
-    if agents and tasks:
+    phase_started = time.perf_counter()
+    if agents and tasks and level_parallel:
+        level_count = len({entry['level'] for entry in agent_plan})
+        socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Running {len(tasks)} tasks across {level_count} hierarchy levels (level-parallel)...'}}, room=run_id)
+        try:
+            final_result_raw, usage_metrics = execute_hierarchy_levels(agent_plan, callback_handler, run_id, socketio_instance, compactor=compactor)
+            socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': 'Crew execution finished.'}}, room=run_id)
+        except Exception as e:
+            error_msg = f"Error During Crew Execution: {e}"
+            print(f"\n--- Error (Run ID: {run_id}): {error_msg} ---")
+            error_occurred = error_msg
+            final_result_raw = None
+            socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_msg}}, room=run_id)
+
+    elif agents and tasks:
         socketio_instance.emit('log_update', {'type': 'status', 'run_id': run_id, 'data': {'message': f'Assembling and kicking off the crew with {len(agents)} agents and {len(tasks)} tasks...'}}, room=run_id)
         try:
+            # Task hand-offs: CrewAI gives each task the previous task's raw output as context, so the
+            # finished task's callback ends it, compacts its output in place and starts the next task
+            def make_handoff(position: int):
+                def handoff(output: Any) -> None:
+                    entry = agent_plan[position]
+                    text = task_output_text(output)
+                    callback_handler.on_task_end(entry['task'], text, task_key=entry['task_key'])
+                    if position + 1 >= len(agent_plan): return # The last output is the final result: never compacted
+                    compacted, record = text, None
+                    try:
+                        compacted, record = compactor.compact(text)
+                        if record and not set_task_output_text(output, compacted):
+                            compacted, record = text, None
+                    except Exception as compaction_err:
+                        print(f"Warning (Run ID: {run_id}): Context compaction failed, handing on the full output: {compaction_err}")
+                    if record: emit_context_compacted(socketio_instance, run_id, entry['agent'].role, record)
+                    next_entry = agent_plan[position + 1]
+                    callback_handler.on_task_start(next_entry['task'], task_key=next_entry['task_key'], context_text=compacted, context_compaction=record)
+                return handoff
+
+            for position, entry in enumerate(agent_plan):
+                entry['task'].callback = make_handoff(position)
+            callback_handler.on_task_start(agent_plan[0]['task'], task_key=agent_plan[0]['task_key'])
+
             # print(f"[Crew Run {run_id}] DEBUG: Creating Crew object with {len(agents)} agents, {len(tasks)} tasks.")
             crew = Crew(
                 agents=agents,
@@ -634,10 +3865,21 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
         error_occurred = "Crew could not run: No valid agents or tasks were created from the hierarchy."
         print(f"Error (Run ID: {run_id}): {error_occurred}")
         socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_occurred}}, room=run_id)
+    if agents and tasks:
+        record_phase("crew_execution", phase_started)
 
     # --- Final Processing & Storage ---
     agent_usage_data = callback_handler.get_agent_token_usage()
-    task_flow_log = callback_handler.get_task_io_log()
+
+    # Model routing decisions and the latency each agent actually saw from its model
+    agent_latency = callback_handler.agent_latency_report()
+    for agent_name, route in agent_routes.items():
+        usage_details = agent_usage_data.setdefault(agent_name, {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+        latency = agent_latency.get(agent_name, {})
+        usage_details['model'] = route["model"]
+        usage_details['routing_reason'] = route["reason"]
+        usage_details['llm_calls'] = latency.get("llm_calls", 0)
+        usage_details['avg_llm_latency_seconds'] = latency.get("avg_llm_latency_seconds")
 
     # --- >>> ADD RANDOM RATES AND COSTS <<< ---
     # Iterate through the collected agent usage and add pricing info
@@ -659,16 +3901,9 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
     # --- >>> END ADD RANDOM RATES AND COSTS <<< ---
 
     # Prepare the final result structure
-    result_data = {
-        "run_id": run_id,
-        "task_description": task_description,
-        "agent_hierarchy": hierarchy_data,
-        "final_output": final_result_raw,
-        "task_flow": task_flow_log,
-        "usage_metrics": None, # Placeholder for total crew metrics
-        "agent_token_usage": agent_usage_data, # <<< NOW INCLUDES rates/costs >>>
-        "error": error_occurred,
-    }
+    result_data = build_result_data(error=error_occurred, hierarchy=hierarchy_data, final_output=final_result_raw,
+                                    agent_token_usage=agent_usage_data, # <<< NOW INCLUDES rates/costs >>>
+                                    hierarchy_similarity=hierarchy_similarity)
 
     # Safely process total usage_metrics
     processed_total_metrics = None
@@ -701,10 +3936,13 @@ def run_crew_background(task_description: str, run_id: str, socketio_instance: S
     # Log Final Summary (will use the modified log_final_summary below)
     log_final_summary(run_id, result_data)
 
+    if not error_occurred and final_result_raw is not None and HIERARCHY_SIMILARITY_ENABLED:
+        # Only hierarchies that carried a run to completion are offered to later near-duplicate tasks
+        hierarchy_similarity_index.add(task_description, json.dumps(hierarchy_data))
+
     # Store results in memory
-    with storage_lock:
-        crew_results_storage[run_id] = result_data
-        print(f"--- Results stored under key (run_id): {run_id} ---")
+    save_run_result(run_id, result_data)
+    print(f"--- Results stored under key (run_id): {run_id} ---")
 
     # Emit Final Status via WebSocket
     final_status = 'error' if error_occurred else 'success'
@@ -736,13 +3974,19 @@ def log_final_summary(run_id, result_data):
     print(f"\n--- Total Usage Metrics (from crew) ---")
     print(result_data.get('usage_metrics', 'N/A'))
 
+    phase_timings = result_data.get('phase_timings') or {}
+    if phase_timings:
+        print(f"\n--- Phase Timings (seconds) ---")
+        for phase, value in phase_timings.items():
+            print(f"{phase:<22} {value}")
+
     # Print Agent Cumulative Usage Breakdown (with pricing)
     agent_token_usage = result_data.get('agent_token_usage', {})
     if agent_token_usage:
         print("\n--- Agent Cumulative Token Usage & Estimated Cost (from callbacks) ---")
         # Adjusted header width
         print("-" * 105)
-        print(f"{'AGENT NAME':<30} {'PROMPT':<10} {'COMPLETION':<15} {'TOTAL':<10} {'RATE (USD/M)':<15} {'EST. COST (USD)':<15}")
+        print(f"{'AGENT NAME':<30} {'PROMPT':<10} {'COMPLETION':<15} {'TOTAL':<10} {'RATE (USD/M)':<15} {'EST. COST (USD)':<15} {'MODEL'}")
         print("-" * 105)
         total_agent_prompt = 0
         total_agent_completion = 0
@@ -765,7 +4009,7 @@ def log_final_summary(run_id, result_data):
             rate_str = f"${rate:.2f}" if isinstance(rate, (int, float)) else "N/A"
             cost_str = f"${cost:.6f}" if isinstance(cost, (int, float)) else "N/A"
 
-            print(f"{agent_name:<30} {prompt_tokens:<10} {completion_tokens:<15} {total_tokens:<10} {rate_str:<15} {cost_str:<15}")
+            print(f"{agent_name:<30} {prompt_tokens:<10} {completion_tokens:<15} {total_tokens:<10} {rate_str:<15} {cost_str:<15} {usage.get('model', '')}")
         print("-" * 105)
         print(f"{'TOTAL (Agents)':<30} {total_agent_prompt:<10} {total_agent_completion:<15} {total_agent_overall:<10} {'':<15} ${total_estimated_cost:.6f}{'':<9}") # Adjusted spacing
     else:
@@ -775,9 +4019,9 @@ def log_final_summary(run_id, result_data):
     task_flow = result_data.get('task_flow', [])
     if task_flow:
         print("\n--- Task Token Usage (from callbacks) ---")
-        print("-" * 90)
-        print(f"{'TASK DESCRIPTION':<40} {'AGENT':<20} {'PROMPT':<10} {'COMPLETION':<15} {'TOTAL':<10}")
-        print("-" * 90)
+        print("-" * 102)
+        print(f"{'TASK DESCRIPTION':<40} {'AGENT':<20} {'PROMPT':<10} {'COMPLETION':<15} {'TOTAL':<10} {'CTX SAVED':<10}")
+        print("-" * 102)
         total_task_prompt = 0
         total_task_completion = 0
         total_task_overall = 0
@@ -791,8 +4035,9 @@ def log_final_summary(run_id, result_data):
             total_task_prompt += prompt_tokens
             total_task_completion += completion_tokens
             total_task_overall += total_tokens
-            print(f"{desc:<40} {agent:<20} {prompt_tokens:<10} {completion_tokens:<15} {total_tokens:<10}")
-        print("-" * 90)
+            prompt_tokens_saved = task_item.get('prompt_tokens_saved') or 0
+            print(f"{desc:<40} {agent:<20} {prompt_tokens:<10} {completion_tokens:<15} {total_tokens:<10} {prompt_tokens_saved:<10}")
+        print("-" * 102)
         print(f"{'TOTAL (Tasks)':<61} {total_task_prompt:<10} {total_task_completion:<15} {total_task_overall:<10}")
     else:
          print("\n--- Task Token Usage (from callbacks): Not Available ---")
@@ -800,6 +4045,465 @@ def log_final_summary(run_id, result_data):
     print(f"{'=' * 40}\n")
 
 
+# --- Shared Run State (Multi-Worker Mode) ---
+run_registry = RunRegistry(registry_redis, WORKER_ID, RUN_REGISTRY_TTL_SECONDS, RUN_REGISTRY_FLIGHT_TTL_SECONDS) if registry_redis is not None else None
+
+
+# --- Run Scheduler (Admission Control) ---
+class RunQueueFull(Exception):
+    """Raised when a run cannot be admitted because the wait queue is full."""
+
+class RunScheduler:
+    """
+    Caps the number of crews executing at once and keeps a bounded FIFO queue
+    of runs waiting for a slot. Queued runs are told their position over the
+    run's `log_update` room channel whenever the queue moves. Limits apply per
+    worker; with a `registry`, run states are published for the other workers.
+    """
+    def __init__(self, socketio_instance: SocketIO, max_concurrent: int = 4, max_queue: int = 32, registry: Optional[RunRegistry] = None):
+        self.socketio = socketio_instance
+        self.registry = registry
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self._lock = threading.Lock()
+        self._queue: deque = deque() # Pending jobs: dicts with run_id, target, kwargs, enqueued_at
+        self._running: Dict[str, float] = {} # run_id -> started_at
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+
+    def submit(self, run_id: str, target, **kwargs: Any) -> int:
+        """
+        Starts the run right away if a slot is free, otherwise queues it.
+        Returns the queue position (0 = started immediately).
+        Raises RunQueueFull if the queue is at capacity.
+        """
+        job = {"run_id": run_id, "target": target, "kwargs": kwargs, "enqueued_at": time.monotonic()}
+        with self._lock:
+            if len(self._running) < self.max_concurrent and not self._queue:
+                self._running[run_id] = time.monotonic()
+                self.admitted += 1
+                start_now = True
+            elif len(self._queue) < self.max_queue:
+                self._queue.append(job)
+                self.admitted += 1
+                start_now = False
+                position = len(self._queue)
+            else:
+                self.rejected += 1
+                raise RunQueueFull(f"Run queue is full ({self.max_queue} waiting, {len(self._running)} running).")
+
+        if start_now:
+            if self.registry is not None: self.registry.set_run_state(run_id, 'running', queue_position=0)
+            self._start(job, queue_wait_seconds=0.0)
+            return 0
+
+        print(f"--- Run {run_id} queued at position {position} ---")
+        self._emit_position(run_id, 'queued', position, f'Run queued at position {position}. Waiting for a free slot...')
+        return position
+
+    def _emit_position(self, run_id: str, event_type: str, position: int, message: str) -> None:
+        if self.registry is not None:
+            self.registry.set_run_state(run_id, 'queued' if position else 'running', queue_position=position)
+        with self._lock:
+            running = len(self._running)
+        try:
+            self.socketio.emit('log_update', {
+                'type': event_type, 'run_id': run_id,
+                'data': {'message': message, 'queue_position': position, 'running': running, 'max_concurrent': self.max_concurrent}
+            }, room=run_id)
+        except Exception as e:
+            print(f"Warning (Run ID: {run_id}): Failed to emit '{event_type}' event: {e}")
+
+    def _start(self, job: Dict[str, Any], queue_wait_seconds: float) -> None:
+        try:
+            self.socketio.start_background_task(self._run_job, job, queue_wait_seconds)
+        except Exception:
+            # Release the slot so a failed start cannot wedge the scheduler
+            self._finish(job["run_id"])
+            raise
+
+    def _run_job(self, job: Dict[str, Any], queue_wait_seconds: float) -> None:
+        try:
+            job["target"](run_id=job["run_id"], queue_wait_seconds=queue_wait_seconds, **job["kwargs"])
+        except Exception as e:
+            print(f"Error (Run ID: {job['run_id']}): Unhandled exception in scheduled run: {e}")
+            traceback.print_exc()
+        finally:
+            self._finish(job["run_id"])
+
+    def _finish(self, run_id: str) -> None:
+        next_jobs = []
+        with self._lock:
+            self._running.pop(run_id, None)
+            self.completed += 1
+            while self._queue and len(self._running) < self.max_concurrent:
+                job = self._queue.popleft()
+                wait = time.monotonic() - job["enqueued_at"]
+                self.total_queue_wait_seconds += wait
+                self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, wait)
+                self._running[job["run_id"]] = time.monotonic()
+                next_jobs.append((job, wait))
+            waiting = [job["run_id"] for job in self._queue]
+
+        if self.registry is not None:
+            self.registry.set_run_state(run_id, 'finished')
+        for job, wait in next_jobs:
+            print(f"--- Run {job['run_id']} dequeued after waiting {wait:.2f}s ---")
+            self._emit_position(job["run_id"], 'queue_position', 0, f'Run slot acquired after waiting {wait:.2f}s. Starting...')
+            try:
+                self._start(job, queue_wait_seconds=round(wait, 4))
+            except Exception as e:
+                print(f"CRITICAL: Failed to start queued run {job['run_id']}: {e}")
+                traceback.print_exc()
+        if next_jobs:
+            for waiting_run_id in waiting:
+                # Re-read the position: a concurrent _finish may have moved the queue since the snapshot
+                position = self.queue_position(waiting_run_id)
+                if position:
+                    self._emit_position(waiting_run_id, 'queue_position', position, f'Queue position is now {position}.')
+
+    def queue_position(self, run_id: str) -> Optional[int]:
+        """Returns 0 if running, the 1-based queue position if waiting, else None."""
+        with self._lock:
+            if run_id in self._running: return 0
+            for index, job in enumerate(self._queue, start=1):
+                if job["run_id"] == run_id: return index
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self.admitted - len(self._queue)
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "running": len(self._running),
+                "queued": len(self._queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "avg_queue_wait_seconds": round(self.total_queue_wait_seconds / started, 4) if started > 0 else 0.0,
+                "max_queue_wait_seconds": round(self.max_queue_wait_seconds, 4),
+            }
+
+run_scheduler = RunScheduler(socketio, max_concurrent=RUN_MAX_CONCURRENT, max_queue=RUN_MAX_QUEUE, registry=run_registry)
+
+
+# --- Single-Flight Run Coalescing ---
+class SingleFlightRegistry:
+    """
+    Tracks in-flight runs by a key of their sanitized task description and run
+    options. A submission whose key is already in flight is handed the existing
+    run_id instead of starting a new crew, so every caller follows the same room
+    and receives the same `run_complete` payload. Keys are released when the run's
+    scheduler target returns (the result is stored by then, so late joiners still
+    get it through join_room). With a `registry`, keys are claimed across all workers.
+    """
+    def __init__(self, socketio_instance: SocketIO, registry: Optional[RunRegistry] = None):
+        self.socketio = socketio_instance
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._runs_by_key: Dict[tuple, str] = {}
+        self._keys_by_run: Dict[str, tuple] = {}
+        self._waiters: Dict[str, int] = {} # run_id -> submissions coalesced into it
+        self.coalesced = 0
+
+    @staticmethod
+    def flight_key(task_description: str, **run_options: Any) -> tuple:
+        return (task_description,) + tuple(sorted(run_options.items()))
+
+    def claim(self, key: tuple, run_id: str) -> Optional[str]:
+        """
+        Registers `run_id` as the run for `key` and returns None, or returns the
+        run_id already in flight for `key` (the caller must not start a run).
+        """
+        with self._lock:
+            existing = self._runs_by_key.get(key)
+            if existing is None and self.registry is not None:
+                existing = self.registry.claim_flight(key, run_id) # In flight on another worker
+            if existing is None:
+                self._runs_by_key[key] = run_id
+                self._keys_by_run[run_id] = key
+                return None
+            self._waiters[existing] = self._waiters.get(existing, 0) + 1
+            self.coalesced += 1
+            waiters = self._waiters[existing]
+        try:
+            self.socketio.emit('log_update', {
+                'type': 'coalesced', 'run_id': existing,
+                'data': {'message': f'An identical submission attached to this run ({waiters} attached so far).', 'attached_submissions': waiters}
+            }, room=existing)
+        except Exception as e:
+            print(f"Warning (Run ID: {existing}): Failed to emit 'coalesced' event: {e}")
+        return existing
+
+    def release(self, run_id: str) -> None:
+        with self._lock:
+            key = self._keys_by_run.pop(run_id, None)
+            if key is not None and self._runs_by_key.get(key) == run_id:
+                del self._runs_by_key[key]
+            self._waiters.pop(run_id, None)
+        if key is not None and self.registry is not None:
+            self.registry.release_flight(key, run_id)
+
+    def wrap(self, run_id: str, target):
+        """Returns a scheduler target that releases `run_id`'s key once `target` returns."""
+        def run_and_release(**kwargs: Any) -> None:
+            try:
+                target(**kwargs)
+            finally:
+                self.release(run_id)
+        return run_and_release
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default_enabled": SINGLE_FLIGHT_DEFAULT,
+                "in_flight": len(self._runs_by_key),
+                "attached_waiters": sum(self._waiters.values()),
+                "coalesced": self.coalesced,
+            }
+
+single_flight = SingleFlightRegistry(socketio, registry=run_registry)
+
+def lookup_queue_position(run_id: str) -> Optional[int]:
+    """Queue position of a run on this worker or, in multi-worker mode, on the worker executing it."""
+    position = run_scheduler.queue_position(run_id)
+    if position is None and run_registry is not None:
+        position = run_registry.queue_position(run_id)
+    return position
+
+
+# --- Out-of-Process Crew Executor ---
+# Worker-process globals, set by _init_crew_worker
+_worker_event_queue = None
+
+class IpcEventEmitter:
+    """
+    Stand-in for the SocketIO instance inside crew worker processes.
+    Every emit is pushed onto the IPC queue and re-emitted by the web process.
+    """
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
+
+    def emit(self, event: str, data: Any = None, room: Optional[str] = None, **kwargs: Any) -> None:
+        self.event_queue.put(("emit", event, data, room))
+
+def in_crew_worker_process() -> bool:
+    return _worker_event_queue is not None
+
+def _forward_result(run_id: str, result_data: Dict[str, Any]) -> None:
+    _worker_event_queue.put(("result", run_id, result_data))
+
+def _init_crew_worker(event_queue) -> None:
+    """ProcessPoolExecutor initializer: route emits and result storage over the IPC queue."""
+    global _worker_event_queue, _result_sink
+    _worker_event_queue = event_queue
+    _result_sink = _forward_result
+    # Local buckets are per process: split this server worker's share of the limits across the pool
+    rate_limiter.scale(rate_limiter.scale_factor / max(1, CREW_PROCESS_WORKERS))
+
+def _crew_worker_entry(run_id: str, task_description: str, queue_wait_seconds: float, run_options: Dict[str, Any]) -> None:
+    """Executed in a pool worker process. `run_options` are the per-run keyword arguments of run_crew_background."""
+    try:
+        run_crew_background(
+            task_description=task_description,
+            run_id=run_id,
+            socketio_instance=IpcEventEmitter(_worker_event_queue),
+            queue_wait_seconds=queue_wait_seconds,
+            **run_options,
+        )
+    finally:
+        # Queued after every emit and result of the run, so the parent knows the relay has caught up.
+        # Carries this worker's cache stats, which the parent's own caches cannot see.
+        worker_stats = {"hierarchy_cache": hierarchy_cache.stats(), "hierarchy_similarity": hierarchy_similarity_index.stats()}
+        _worker_event_queue.put(("done", run_id, os.getpid(), worker_stats))
+
+class CrewProcessPool:
+    """
+    Runs `run_crew_background` in a pool of worker processes so CrewAI/LangChain
+    work cannot stall the eventlet hub. Worker emits and final results come back
+    over a multiprocessing queue that a relay task drains and re-emits to rooms.
+    Caches used while building crews (hierarchy cache, similarity index) live in
+    the workers; their latest stats per worker are relayed and shown in stats().
+    """
+    def __init__(self, socketio_instance: SocketIO, max_workers: int):
+        self.socketio = socketio_instance
+        self.max_workers = max(1, max_workers)
+        self._lock = threading.Lock() # Also guards the run sets and worker stats, which the relay task writes
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._event_queue = None
+        self._awaited_runs: set = set() # Runs whose "done" marker run_crew is still waiting for
+        self._relayed_runs: set = set() # Awaited runs whose "done" marker has been relayed
+        self._worker_stats: Dict[int, Dict[str, Any]] = {} # pid -> latest cache stats reported by that worker
+        self.events_relayed = 0
+        self.results_received = 0
+        self.worker_failures = 0
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._executor is not None: return
+            # spawn: forking an eventlet-patched process with live sockets is unsafe
+            mp_context = multiprocessing.get_context("spawn")
+            self._event_queue = mp_context.Queue()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=mp_context,
+                initializer=_init_crew_worker,
+                initargs=(self._event_queue,),
+            )
+            self.socketio.start_background_task(self._relay_events)
+            print(f"--- Crew process pool started with {self.max_workers} workers ---")
+
+    def _relay_events(self) -> None:
+        """Drains the IPC queue without blocking the hub and re-emits events in this process."""
+        while True:
+            drained = 0
+            while True:
+                try:
+                    message = self._event_queue.get_nowait()
+                except queue_module.Empty:
+                    break
+                drained += 1
+                try:
+                    self._handle_message(message)
+                except Exception as e:
+                    print(f"Error relaying crew worker message: {e}")
+                    traceback.print_exc()
+            if not drained:
+                self.socketio.sleep(CREW_EVENT_RELAY_INTERVAL)
+            else:
+                self.socketio.sleep(0) # Yield between batches so HTTP handlers keep running
+
+    def _handle_message(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "emit":
+            _, event, data, room = message
+            if room is not None and isinstance(data, dict) and 'seq' in data:
+                # Record in this process's event log so join_room can replay worker events
+                with run_event_log.lock_for(room):
+                    run_event_log.record(room, event, data)
+                    self.socketio.emit(event, data, room=room)
+                metrics.inc("crew_socketio_emits_total", event=event, type=data.get('type', ''))
+            elif room is not None and event == 'log_batch' and isinstance(data, dict):
+                # Batched log_updates were sequenced one by one in the worker: record each for replay
+                batched = [item for item in data.get('events') or [] if isinstance(item, dict) and 'seq' in item]
+                with run_event_log.lock_for(room):
+                    run_event_log.record_many(room, [('log_update', item) for item in batched])
+                    self.socketio.emit(event, data, room=room)
+                for item in batched:
+                    metrics.inc("crew_socketio_emits_total", event='log_update', type=item.get('type', ''))
+            else:
+                self.socketio.emit(event, data, room=room)
+            self.events_relayed += 1
+        elif kind == "metric":
+            _, metric_kind, name, value, labels = message
+            record_metric(metric_kind, name, value, **labels)
+        elif kind == "result":
+            _, run_id, result_data = message
+            save_run_result(run_id, result_data)
+            self.results_received += 1
+        elif kind == "done":
+            _, run_id, pid, worker_stats = message
+            with self._lock:
+                self._worker_stats[pid] = worker_stats
+                if run_id in self._awaited_runs: # A marker arriving after the wait timed out is dropped
+                    self._relayed_runs.add(run_id)
+
+    def _wait_for_relay(self, run_id: str, socketio_instance: SocketIO) -> None:
+        """Waits (green) until the run's "done" marker has been relayed, i.e. its result is stored if it sent one."""
+        deadline = time.monotonic() + CREW_RELAY_DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            with self._lock:
+                if run_id in self._relayed_runs: break
+            socketio_instance.sleep(CREW_EVENT_RELAY_INTERVAL)
+        with self._lock:
+            self._awaited_runs.discard(run_id)
+            self._relayed_runs.discard(run_id)
+
+    def run_crew(self, run_id: str, task_description: str, socketio_instance: SocketIO, queue_wait_seconds: float = 0.0, **run_options: Any) -> None:
+        """Scheduler target: submits the run to a worker process and waits (green) until it finishes."""
+        self._ensure_started()
+        with self._lock:
+            self._awaited_runs.add(run_id)
+        future = self._executor.submit(_crew_worker_entry, run_id, task_description, queue_wait_seconds, run_options)
+        while not future.done():
+            socketio_instance.sleep(CREW_EVENT_RELAY_INTERVAL)
+        # The result may still be in the IPC queue when the future resolves
+        self._wait_for_relay(run_id, socketio_instance)
+        try:
+            future.result()
+        except Exception as e:
+            # The worker died or raised before storing a result: record the failure here
+            self.worker_failures += 1
+            error_occurred = f"Crew worker process failed: {e}"
+            print(f"Error (Run ID: {run_id}): {error_occurred}")
+            if not result_store.contains(run_id):
+                metrics.inc("crew_runs_total", status="error", execution_mode=run_options.get('execution_mode', CREW_EXECUTION_MODE_DEFAULT))
+                result_data = {
+                    "run_id": run_id,
+                    "task_description": task_description,
+                    "agent_hierarchy": None,
+                    "final_output": None,
+                    "task_flow": [],
+                    "usage_metrics": None,
+                    "agent_token_usage": {},
+                    "queue_wait_seconds": queue_wait_seconds,
+                    "error": error_occurred
+                }
+                save_run_result(run_id, result_data)
+                socketio_instance.emit('log_update', {'type': 'error', 'run_id': run_id, 'data': {'message': error_occurred}}, room=run_id)
+                socketio_instance.emit('run_complete', {'run_id': run_id, 'status': 'error', 'error': error_occurred, 'final_result': result_data}, room=run_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            worker_caches = {str(pid): worker_stats for pid, worker_stats in self._worker_stats.items()}
+        return {
+            "mode": CREW_EXECUTOR_MODE,
+            "max_workers": self.max_workers,
+            "started": self._executor is not None,
+            "events_relayed": self.events_relayed,
+            "results_received": self.results_received,
+            "worker_failures": self.worker_failures,
+            "worker_caches": worker_caches,
+        }
+
+crew_process_pool = CrewProcessPool(socketio, CREW_PROCESS_WORKERS) if CREW_EXECUTOR_MODE == "process" else None
+
+def crew_run_target():
+    """Returns the callable the scheduler should run for each crew, based on CREW_EXECUTOR_MODE."""
+    return crew_process_pool.run_crew if crew_process_pool is not None else run_crew_background
+
+
+@metrics.collector
+def collect_runtime_gauges() -> List[tuple]:
+    """Point-in-time gauges for /metrics, read from the scheduler, caches and stores."""
+    scheduler_stats = run_scheduler.stats()
+    cache_stats = hierarchy_cache.stats()
+    similarity_stats = hierarchy_similarity_index.stats()
+    request_stats = hierarchy_requests.stats()
+    return [
+        ("crew_runs_in_flight", "gauge", "Crew runs currently executing.", [({}, scheduler_stats["running"])]),
+        ("crew_runs_queued", "gauge", "Crew runs waiting for an execution slot.", [({}, scheduler_stats["queued"])]),
+        ("crew_runs_rejected_total", "counter", "Runs rejected because the wait queue was full.", [({}, scheduler_stats["rejected"])]),
+        ("crew_hierarchy_cache_requests_total", "counter", "Hierarchy cache lookups by result.",
+         [({"result": "hit"}, cache_stats.get("hits", 0)), ({"result": "miss"}, cache_stats.get("misses", 0))]),
+        ("crew_hierarchy_similarity_requests_total", "counter", "Hierarchy similarity index lookups in this process by result.",
+         [({"result": "reused"}, similarity_stats["hits"]), ({"result": "miss"}, similarity_stats["lookups"] - similarity_stats["hits"])]),
+        ("crew_completion_cache_requests_total", "counter", "Completion cache lookups in this process by result.",
+         [({"result": "memory_hit"}, completion_cache.memory_hits), ({"result": "disk_hit"}, completion_cache.disk_hits),
+          ({"result": "miss"}, completion_cache.misses)]),
+        ("crew_hierarchy_hedges_total", "counter", "Hedged duplicate hierarchy requests in this process by outcome.",
+         [({"result": "won"}, request_stats["hedge_wins"]), ({"result": "lost"}, request_stats["hedges_sent"] - request_stats["hedge_wins"])]),
+        ("crew_hierarchy_retries_total", "counter", "Hierarchy request retries after transient failures in this process.", [({}, request_stats["retries"])]),
+        ("crew_hierarchy_breaker_open", "gauge", "1 while the hierarchy circuit breaker is open or half-open in this process.",
+         [({}, 0 if request_stats["breaker"]["state"] == "closed" else 1)]),
+        ("crew_result_store_runs", "gauge", "Run results held by the result store.", [({}, result_store.count())]),
+    ]
+
+
 # --- API Endpoints (Keep As Is) ---
 
 @app.route('/', methods=['GET'])
@@ -807,74 +4511,326 @@ def health_check():
     """Basic health check endpoint."""
     return jsonify({"status": "ok", "message": "CrewAI API server is running"}), 200
 
-@app.route('/run', methods=['POST'])
-def run_crew_endpoint():
+def runtime_stats() -> Dict[str, Any]:
+    """The /stats body (shared by the Flask route and asgi_app)."""
+    return {
+        "server_mode": SERVER_MODE,
+        "hierarchy_cache": hierarchy_cache.stats(),
+        "hierarchy_similarity": hierarchy_similarity_index.stats(),
+        "completion_cache": completion_cache.stats(),
+        "hierarchy_requests": hierarchy_requests.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "model_routing": model_router.stats(),
+        "http_pool": http_clients.stats(),
+        "scheduler": run_scheduler.stats(),
+        "single_flight": single_flight.stats(),
+        "run_registry": run_registry.stats() if run_registry is not None else {"mode": "local", "worker_id": WORKER_ID},
+        "message_queue": bool(SOCKETIO_MESSAGE_QUEUE),
+        "result_store": result_store.stats(),
+        "log_batching": LogBatchingEmitter.stats(),
+        "event_encoding": dict(MsgpackRoomEmitter.stats(), msgpack_enabled=MSGPACK_EVENTS_ENABLED, msgpack_subscribers=msgpack_subscribers.stats()),
+        "run_event_log": run_event_log.stats(),
+        "executor": crew_process_pool.stats() if crew_process_pool is not None else {"mode": CREW_EXECUTOR_MODE},
+    }
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Runtime statistics for server-side caches and pools."""
+    return jsonify(runtime_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint: run phase/task/LLM latency histograms, token and emit counters, runtime gauges."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- Run Submission (shared by the Flask routes and asgi_app) ---
+RUN_ID_PATTERN = re.compile(r'[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}') # uuid4 run ids from submit_run
+
+class RunRequestError(ValueError):
+    """Invalid /run request body; the message is returned to the client with a 400."""
+
+def parse_run_request(data: Any) -> tuple:
     """
-    API endpoint to trigger a crew run asynchronously.
-    Expects JSON: {"task_description": "..."}
-    Returns JSON: {"run_id": "..."}
+    Validates a /run JSON body. Returns (sanitized task_description, run_options, use_single_flight)
+    where run_options are the per-run keyword arguments of run_crew_background.
+    Raises RunRequestError for invalid input.
     """
-    if not request.is_json:
-        return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
+    if not isinstance(data, dict):
+        raise RunRequestError("Request must be JSON")
     task_description = data.get('task_description')
+    use_cache = data.get('use_cache', True)
+    if not isinstance(use_cache, bool):
+        raise RunRequestError("'use_cache' must be a boolean")
+    batch_logs = data.get('batch_logs', LOG_BATCH_DEFAULT)
+    if not isinstance(batch_logs, bool):
+        raise RunRequestError("'batch_logs' must be a boolean")
+    stream_tokens = data.get('stream_tokens', STREAM_TOKENS_DEFAULT)
+    if not isinstance(stream_tokens, bool):
+        raise RunRequestError("'stream_tokens' must be a boolean")
+    execution_mode = data.get('execution_mode', CREW_EXECUTION_MODE_DEFAULT)
+    if execution_mode not in CREW_EXECUTION_MODES:
+        raise RunRequestError(f"'execution_mode' must be one of {list(CREW_EXECUTION_MODES)}")
+    use_completion_cache = data.get('use_completion_cache', COMPLETION_CACHE_DEFAULT)
+    if not isinstance(use_completion_cache, bool):
+        raise RunRequestError("'use_completion_cache' must be a boolean")
+    context_compaction = data.get('context_compaction', CONTEXT_COMPACTION_MODE_DEFAULT)
+    if context_compaction not in CONTEXT_COMPACTION_MODES:
+        raise RunRequestError(f"'context_compaction' must be one of {list(CONTEXT_COMPACTION_MODES)}")
+    model_routing = data.get('model_routing', MODEL_ROUTING_DEFAULT)
+    if not isinstance(model_routing, bool):
+        raise RunRequestError("'model_routing' must be a boolean")
+    stream_hierarchy = data.get('stream_hierarchy', HIERARCHY_STREAMING_DEFAULT)
+    if not isinstance(stream_hierarchy, bool):
+        raise RunRequestError("'stream_hierarchy' must be a boolean")
+    use_single_flight = data.get('single_flight', SINGLE_FLIGHT_DEFAULT)
+    if not isinstance(use_single_flight, bool):
+        raise RunRequestError("'single_flight' must be a boolean")
 
     if not task_description or not isinstance(task_description, str) or not task_description.strip():
-        return jsonify({"error": "Missing or invalid 'task_description'"}), 400
+        raise RunRequestError("Missing or invalid 'task_description'")
 
     task_description = re.sub(r'[^\w\s.,!?-]', '', task_description[:1500]).strip()
 
     if not task_description:
-        return jsonify({"error": "Task description is empty after sanitization"}), 400
+        raise RunRequestError("Task description is empty after sanitization")
+
+    run_options = {
+        "use_hierarchy_cache": use_cache,
+        "batch_logs": batch_logs,
+        "stream_tokens": stream_tokens,
+        "execution_mode": execution_mode,
+        "use_completion_cache": use_completion_cache,
+        "context_compaction": context_compaction,
+        "model_routing": model_routing,
+        "stream_hierarchy": stream_hierarchy,
+    }
+    return task_description, run_options, use_single_flight
 
+def submit_run(task_description: str, run_options: Dict[str, Any], use_single_flight: bool, socketio_instance: Any, **target_kwargs: Any) -> tuple:
+    """
+    Coalesces or schedules a validated run. Returns (response body, HTTP status, extra headers).
+    `target_kwargs` reach run_crew_background without being part of the single-flight key.
+    """
     run_id = str(uuid.uuid4())
 
     print(f"--- Received API request (Run ID: {run_id}) for task: '{task_description}' ---")
+
+    target = crew_run_target()
+    if use_single_flight:
+        existing_run_id = single_flight.claim(SingleFlightRegistry.flight_key(task_description, **run_options), run_id)
+        if existing_run_id is not None:
+            print(f"--- Coalesced request into in-flight run {existing_run_id} ---")
+            return {"run_id": existing_run_id, "queue_position": lookup_queue_position(existing_run_id) or 0, "coalesced": True}, 202, {}
+        target = single_flight.wrap(run_id, target)
+
     print(f"--- Starting background task for run ID: {run_id} ---")
 
     try:
-        socketio.start_background_task(
-            run_crew_background,
+        queue_position = run_scheduler.submit(
+            run_id,
+            target,
             task_description=task_description,
-            run_id=run_id,
-            socketio_instance=socketio
+            socketio_instance=socketio_instance,
+            **run_options,
+            **target_kwargs
         )
+    except RunQueueFull as queue_err:
+        single_flight.release(run_id)
+        print(f"Rejected run {run_id}: {queue_err}")
+        return {"error": "Server is busy, run queue is full. Retry later.", "run_id": run_id}, 429, {'Retry-After': str(RUN_QUEUE_RETRY_AFTER_SECONDS)}
     except Exception as bg_task_err:
+         single_flight.release(run_id)
          print(f"CRITICAL: Failed to start background task for run {run_id}: {bg_task_err}")
          traceback.print_exc()
-         return jsonify({"error": "Failed to initiate background processing", "run_id": run_id}), 500
+         return {"error": "Failed to initiate background processing", "run_id": run_id}, 500, {}
+
+    return {"run_id": run_id, "queue_position": queue_position, "coalesced": False}, 202, {}
+
+def bind_emitter(emitter: Any) -> None:
+    """
+    Points the process-wide scheduler, single-flight registry and crew process pool at
+    another Socket.IO emitter (emit/sleep/start_background_task), e.g. asgi_app's bridge.
+    The emitter is wrapped in a MsgpackRoomEmitter when MessagePack events are enabled.
+    """
+    global socketio
+    if MSGPACK_EVENTS_ENABLED and not isinstance(emitter, MsgpackRoomEmitter):
+        emitter = MsgpackRoomEmitter(emitter)
+    socketio = emitter
+    run_scheduler.socketio = emitter
+    single_flight.socketio = emitter
+    if crew_process_pool is not None:
+        crew_process_pool.socketio = emitter
+
+if MSGPACK_EVENTS_ENABLED:
+    bind_emitter(socketio)
 
-    return jsonify({"run_id": run_id}), 202
+@app.route('/run', methods=['POST'])
+def run_crew_endpoint():
+    """
+    API endpoint to trigger a crew run asynchronously.
+    Expects JSON: {"task_description": "...", "use_cache": true, "batch_logs": false, "stream_tokens": false,
+                   "execution_mode": "sequential", "use_completion_cache": false, "single_flight": false,
+                   "context_compaction": "off", "model_routing": false, "stream_hierarchy": false}
+    (`use_cache` is optional; pass false to force a fresh hierarchy generation.
+     `batch_logs` is optional; when true, log_update events arrive grouped in log_batch frames.
+     `stream_tokens` is optional; when true, agent output arrives incrementally as llm_token events.
+     `execution_mode` is optional; "level_parallel" runs agents on the same hierarchy level concurrently.
+     `use_completion_cache` is optional; when true, repeated agent LLM calls are served from the completion cache.
+     `single_flight` is optional; when true, an identical submission already in flight is joined instead of started.
+     `context_compaction` is optional; "truncate", "extractive" or "summary" keeps task hand-offs under the token budget.
+     `model_routing` is optional; when true, each agent's model is chosen from MODEL_ROUTING_RULES.
+     `stream_hierarchy` is optional; when true, agents arrive one by one as hierarchy_agent events and are built immediately.)
+    Returns JSON: {"run_id": "...", "queue_position": 0, "coalesced": false}
+    (`queue_position` 0 means the run started immediately; 429 if the run queue is full.
+     `coalesced` true means `run_id` is an existing run this submission was attached to.)
+    """
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    try:
+        task_description, run_options, use_single_flight = parse_run_request(request.get_json())
+    except RunRequestError as e:
+        return jsonify({"error": str(e)}), 400
+
+    body, status, headers = submit_run(task_description, run_options, use_single_flight, socketio)
+    response = jsonify(body)
+    response.headers.update(headers)
+    return response, status
 # --- Results Endpoints (Keep As Is) ---
 
+def _parse_time_param(value: str) -> float:
+    """Accepts a unix timestamp or an ISO 8601 datetime and returns a unix timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def query_results_page(args: Any) -> tuple:
+    """
+    One page of stored runs for the /results query params in `args` (any mapping).
+    Returns (response body, HTTP status); shared by the Flask route and asgi_app.
+    Without any of RESULTS_QUERY_PARAMS the original response is kept: every run id, oldest first.
+    """
+    if not any(name in args for name in RESULTS_QUERY_PARAMS):
+        return {"available_run_ids": result_store.list_run_ids()}, 200
+    view = args.get('view', 'ids')
+    if view not in ('ids', 'summary'):
+        return {"error": "'view' must be 'ids' or 'summary'"}, 400
+    status = args.get('status')
+    if status is not None and status not in ('success', 'error'):
+        return {"error": "'status' must be 'success' or 'error'"}, 400
+    try:
+        limit = min(max(int(args.get('limit', RESULTS_PAGE_DEFAULT_LIMIT)), 1), RESULTS_PAGE_MAX_LIMIT)
+        since = _parse_time_param(args['since']) if 'since' in args else None
+        until = _parse_time_param(args['until']) if 'until' in args else None
+        min_cost = float(args['min_cost']) if 'min_cost' in args else None
+        min_tokens = int(args['min_tokens']) if 'min_tokens' in args else None
+        summaries, next_cursor = result_store.query_summaries(
+            limit, cursor=args.get('cursor'), status=status, since=since, until=until,
+            min_cost=min_cost, min_tokens=min_tokens
+        )
+    except ValueError as e:
+        return {"error": f"Invalid query parameter: {e}"}, 400
+
+    response_data: Dict[str, Any] = {
+        "available_run_ids": [summary["run_id"] for summary in summaries],
+        "next_cursor": next_cursor,
+    }
+    if view == 'summary':
+        response_data["runs"] = summaries
+    return response_data, 200
+
 @app.route('/results', methods=['GET'])
 def get_results_list():
-    """API endpoint to list available result run_ids."""
-    with storage_lock:
-        keys = list(crew_results_storage.keys())
-    return jsonify({"available_run_ids": keys}), 200
-
+    """
+    API endpoint to list stored runs. With no query params, returns every run id
+    (oldest first); any of the params below switches to pages, newest first:
+      limit (default 100, max 1000), cursor (from `next_cursor`), status (success|error),
+      since / until (unix seconds or ISO 8601), min_cost (USD), min_tokens,
+      view ("ids" for run ids only, "summary" for slim summary rows).
+    """
+    body, status = query_results_page(request.args)
+    return jsonify(body), status
+
+
+def parse_fields_param(value: Optional[str]) -> Optional[tuple]:
+    """Parses a `fields=a,b` projection into sorted unique names; None means the full result."""
+    if value is None: return None
+    names = tuple(sorted({name.strip() for name in value.split(',') if name.strip()}))
+    if not names or not all(re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name) for name in names):
+        raise ValueError("'fields' must be a comma-separated list of top-level result keys")
+    return names
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> str:
+    """Picks "br" (when brotli is installed), then "gzip", from an Accept-Encoding header; "identity" otherwise."""
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+    for encoding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return "identity"
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against `etag` (RFC 9110 section 13.1.2)."""
+    if not if_none_match: return False
+    if if_none_match.strip() == '*': return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any((tag[2:] if tag.startswith('W/') else tag) == opaque for tag in candidates)
+
+def result_detail_response(run_id: str, fields_param: Optional[str] = None, accept_encoding: Optional[str] = None,
+                           if_none_match: Optional[str] = None) -> tuple:
+    """
+    The /results/<run_id> response, shared by the Flask route and asgi_app.
+    Returns (HTTP status, body bytes, headers): 304 when If-None-Match matches,
+    the `fields` projection when requested, compressed when large enough.
+    """
+    if not isinstance(run_id, str) or not RUN_ID_PATTERN.fullmatch(run_id):
+        return 400, json.dumps({"error": "Invalid run_id format"}).encode('utf-8'), {}
+    try:
+        fields = parse_fields_param(fields_param)
+    except ValueError as e:
+        return 400, json.dumps({"error": str(e)}).encode('utf-8'), {}
+
+    snapshot = result_store.get_snapshot(run_id)
+    if not snapshot:
+        return 404, json.dumps({"error": f"Results not found for run_id: {run_id}. It might still be running or failed to start."}).encode('utf-8'), {}
+
+    # Stored results never change, but they can be pruned: clients revalidate every time and get a 304
+    headers = {"ETag": snapshot.etag(fields), "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(if_none_match, headers["ETag"]):
+        metrics.inc("crew_result_responses_total", outcome="not_modified", encoding="identity")
+        return 304, b"", headers
+
+    # Pre-serialized at freeze time (already includes the pricing info in agent_token_usage)
+    body = snapshot.body(fields)
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= RESULT_COMPRESSION_MIN_BYTES else "identity"
+    if encoding != "identity":
+        body = snapshot.body(fields, encoding)
+        headers["Content-Encoding"] = encoding
+    metrics.inc("crew_result_responses_total", outcome="projected" if fields else "full", encoding=encoding)
+    return 200, body, headers
 
 @app.route('/results/<run_id>', methods=['GET'])
 def get_result_detail(run_id):
-    """API endpoint to get detailed results for a specific run_id."""
-    if not isinstance(run_id, str) or not re.fullmatch(r'[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}', run_id):
-         return jsonify({"error": "Invalid run_id format"}), 400
-
-    with storage_lock:
-        result = crew_results_storage.get(run_id)
-        if result:
-            import copy
-            result_copy = copy.deepcopy(result)
-        else:
-            result_copy = None
-
-    if result_copy:
-        # The result_copy already contains the pricing info in agent_token_usage
-        return jsonify(result_copy), 200
-    else:
-        return jsonify({"error": f"Results not found for run_id: {run_id}. It might still be running or failed to start."}), 404
+    """
+    API endpoint to get detailed results for a specific run_id.
+    Query params (optional): fields (comma-separated top-level keys, e.g. "status,agent_token_usage").
+    Honours If-None-Match (304 for an unchanged ETag) and Accept-Encoding (br/gzip).
+    """
+    status, body, headers = result_detail_response(
+        run_id, request.args.get('fields'), request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match')
+    )
+    return Response(body, status=status, headers=headers, mimetype='application/json')
 
 
 # --- WebSocket Event Handlers (Keep As Is) ---
@@ -887,64 +4843,108 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     """Called when a client disconnects."""
+    msgpack_subscribers.disconnect(request.sid)
     print(f"Client disconnected: {request.sid}")
 
-@socketio.on('join_room')
-def handle_join_room(data):
-    """Called when a client wants to join a room to receive logs for a specific run."""
-    if not isinstance(data, dict):
-        print(f"Client {request.sid} sent invalid join data type: {type(data)}")
-        emit('error', {'message': 'Invalid data format. Send {"run_id": "your_run_id"}.'})
-        return
+class RoomRequestError(ValueError):
+    """Invalid join_room/leave_room payload; the message is emitted to the client as an `error` event."""
 
+def parse_room_request(data: Any, action: str) -> str:
+    """Returns the run_id of a join/leave payload. Raises RoomRequestError for invalid input."""
+    if not isinstance(data, dict):
+        raise RoomRequestError('Invalid data format. Send {"run_id": "your_run_id"}.')
     run_id = data.get('run_id')
     if not run_id or not isinstance(run_id, str):
-        print(f"Client {request.sid} tried to join room without valid run_id.")
-        emit('error', {'message': 'run_id must be provided as a string.'})
-        return
+        raise RoomRequestError(f'run_id must be provided as a string to {action} a room.')
+    if not RUN_ID_PATTERN.fullmatch(run_id):
+        raise RoomRequestError('Invalid run_id format provided.')
+    return run_id
+
+def parse_join_request(data: Any) -> tuple:
+    """Validates a join_room payload. Returns (run_id, since_seq, granted encoding)."""
+    run_id = parse_room_request(data, 'join')
+    since_seq = data.get('since_seq')
+    if since_seq is not None and (not isinstance(since_seq, int) or isinstance(since_seq, bool) or since_seq < 0):
+        raise RoomRequestError('since_seq must be a non-negative integer.')
+    encoding = data.get('encoding', 'json')
+    if encoding not in EVENT_ENCODINGS:
+        raise RoomRequestError(f'encoding must be one of {list(EVENT_ENCODINGS)}.')
+    return run_id, since_seq, negotiate_event_encoding(encoding)
+
+def join_run_room(run_id: str, since_seq: Optional[int], encoding: str, enter_room, send, client: str) -> None:
+    """
+    Subscribes a client to a run, shared by the Flask handler and asgi_app.
+    `enter_room(room)` adds the client to a room and `send(event, payload)` emits to it alone.
+    With `since_seq`, buffered events after it are replayed first; then the queue position
+    of a queued run and the stored result of a finished one are sent.
+    Blocking: the event log, run registry and result store may be in Redis.
+    """
+    run_lock = run_event_log.lock_for(run_id, create=False) if since_seq is not None else None
+    if run_lock is not None:
+        # Subscribe and replay under the run's lock: live events resume right after the replayed ones
+        with run_lock:
+            enter_room(event_room(run_id, encoding))
+            if encoding == "msgpack": msgpack_subscribers.join(client, run_id)
+            print(f"Client {client} joined room: {run_id} (resuming after seq {since_seq}, {encoding})")
+            send('joined_room', {'run_id': run_id, 'encoding': encoding, 'message': f'Successfully joined room {run_id}. Replaying missed logs...'})
+            replay = run_event_log.events_since(run_id, since_seq)
+            for _, event, payload in replay["events"]:
+                send(event, encode_event_payload(payload, encoding))
+            send('replay_complete', {'run_id': run_id, 'since_seq': since_seq, 'last_seq': replay["last_seq"],
+                                     'replayed': len(replay["events"]), 'truncated': replay["truncated"]})
+        if any(event == 'run_complete' for _, event, _ in replay["events"]):
+            return # The buffered run_complete was already replayed
+    else:
+        enter_room(event_room(run_id, encoding))
+        if encoding == "msgpack": msgpack_subscribers.join(client, run_id)
+        print(f"Client {client} joined room: {run_id} ({encoding})")
+        send('joined_room', {'run_id': run_id, 'encoding': encoding, 'message': f'Successfully joined room {run_id}. Waiting for logs...'})
+
+    # Late joiners of a queued run would otherwise miss the 'queued' event emitted at submit time
+    queue_position = lookup_queue_position(run_id)
+    if queue_position:
+        send('log_update', encode_event_payload({'type': 'queued', 'run_id': run_id, 'data': {'message': f'Run queued at position {queue_position}.', 'queue_position': queue_position}}, encoding))
+
+    existing_snapshot = result_store.get_snapshot(run_id)
+    if existing_snapshot:
+        print(f"Sending existing results for run {run_id} to client {client}")
+        send('run_complete', encode_event_payload(existing_snapshot.run_complete_payload(), encoding))
+
+def leave_run_room(run_id: str, exit_room, send, client: str) -> None:
+    """Unsubscribes a client from every encoding room of a run (see join_run_room)."""
+    for encoding in EVENT_ENCODINGS:
+        exit_room(event_room(run_id, encoding))
+    msgpack_subscribers.leave(client, run_id)
+    print(f"Client {client} left room: {run_id}")
+    send('left_room', {'run_id': run_id, 'message': f'Successfully left room {run_id}.'})
 
-    if not re.fullmatch(r'[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}', run_id):
-         print(f"Client {request.sid} tried to join invalid room format: {run_id}")
-         emit('error', {'message': 'Invalid run_id format provided.'})
-         return
-
-    join_room(run_id)
-    print(f"Client {request.sid} joined room: {run_id}")
-    emit('joined_room', {'run_id': run_id, 'message': f'Successfully joined room {run_id}. Waiting for logs...'})
-
-    existing_result = None
-    with storage_lock:
-        result_in_storage = crew_results_storage.get(run_id)
-        if result_in_storage:
-             import copy
-             existing_result = copy.deepcopy(result_in_storage)
-
-    if existing_result:
-         status = 'error' if existing_result.get('error') else 'success'
-         print(f"Sending existing results for run {run_id} to client {request.sid}")
-         emit('run_complete', {
-              'run_id': run_id,
-              'status': status,
-              'error': existing_result.get('error'),
-              'final_result': existing_result
-              })
+@socketio.on('join_room')
+def handle_join_room(data):
+    """
+    Called when a client wants to join a room to receive logs for a specific run.
+    Send {"run_id": "...", "since_seq": N} to first receive every buffered event with
+    seq > N (followed by a `replay_complete` event), then live events.
+    Add "encoding": "msgpack" to receive run events as MessagePack binary payloads;
+    `joined_room` reports the encoding granted (handshake events themselves stay JSON).
+    """
+    try:
+        run_id, since_seq, encoding = parse_join_request(data)
+    except RoomRequestError as e:
+        print(f"Client {request.sid} sent an invalid join request: {e}")
+        emit('error', {'message': str(e)})
+        return
+    join_run_room(run_id, since_seq, encoding, join_room, emit, request.sid)
 
 @socketio.on('leave_room')
 def handle_leave_room(data):
     """Called when a client wants to explicitly leave a room."""
-    if not isinstance(data, dict):
-        print(f"Client {request.sid} sent invalid leave data type: {type(data)}")
-        emit('error', {'message': 'Invalid data format. Send {"run_id": "your_run_id"}.'})
+    try:
+        run_id = parse_room_request(data, 'leave')
+    except RoomRequestError as e:
+        print(f"Client {request.sid} sent an invalid leave request: {e}")
+        emit('error', {'message': str(e)})
         return
-
-    run_id = data.get('run_id')
-    if run_id and isinstance(run_id, str) and re.fullmatch(r'[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}', run_id):
-        leave_room(run_id)
-        print(f"Client {request.sid} left room: {run_id}")
-        emit('left_room', {'run_id': run_id, 'message': f'Successfully left room {run_id}.'})
-    else:
-        print(f"Client {request.sid} tried to leave room with invalid/missing run_id.")
-        emit('error', {'message': 'Valid run_id must be provided to leave a room.'})
+    leave_run_room(run_id, leave_room, emit, request.sid)
 
 
 # --- Main Execution Block (Keep As Is) ---
@@ -0,0 +1,335 @@
+"""
+ASGI entry point: serves the same HTTP API (/, /run, /results, /results/<run_id>,
+/stats, /metrics) and Socket.IO events as app.py, but on python-socketio's
+AsyncServer and an asyncio event loop instead of Flask-SocketIO on a
+monkey-patched eventlet hub.
+
+- HTTP handlers run on the loop; result-store and stats reads go to a thread.
+- The hierarchy call is made with a pooled httpx.AsyncClient on the loop,
+  through the same breaker, hedging and retry policy (hierarchy_requests).
+- CrewAI's kickoff is synchronous, so each crew runs on a scheduler thread
+  (real OS threads here). Its emits are handed to the loop through
+  AsyncEmitterBridge, which keeps them in call order.
+
+Run:  uvicorn asgi_app:asgi_app --host 0.0.0.0 --port 8080
+  or: python asgi_app.py
+For several workers, set SOCKETIO_MESSAGE_QUEUE (see app.py's multi-worker mode)
+and add --workers N.
+The eventlet server (python app.py / gunicorn --worker-class eventlet app:app)
+is unchanged, so both can be compared with benchmarks/run_benchmark.py --server.
+"""
+import os
+os.environ["SERVER_MODE"] = "asgi" # Must be set before app is imported: skips eventlet.monkey_patch()
+
+import asyncio
+import functools
+import inspect
+import json
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+import socketio
+
+import app as core
+
+
+# --- Emitter Bridge ---
+class AsyncEmitterBridge:
+    """
+    Gives crew threads the Flask-SocketIO surface they use (emit, sleep,
+    start_background_task) on top of an AsyncServer. Emits and room joins are
+    queued through `call_soon_threadsafe` and sent by a single drain task, so
+    they leave in the order they were made, whichever thread made them.
+    That ordering lets join_room replay under the run's event-log lock without
+    gaps or reordering.
+    """
+    def __init__(self, server: socketio.AsyncServer):
+        self.server = server
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self.emitted = 0
+        self.failed = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.loop is not None: return
+        self.loop = loop
+        self._queue = asyncio.Queue()
+        loop.create_task(self._drain())
+
+    def _submit(self, operation: tuple) -> None:
+        if self.loop is None:
+            print(f"Warning: dropping Socket.IO operation before the server loop started: {operation[:2]}")
+            return
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, operation)
+
+    def emit(self, event: str, data: Any = None, room: Optional[str] = None, **kwargs: Any) -> None:
+        to = kwargs.pop('to', None) or room
+        self._submit(("emit", event, data, to, kwargs))
+
+    def enter_room(self, sid: str, room: str) -> None:
+        self._submit(("enter_room", sid, room))
+
+    def leave_room(self, sid: str, room: str) -> None:
+        self._submit(("leave_room", sid, room))
+
+    def sleep(self, seconds: float = 0) -> None:
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args: Any, **kwargs: Any) -> threading.Thread:
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    async def _drain(self) -> None:
+        while True:
+            operation = await self._queue.get()
+            try:
+                if operation[0] == "emit":
+                    _, event, data, to, kwargs = operation
+                    await self.server.emit(event, data, to=to, **kwargs)
+                    self.emitted += 1
+                else:
+                    kind, sid, room = operation
+                    method = self.server.enter_room if kind == "enter_room" else self.server.leave_room
+                    result = method(sid, room) # Coroutine in newer python-socketio releases
+                    if inspect.isawaitable(result): await result
+            except Exception as e:
+                self.failed += 1
+                print(f"[ASGI Emitter] ERROR in {operation[0]} ({operation[1]}): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"emitted": self.emitted, "failed": self.failed, "pending": self._queue.qsize() if self._queue else 0}
+
+
+# --- Async Hierarchy Client ---
+class AsyncHierarchyClient:
+    """
+    Async counterpart of create_agent_hierarchy_with_ai. It shares that function's cache
+    lookup, request builder, rate limiting and response handling, and sends the request
+    through core.hierarchy_requests (breaker, hedging, retries) on a pooled
+    httpx.AsyncClient. Crew threads call `generate_blocking`, which runs the request on
+    the server loop.
+    """
+    def __init__(self, bridge: AsyncEmitterBridge):
+        self.bridge = bridge
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=core.HTTP_POOL_MAXSIZE,
+                    max_keepalive_connections=core.HTTP_POOL_MAXSIZE,
+                    keepalive_expiry=core.HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(core.HTTP_READ_TIMEOUT, connect=core.HTTP_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def generate(self, task_description: str, use_cache: bool = True, on_rate_limit_wait=None) -> str:
+        use_cache = use_cache and core.HIERARCHY_CACHE_ENABLED
+        # Both ends touch the hierarchy cache, which may be a blocking Redis call: keep them off the loop
+        cached_hierarchy, error_json = await asyncio.to_thread(core.begin_hierarchy_generation, task_description, use_cache)
+        if cached_hierarchy is not None or error_json is not None:
+            return cached_hierarchy or error_json
+
+        headers, payload = core.build_hierarchy_request(task_description)
+        # The limiter sleeps while queued: keep that off the loop
+        estimated_tokens = await asyncio.to_thread(core.reserve_hierarchy_call, payload, on_rate_limit_wait)
+        actual_tokens = estimated_tokens # Until the response reports usage (or the request fails)
+        try:
+            send = functools.partial(self._http().post, core.HIERARCHY_API_ENDPOINT, headers=headers, json=payload)
+            response = await core.hierarchy_requests.post_async(
+                send, retry_errors=(httpx.TransportError,),
+                reserve_extra=core.hierarchy_extra_request_reserver(payload, estimated_tokens),
+            )
+            response.raise_for_status()
+            api_response_data = response.json()
+            usage = api_response_data.get('usage') or {}
+            if usage.get('total_tokens') is not None:
+                actual_tokens = int(usage['total_tokens'])
+            generated_text = api_response_data['choices'][0]['message']['content'].strip()
+        except (httpx.HTTPError, core.CircuitOpenError) as req_err:
+            actual_tokens = 0 # Nothing was generated
+            print(f"Error during async API request for hierarchy: {req_err}")
+            return json.dumps({"error": f"API request failed: {req_err}"})
+        except (ValueError, KeyError, IndexError) as parse_err:
+            print(f"Error: Unexpected API response structure for hierarchy. Error: {parse_err}")
+            return json.dumps({"error": f"Unexpected API response structure: {parse_err}"})
+        except Exception as e:
+            print(f"An unexpected error occurred during hierarchy generation: {e}")
+            traceback.print_exc()
+            return json.dumps({"error": f"An unexpected error occurred: {e}"})
+        finally:
+            core.rate_limiter.reconcile(payload["model"], estimated_tokens, actual_tokens)
+        return await asyncio.to_thread(core.finish_hierarchy_generation, task_description, generated_text, use_cache)
+
+    def generate_blocking(self, task_description: str, use_cache: bool = True, on_rate_limit_wait=None) -> str:
+        """Drop-in for create_agent_hierarchy_with_ai in crew threads: runs `generate` on the server loop and waits."""
+        future = asyncio.run_coroutine_threadsafe(self.generate(task_description, use_cache=use_cache, on_rate_limit_wait=on_rate_limit_wait), self.bridge.loop)
+        return future.result()
+
+
+# --- Server Setup ---
+# With SOCKETIO_MESSAGE_QUEUE set, rooms span every worker: emits are published through Redis
+client_manager = socketio.AsyncRedisManager(core.SOCKETIO_MESSAGE_QUEUE) if core.SOCKETIO_MESSAGE_QUEUE else None
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", client_manager=client_manager)
+bridge = AsyncEmitterBridge(sio)
+hierarchy_client = AsyncHierarchyClient(bridge)
+core.bind_emitter(bridge)
+
+
+# --- HTTP Endpoints ---
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"Content-Type, If-None-Match"),
+    (b"access-control-expose-headers", b"ETag"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+]
+
+async def send_response(send, status: int, body: bytes, content_type: str = "application/json",
+                        headers: Optional[Dict[str, str]] = None) -> None:
+    response_headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())] + CORS_HEADERS
+    response_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+async def send_json(send, status: int, body: Any, headers: Optional[Dict[str, str]] = None) -> None:
+    await send_response(send, status, json.dumps(body).encode("utf-8"), headers=headers)
+
+async def read_body(receive) -> bytes:
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"): return b"".join(chunks)
+
+async def handle_run(scope, receive, send) -> None:
+    content_type = dict(scope["headers"]).get(b"content-type", b"").decode("latin-1")
+    body = await read_body(receive)
+    if "json" not in content_type:
+        return await send_json(send, 400, {"error": "Request must be JSON"})
+    try:
+        data = json.loads(body or b"null")
+        task_description, run_options, use_single_flight = core.parse_run_request(data)
+    except (ValueError, core.RunRequestError) as e:
+        message = str(e) if isinstance(e, core.RunRequestError) else "Request must be JSON"
+        return await send_json(send, 400, {"error": message})
+    target_kwargs = {}
+    if core.crew_process_pool is None:
+        # Inline crews make the hierarchy call on this loop; pool workers keep their own sync client
+        target_kwargs["generate_hierarchy"] = hierarchy_client.generate_blocking
+    response_body, status, headers = core.submit_run(task_description, run_options, use_single_flight, core.socketio, **target_kwargs)
+    await send_json(send, status, response_body, headers=headers)
+
+async def handle_result_detail(scope, send, run_id: str) -> None:
+    headers = dict(scope["headers"])
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    accept_encoding = headers.get(b"accept-encoding", b"").decode("latin-1") or None
+    if_none_match = headers.get(b"if-none-match", b"").decode("latin-1") or None
+    status, body, response_headers = await asyncio.to_thread(
+        core.result_detail_response, run_id, args.get("fields"), accept_encoding, if_none_match
+    )
+    await send_response(send, status, body, headers=response_headers)
+
+async def http_app(scope, receive, send) -> None:
+    """Plain ASGI router for the non-Socket.IO endpoints."""
+    if scope["type"] != "http":
+        return
+    bridge.start(asyncio.get_running_loop())
+    method, path = scope["method"], scope["path"].rstrip("/") or "/"
+    try:
+        if method == "OPTIONS":
+            await send_response(send, 204, b"")
+        elif path == "/" and method == "GET":
+            await send_json(send, 200, {"status": "ok", "message": "CrewAI API server is running"})
+        elif path == "/run" and method == "POST":
+            await handle_run(scope, receive, send)
+        elif path == "/results" and method == "GET":
+            args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+            body, status = await asyncio.to_thread(core.query_results_page, args)
+            await send_json(send, status, body)
+        elif path.startswith("/results/") and method == "GET":
+            await handle_result_detail(scope, send, path[len("/results/"):])
+        elif path == "/stats" and method == "GET":
+            stats = await asyncio.to_thread(core.runtime_stats)
+            stats["asgi"] = {"emitter": bridge.stats()}
+            await send_json(send, 200, stats)
+        elif path == "/metrics" and method == "GET":
+            body = await asyncio.to_thread(core.metrics.render)
+            await send_response(send, 200, body.encode("utf-8"), content_type="text/plain; version=0.0.4; charset=utf-8")
+        elif path in ("/", "/run", "/results", "/stats", "/metrics") or path.startswith("/results/"):
+            await send_json(send, 405, {"error": "Method not allowed"})
+        else:
+            await send_json(send, 404, {"error": "Not found"})
+    except Exception as e:
+        print(f"Error handling {method} {path}: {e}")
+        traceback.print_exc()
+        await send_json(send, 500, {"error": "Internal server error"})
+
+
+# --- WebSocket Event Handlers ---
+@sio.event
+async def connect(sid, environ):
+    bridge.start(asyncio.get_running_loop())
+    print(f"Client connected: {sid}")
+
+@sio.event
+async def disconnect(sid, *args):
+    await asyncio.to_thread(core.msgpack_subscribers.disconnect, sid) # May update the run registry
+    print(f"Client disconnected: {sid}")
+
+@sio.on('join_room')
+async def handle_join_room(sid, data):
+    """Same contract as app.py's join_room, including `since_seq` replay and the `encoding` option."""
+    try:
+        run_id, since_seq, encoding = core.parse_join_request(data)
+    except core.RoomRequestError as e:
+        print(f"Client {sid} sent an invalid join request: {e}")
+        bridge.emit('error', {'message': str(e)}, to=sid)
+        return
+    # Bridge operations are queued in call order, so the replay keeps its place under the run's lock
+    await asyncio.to_thread(core.join_run_room, run_id, since_seq, encoding,
+                            functools.partial(bridge.enter_room, sid),
+                            functools.partial(bridge.emit, to=sid), sid)
+
+@sio.on('leave_room')
+async def handle_leave_room(sid, data):
+    try:
+        run_id = core.parse_room_request(data, 'leave')
+    except core.RoomRequestError as e:
+        print(f"Client {sid} sent an invalid leave request: {e}")
+        bridge.emit('error', {'message': str(e)}, to=sid)
+        return
+    # Off the loop: the msgpack subscriber count may live in the run registry
+    await asyncio.to_thread(core.leave_run_room, run_id, functools.partial(bridge.leave_room, sid), functools.partial(bridge.emit, to=sid), sid)
+
+
+async def on_startup() -> None:
+    bridge.start(asyncio.get_running_loop())
+
+async def on_shutdown() -> None:
+    await hierarchy_client.close()
+
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=http_app, on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    key_ok, error_message = core.check_api_key(os.getenv("OPENAI_API_KEY"), "OPENAI_API_KEY")
+    if not key_ok:
+        print(f"CRITICAL ERROR: Cannot start server - {error_message}. Ensure OPENAI_API_KEY is set in your .env file or environment.")
+        exit(1)
+    server_port = int(os.getenv("PORT", 8080))
+    print(f" * Running ASGI server on http://0.0.0.0:{server_port}/ (Press CTRL+C to quit)")
+    uvicorn.run(asgi_app, host="0.0.0.0", port=server_port, log_level="warning")
@@ -0,0 +1,165 @@
+"""
+Per-event size and encode-time comparison of the two run-event encodings:
+JSON (the default) and MessagePack (clients that join_room with "encoding": "msgpack").
+
+Every event is encoded the way the server sends it, with python-socketio's own packet
+encoder: a JSON EVENT packet, or a BINARY_EVENT packet whose attachment is the payload
+packed like app.encode_event_payload. Sizes include the Socket.IO framing (header packet
+plus attachment for binary events); the one-byte Engine.IO prefix is left out.
+
+Events come from a capture written by run_benchmark.py --capture-events, or from a
+synthetic sample shaped like the log_update / run_complete emits of a crew run.
+
+Example:
+    python benchmarks/event_encoding_benchmark.py --events events.jsonl --json-out encoding.json
+    python benchmarks/event_encoding_benchmark.py --synthetic-runs 20 --agents 4 --output-words 400
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import msgpack
+from socketio import packet
+
+FILLER_WORDS = ("analysis", "result", "plan", "step", "detail", "summary", "context", "output", "review", "draft")
+
+
+def load_events(path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    events = []
+    with open(path) as source:
+        for line in source:
+            if line.strip():
+                item = json.loads(line)
+                events.append((item["event"], item["payload"]))
+    return events
+
+
+def synthetic_events(runs: int, agents: int, output_words: int, seed: int) -> List[Tuple[str, Dict[str, Any]]]:
+    """log_update events of a sequential crew run (one task per agent) followed by its run_complete."""
+    rng = random.Random(seed)
+
+    def text(words: int) -> str:
+        return " ".join(rng.choice(FILLER_WORDS) for _ in range(words))
+
+    events: List[Tuple[str, Dict[str, Any]]] = []
+    for _ in range(runs):
+        run_id = str(uuid.uuid4())
+        seq = 0
+        task_flow, agent_usage = [], {}
+
+        def log(event_type: str, agent_name: str, data: Dict[str, Any]) -> None:
+            nonlocal seq
+            seq += 1
+            events.append(("log_update", {
+                "type": event_type, "run_id": run_id, "log_prefix": f"Run({run_id}) Agent({agent_name})",
+                "data": data, "seq": seq, "ts": round(time.time(), 4),
+            }))
+
+        for index in range(agents):
+            agent_name = f"Agent_{index + 1}"
+            task_description = f"Step {index + 1}: {text(12)}"
+            output = text(output_words)
+            usage = {"prompt_tokens": rng.randint(300, 2000), "completion_tokens": output_words, "model": "gpt-4o"}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            usage["estimated_cost_usd"] = round(usage["total_tokens"] * 5e-6, 6)
+            log("task_start", agent_name, {"agent_name": agent_name, "task_description": task_description, "message": f"Starting task: {task_description}"})
+            log("llm_start", agent_name, {"agent_name": agent_name, "model": "gpt-4o", "message": "Calling LLM..."})
+            log("llm_end", agent_name, {"agent_name": agent_name, "output": output, "token_usage": usage, "duration_seconds": round(rng.uniform(1, 8), 3)})
+            log("agent_usage_update", agent_name, {"agent_name": agent_name, "usage": usage})
+            log("task_complete", agent_name, {"agent_name": agent_name, "task_description": task_description, "output": output})
+            task_flow.append({"agent": agent_name, "task": task_description, "output": output})
+            agent_usage[agent_name] = usage
+
+        result = {
+            "run_id": run_id, "task_description": text(20), "agent_hierarchy": [{"agent_name": name, "level": i + 1} for i, name in enumerate(agent_usage)],
+            "final_output": task_flow[-1]["output"] if task_flow else None, "task_flow": task_flow,
+            "usage_metrics": {"total_tokens": sum(u["total_tokens"] for u in agent_usage.values())},
+            "agent_token_usage": agent_usage, "error": None,
+        }
+        seq += 1
+        events.append(("run_complete", {"run_id": run_id, "status": "success", "error": None, "final_result": result, "seq": seq, "ts": round(time.time(), 4)}))
+    return events
+
+
+def encode_json(event: str, payload: Dict[str, Any]) -> int:
+    return len(packet.Packet(packet.EVENT, data=[event, payload]).encode().encode("utf-8"))
+
+
+def encode_msgpack(event: str, payload: Dict[str, Any]) -> int:
+    packed = msgpack.packb(payload, default=str, use_bin_type=True)
+    header, *attachments = packet.Packet(packet.EVENT, data=[event, packed]).encode()
+    return len(header.encode("utf-8")) + sum(len(attachment) for attachment in attachments)
+
+
+def event_group(event: str, payload: Dict[str, Any]) -> str:
+    return f"{event}:{payload['type']}" if event == "log_update" and "type" in payload else event
+
+
+def measure(events: List[Tuple[str, Dict[str, Any]]], repeat: int) -> "OrderedDict[str, Dict[str, Any]]":
+    """Per event group: count, total bytes and total encode seconds for each encoding."""
+    groups: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    for event, payload in events:
+        stats = groups.setdefault(event_group(event, payload), {"count": 0, "json_bytes": 0, "msgpack_bytes": 0, "json_seconds": 0.0, "msgpack_seconds": 0.0})
+        stats["count"] += 1
+        for name, encoder in (("json", encode_json), ("msgpack", encode_msgpack)):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                size = encoder(event, payload)
+            stats[f"{name}_seconds"] += (time.perf_counter() - started) / repeat
+            stats[f"{name}_bytes"] += size
+    return groups
+
+
+def summarize(name: str, stats: Dict[str, Any]) -> Dict[str, Any]:
+    count = stats["count"]
+    return {
+        "group": name,
+        "events": count,
+        "json_bytes_per_event": round(stats["json_bytes"] / count, 1),
+        "msgpack_bytes_per_event": round(stats["msgpack_bytes"] / count, 1),
+        "bytes_saved_pct": round(100.0 * (1 - stats["msgpack_bytes"] / stats["json_bytes"]), 1) if stats["json_bytes"] else None,
+        "json_encode_us": round(1e6 * stats["json_seconds"] / count, 2),
+        "msgpack_encode_us": round(1e6 * stats["msgpack_seconds"] / count, 2),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare JSON and MessagePack Socket.IO encodings of run events.")
+    parser.add_argument("--events", default=None, help="JSON lines capture from run_benchmark.py --capture-events (default: synthetic events)")
+    parser.add_argument("--synthetic-runs", type=int, default=10, help="Synthetic runs when no capture is given (default: 10)")
+    parser.add_argument("--agents", type=int, default=3, help="Agents (tasks) per synthetic run (default: 3)")
+    parser.add_argument("--output-words", type=int, default=200, help="Words per synthetic task output (default: 200)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=20, help="Encodes per event when timing (default: 20)")
+    parser.add_argument("--json-out", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    events = load_events(args.events) if args.events else synthetic_events(args.synthetic_runs, args.agents, args.output_words, args.seed)
+    if not events:
+        print("No events to measure.")
+        return 1
+    groups = measure(events, max(1, args.repeat))
+    totals = {key: sum(stats[key] for stats in groups.values()) for key in ("count", "json_bytes", "msgpack_bytes", "json_seconds", "msgpack_seconds")}
+    rows = [summarize(name, stats) for name, stats in groups.items()] + [summarize("all", totals)]
+
+    print(f"{'group':<34}{'events':>8}{'json B':>10}{'msgpack B':>11}{'saved':>8}{'json us':>10}{'msgpack us':>12}")
+    for row in rows:
+        saved = f"{row['bytes_saved_pct']}%" if row["bytes_saved_pct"] is not None else "-"
+        print(f"{row['group']:<34}{row['events']:>8}{row['json_bytes_per_event']:>10}{row['msgpack_bytes_per_event']:>11}{saved:>8}"
+              f"{row['json_encode_us']:>10}{row['msgpack_encode_us']:>12}")
+
+    if args.json_out:
+        report = {"config": {key: value for key, value in vars(args).items() if key != "json_out"}, "groups": rows}
+        with open(args.json_out, "w") as out:
+            json.dump(report, out, indent=2)
+        print(f"Report written to {args.json_out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
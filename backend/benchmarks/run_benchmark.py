@@ -0,0 +1,351 @@
+"""
+End-to-end throughput benchmark for the crew server, fully offline.
+
+Starts the stub OpenAI server (stub_openai_server.py), launches app.py (or, with
+--server asgi, asgi_app.py) pointed at it (HIERARCHY_API_ENDPOINT / CREW_LLM_BASE_URL),
+then drives N runs with a bounded number in flight. Every run has its own Socket.IO subscriber that joins the run's
+room and waits for `run_complete`. Afterwards the stored results are read back.
+
+Reports runs/sec, end-to-end latency (POST /run -> run_complete) percentiles,
+event delivery lag (client receive time - server `ts` on live events), result read
+throughput/latency and the server's peak RSS.
+
+Example:
+    python benchmarks/run_benchmark.py --runs 50 --concurrency 10 --latency-ms 200 --json-out bench.json
+    python benchmarks/run_benchmark.py --server asgi --runs 50 --concurrency 10 --latency-ms 200 --json-out bench-asgi.json
+    python benchmarks/run_benchmark.py --event-encoding msgpack --capture-events events.jsonl
+(events.jsonl can then be fed to event_encoding_benchmark.py --events.)
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+import socketio
+
+try:
+    import msgpack # Only needed for --event-encoding msgpack
+except ImportError:
+    msgpack = None
+
+from stub_openai_server import StubOpenAIServer, add_stub_arguments, stub_config_from_args
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile; None for an empty sample."""
+    if not values: return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.4999)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def latency_summary(values: List[float]) -> Dict[str, Any]:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else None,
+        "p50": _round(percentile(values, 50)),
+        "p95": _round(percentile(values, 95)),
+        "p99": _round(percentile(values, 99)),
+        "max": _round(max(values) if values else None),
+    }
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+def find_free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+SERVER_ENTRY_POINTS = {"eventlet": "app.py", "asgi": "asgi_app.py"}
+
+class AppProcess:
+    """app.py (or asgi_app.py) in a subprocess, configured to talk only to the stub server."""
+    def __init__(self, port: int, stub_base_url: str, extra_env: Dict[str, str], log_path: str, server: str = "eventlet"):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ)
+        env.update({
+            "PORT": str(port),
+            "OPENAI_API_KEY": "sk-offline-benchmark",
+            "HIERARCHY_API_ENDPOINT": f"{stub_base_url}/chat/completions",
+            "CREW_LLM_BASE_URL": stub_base_url,
+            "RESULT_STORE_BACKEND": "memory",
+            "FLASK_DEBUG": "False",
+            # Keep the run offline: no telemetry exporters
+            "CREWAI_DISABLE_TELEMETRY": "true",
+            "OTEL_SDK_DISABLED": "true",
+        })
+        env.pop("RENDER", None) # app.py only serves itself when RENDER is unset
+        env.update(extra_env)
+        self.log_path = log_path
+        self._log_file = open(log_path, "w")
+        self.entry_point = SERVER_ENTRY_POINTS[server]
+        self.process = subprocess.Popen([sys.executable, self.entry_point], cwd=BACKEND_DIR, env=env,
+                                        stdout=self._log_file, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.entry_point} exited with code {self.process.returncode}; see {self.log_path}")
+            try:
+                if requests.get(f"{self.url}/", timeout=1).ok: return
+            except requests.RequestException:
+                pass
+            time.sleep(0.25)
+        raise RuntimeError(f"{self.entry_point} did not become ready within {timeout}s; see {self.log_path}")
+
+    def peak_rss_kb(self) -> Optional[int]:
+        """VmHWM (peak resident set) from /proc while the process is alive (Linux)."""
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def stop(self) -> Optional[int]:
+        """Stops the server; returns peak RSS in KB from /proc or, failing that, from rusage."""
+        peak_kb = self.peak_rss_kb()
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log_file.close()
+        if peak_kb is None:
+            max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            peak_kb = max_rss // 1024 if sys.platform == "darwin" else max_rss # macOS reports bytes
+        return peak_kb
+
+
+class RunDriver:
+    """Submits one run and follows it over Socket.IO until run_complete."""
+    def __init__(self, app_url: str, run_options: Dict[str, Any], run_timeout: float, event_encoding: str = "json", capture: bool = False):
+        self.app_url = app_url
+        self.run_options = run_options
+        self.run_timeout = run_timeout
+        self.event_encoding = event_encoding
+        self.capture = capture
+
+    def drive(self, index: int, task_description: str) -> Dict[str, Any]:
+        sio = socketio.Client(reconnection=False)
+        outcome: Dict[str, Any] = {"index": index, "status": None, "events": 0, "replayed_events": 0,
+                                   "event_lags": [], "rejections": 0, "encoding": None, "binary_bytes": 0, "captured": []}
+        done = threading.Event()
+        replaying = threading.Event()
+
+        def decode(payload: Any) -> Any:
+            if isinstance(payload, (bytes, bytearray)):
+                outcome["binary_bytes"] += len(payload)
+                return msgpack.unpackb(payload, raw=False)
+            return payload
+
+        def on_joined(payload: Dict[str, Any]) -> None:
+            outcome["encoding"] = (payload or {}).get("encoding", "json")
+            # Nothing buffered for the run yet: the server joins without a replay phase
+            if "Replaying" not in (payload or {}).get("message", ""): replaying.clear()
+
+        def on_event(event: str, payload: Any) -> None:
+            if not isinstance(payload, dict): return
+            outcome["events"] += 1
+            if self.capture: outcome["captured"].append({"event": event, "payload": payload})
+            if replaying.is_set():
+                outcome["replayed_events"] += 1 # Emitted before we joined: not a delivery-lag sample
+            elif isinstance(payload.get("ts"), (int, float)):
+                outcome["event_lags"].append(max(0.0, time.time() - payload["ts"]))
+            if event == "run_complete":
+                outcome["status"] = payload.get("status")
+                done.set()
+
+        sio.on("log_update", lambda payload: on_event("log_update", decode(payload)))
+        sio.on("log_batch", lambda frame: [on_event("log_update", item) for item in (decode(frame) or {}).get("events", [])])
+        sio.on("run_complete", lambda payload: on_event("run_complete", decode(payload)))
+        sio.on("replay_complete", lambda payload: replaying.clear())
+        sio.on("joined_room", on_joined)
+
+        sio.connect(self.app_url, wait_timeout=10)
+        try:
+            started = time.perf_counter()
+            while True:
+                response = requests.post(f"{self.app_url}/run", json=dict(self.run_options, task_description=task_description), timeout=30)
+                if response.status_code != 429: break
+                outcome["rejections"] += 1
+                time.sleep(float(response.headers.get("Retry-After", 1)))
+            response.raise_for_status()
+            run_id = response.json()["run_id"]
+            outcome["run_id"] = run_id
+            replaying.set()
+            # since_seq=0 replays anything emitted between POST /run and the join
+            sio.emit("join_room", {"run_id": run_id, "since_seq": 0, "encoding": self.event_encoding})
+            if not done.wait(self.run_timeout):
+                outcome["status"] = "timeout"
+            outcome["latency"] = time.perf_counter() - started
+        finally:
+            sio.disconnect()
+        return outcome
+
+
+def benchmark_result_reads(app_url: str, run_ids: List[str], reads: int, concurrency: int) -> Dict[str, Any]:
+    """GET /results/<run_id> (round robin) and /results listing pages; returns reads/sec and latency."""
+    if not run_ids or reads <= 0: return {}
+    session_local = threading.local()
+
+    def timed_get(path: str) -> float:
+        session = getattr(session_local, "session", None)
+        if session is None:
+            session = session_local.session = requests.Session()
+        started = time.perf_counter()
+        response = session.get(f"{app_url}{path}", timeout=30)
+        response.raise_for_status()
+        len(response.content) # Include body transfer in the timing
+        return time.perf_counter() - started
+
+    report: Dict[str, Any] = {}
+    for name, paths in (
+        ("detail", [f"/results/{run_ids[i % len(run_ids)]}" for i in range(reads)]),
+        ("listing", ["/results?view=summary&limit=50" for _ in range(reads)]),
+    ):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            timings = list(pool.map(timed_get, paths))
+        elapsed = time.perf_counter() - started
+        report[name] = dict(latency_summary(timings), reads_per_sec=round(len(timings) / elapsed, 2))
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the crew server.")
+    parser.add_argument("--server", choices=sorted(SERVER_ENTRY_POINTS), default="eventlet",
+                        help="Serving stack: eventlet (app.py) or asgi (asgi_app.py) (default: eventlet)")
+    parser.add_argument("--runs", type=int, default=20, help="Total runs to submit (default: 20)")
+    parser.add_argument("--concurrency", type=int, default=5, help="Runs in flight at once (default: 5)")
+    parser.add_argument("--run-timeout", type=float, default=300.0, help="Seconds to wait for each run_complete")
+    parser.add_argument("--same-task", action="store_true", help="Reuse one task description (exercises the hierarchy cache)")
+    parser.add_argument("--stream-tokens", action="store_true", help="Submit runs with stream_tokens=true")
+    parser.add_argument("--batch-logs", action="store_true", help="Submit runs with batch_logs=true")
+    parser.add_argument("--execution-mode", choices=("sequential", "level_parallel"), default=None)
+    parser.add_argument("--event-encoding", choices=("json", "msgpack"), default="json",
+                        help="Socket.IO event encoding requested by the subscribers (msgpack sets SOCKETIO_MSGPACK_ENABLED on the server)")
+    parser.add_argument("--capture-events", default=None, metavar="PATH", help="Write every received event to PATH as JSON lines")
+    parser.add_argument("--reads", type=int, default=200, help="Result reads per endpoint after the runs (default: 200)")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="Extra environment for app.py (repeatable)")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--json-out", default=None, help="Also write the report as JSON to this path")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    extra_env = {}
+    for item in args.app_env:
+        key, sep, value = item.partition("=")
+        if not sep: parser.error(f"--app-env expects KEY=VALUE, got {item!r}")
+        extra_env[key] = value
+
+    if args.event_encoding == "msgpack":
+        if msgpack is None: parser.error("--event-encoding msgpack needs the msgpack package")
+        extra_env.setdefault("SOCKETIO_MSGPACK_ENABLED", "true")
+
+    run_options: Dict[str, Any] = {"stream_tokens": args.stream_tokens, "batch_logs": args.batch_logs}
+    if args.execution_mode: run_options["execution_mode"] = args.execution_mode
+
+    stub = StubOpenAIServer(stub_config_from_args(args))
+    stub_url = stub.start()
+    log_path = os.path.join(tempfile.gettempdir(), f"crew-benchmark-app-{uuid.uuid4().hex[:8]}.log")
+    app_process = AppProcess(find_free_port(), stub_url, extra_env, log_path, server=args.server)
+    print(f"Stub OpenAI API: {stub_url}")
+    print(f"App server:      {app_process.url} [{args.server}] (log: {log_path})")
+
+    peak_rss_kb = None
+    try:
+        app_process.wait_ready(args.startup_timeout)
+        driver = RunDriver(app_process.url, run_options, args.run_timeout, event_encoding=args.event_encoding, capture=bool(args.capture_events))
+        tasks = ["Benchmark task: summarize the benefits of unit testing" if args.same_task
+                 else f"Benchmark task {i}: summarize the benefits of unit testing" for i in range(args.runs)]
+
+        print(f"Driving {args.runs} runs with concurrency {args.concurrency}...")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(driver.drive, range(args.runs), tasks))
+        wall_seconds = time.perf_counter() - started
+
+        completed = [o for o in outcomes if o["status"] in ("success", "error")]
+        run_ids = [o["run_id"] for o in completed if o.get("run_id")]
+        event_lags = [lag for o in outcomes for lag in o["event_lags"]]
+        total_events = sum(o["events"] for o in outcomes)
+
+        print("Reading results back...")
+        reads = benchmark_result_reads(app_process.url, run_ids, args.reads, args.concurrency)
+        server_stats = requests.get(f"{app_process.url}/stats", timeout=10).json()
+        peak_rss_kb = app_process.stop()
+    finally:
+        if app_process.process.poll() is None:
+            peak_rss_kb = app_process.stop()
+        stub.stop()
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("json_out", "capture_events")},
+        "wall_seconds": round(wall_seconds, 3),
+        "runs": {
+            "submitted": args.runs,
+            "succeeded": sum(1 for o in outcomes if o["status"] == "success"),
+            "failed": sum(1 for o in outcomes if o["status"] == "error"),
+            "timed_out": sum(1 for o in outcomes if o["status"] == "timeout"),
+            "queue_rejections": sum(o["rejections"] for o in outcomes),
+        },
+        "runs_per_sec": round(len(completed) / wall_seconds, 3) if wall_seconds else None,
+        "end_to_end_latency_seconds": latency_summary([o["latency"] for o in completed]),
+        "event_delivery_lag_seconds": latency_summary(event_lags),
+        "events": {"total": total_events, "replayed": sum(o["replayed_events"] for o in outcomes),
+                   "per_sec": round(total_events / wall_seconds, 2) if wall_seconds else None,
+                   "encodings_granted": sorted({o["encoding"] for o in outcomes if o["encoding"]}),
+                   "binary_bytes": sum(o["binary_bytes"] for o in outcomes)},
+        "result_reads": reads,
+        "server_peak_rss_mb": round(peak_rss_kb / 1024, 1) if peak_rss_kb else None,
+        "stub_requests": stub.stats.snapshot(),
+        "server_stats": server_stats,
+    }
+
+    e2e = report["end_to_end_latency_seconds"]
+    lag = report["event_delivery_lag_seconds"]
+    print(f"\n{'=' * 40}\nBENCHMARK SUMMARY\n{'=' * 40}")
+    print(f"Runs:              {report['runs']['succeeded']} ok / {report['runs']['failed']} error / {report['runs']['timed_out']} timeout ({args.runs} submitted)")
+    print(f"Throughput:        {report['runs_per_sec']} runs/sec over {report['wall_seconds']}s")
+    print(f"End-to-end (s):    p50={e2e['p50']} p95={e2e['p95']} p99={e2e['p99']} max={e2e['max']}")
+    print(f"Event lag (s):     p50={lag['p50']} p95={lag['p95']} p99={lag['p99']} ({lag['count']} live events)")
+    for name, summary in reads.items():
+        print(f"Reads /{name:<8}  {summary['reads_per_sec']} req/sec, p50={summary['p50']} p95={summary['p95']} p99={summary['p99']}")
+    print(f"Server peak RSS:   {report['server_peak_rss_mb']} MB")
+    print(f"Stub requests:     {report['stub_requests']}")
+
+    if args.capture_events:
+        with open(args.capture_events, "w") as out:
+            for outcome in outcomes:
+                for item in outcome["captured"]:
+                    out.write(json.dumps(item, default=str) + "\n")
+        print(f"Captured events written to {args.capture_events}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as out:
+            json.dump(report, out, indent=2)
+        print(f"Report written to {args.json_out}")
+    return 0 if report["runs"]["timed_out"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Local stand-in for the OpenAI chat completions API, used by the benchmark harness.
+
+Serves POST /v1/chat/completions (plain and `stream: true` SSE responses) with a
+configurable latency, completion size and error rate, so the crew server can be
+load-tested entirely offline:
+  * hierarchy requests (the system prompt used by create_agent_hierarchy_with_ai)
+    get a JSON array of agents,
+  * every other request gets a CrewAI-style "Final Answer:" completion.
+GET /stats returns request counters.
+
+Run standalone:  python stub_openai_server.py --port 8090 --latency-ms 200
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+HIERARCHY_SYSTEM_PROMPT_MARKER = "designing multi-agent systems"
+FILLER_WORDS = ("analysis", "result", "plan", "step", "detail", "summary", "context", "output", "review", "draft")
+
+
+class StubConfig:
+    """Knobs shared by every request handler of a StubOpenAIServer."""
+    def __init__(self, latency_ms: float = 100.0, jitter_ms: float = 0.0, completion_tokens: int = 64,
+                 prompt_tokens: Optional[int] = None, error_rate: float = 0.0, agents: int = 3,
+                 agents_per_level: int = 1, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.completion_tokens = max(1, completion_tokens)
+        self.prompt_tokens = prompt_tokens # None = estimate from the request (~4 characters per token)
+        self.error_rate = error_rate
+        self.agents = max(1, agents)
+        self.agents_per_level = max(1, agents_per_level)
+        self.random = random.Random(seed)
+
+    def latency_seconds(self) -> float:
+        jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(0.0, self.latency_ms + jitter) / 1000.0
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {"hierarchy": 0, "completion": 0, "streamed": 0, "errors_injected": 0}
+
+    def inc(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+def hierarchy_content(config: StubConfig) -> str:
+    agents = []
+    for index in range(config.agents):
+        agents.append({
+            "agent_name": f"Benchmark_Agent_{index + 1}",
+            "description": f"Handles part {index + 1} of the benchmark task",
+            "level": index // config.agents_per_level + 1,
+            "cost_per_million": 1,
+            "tokens": config.completion_tokens,
+        })
+    return json.dumps(agents)
+
+
+def completion_content(config: StubConfig) -> str:
+    words = [config.random.choice(FILLER_WORDS) for _ in range(max(1, config.completion_tokens - 8))]
+    return "Thought: I now can give a great answer\nFinal Answer: " + " ".join(words)
+
+
+def make_handler(config: StubConfig, stats: StubStats):
+    class StubRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass # Per-request logging would dominate the benchmark output
+
+        def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+            raw = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") == "/stats":
+                self._send_json(200, stats.snapshot())
+            else:
+                self._send_json(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+                return
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            messages: List[Dict[str, Any]] = body.get("messages") or []
+            is_hierarchy = any(HIERARCHY_SYSTEM_PROMPT_MARKER in str(m.get("content", "")) for m in messages if m.get("role") == "system")
+            stats.inc("hierarchy" if is_hierarchy else "completion")
+
+            latency = config.latency_seconds()
+            if config.error_rate and config.random.random() < config.error_rate:
+                stats.inc("errors_injected")
+                time.sleep(latency)
+                self._send_json(500, {"error": {"message": "Injected stub failure", "type": "server_error"}})
+                return
+
+            content = hierarchy_content(config) if is_hierarchy else completion_content(config)
+            prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+            usage = {
+                "prompt_tokens": config.prompt_tokens if config.prompt_tokens is not None else max(1, prompt_chars // 4),
+                "completion_tokens": config.completion_tokens,
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            model = body.get("model", "stub-model")
+
+            if body.get("stream"):
+                stats.inc("streamed")
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                self._stream(model, content, usage if include_usage else None, latency)
+                return
+
+            time.sleep(latency)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        def _stream(self, model: str, content: str, usage: Optional[Dict[str, int]], latency: float) -> None:
+            """Sends `content` word by word as SSE chunks, spreading `latency` across them."""
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+            pieces = [piece + " " for piece in content.split(" ")]
+            delay = latency / (len(pieces) + 1)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close") # No Content-Length: the stream ends when the socket closes
+            self.end_headers()
+
+            def send_chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, chunk_usage: Optional[Dict[str, int]] = None) -> None:
+                chunk = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if chunk_usage is None else [],
+                }
+                if chunk_usage is not None: chunk["usage"] = chunk_usage
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            time.sleep(delay) # Time to first token
+            send_chunk({"role": "assistant", "content": ""})
+            for piece in pieces:
+                time.sleep(delay)
+                send_chunk({"content": piece})
+            send_chunk({}, finish_reason="stop")
+            if usage is not None:
+                send_chunk({}, chunk_usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return StubRequestHandler
+
+
+class StubOpenAIServer:
+    """Threaded stub server; `start()` serves in a daemon thread and returns the base URL."""
+    def __init__(self, config: StubConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.stats = StubStats()
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(config, self.stats))
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="stub-openai", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="Stub response latency per LLM call (default: 100)")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform +/- jitter added to the latency (default: 0)")
+    parser.add_argument("--completion-tokens", type=int, default=64, help="Completion tokens per response (default: 64)")
+    parser.add_argument("--prompt-tokens", type=int, default=None, help="Fixed prompt token count (default: estimated from the request)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500 (default: 0)")
+    parser.add_argument("--agents", type=int, default=3, help="Agents in the generated hierarchy (default: 3)")
+    parser.add_argument("--agents-per-level", type=int, default=1, help="Agents sharing each hierarchy level (default: 1)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for jitter, errors and filler text")
+
+def stub_config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, completion_tokens=args.completion_tokens,
+        prompt_tokens=args.prompt_tokens, error_rate=args.error_rate, agents=args.agents,
+        agents_per_level=args.agents_per_level, seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline stub of the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    server = StubOpenAIServer(stub_config_from_args(args), host=args.host, port=args.port)
+    print(f" * Stub OpenAI API on {server.base_url} (Press CTRL+C to quit)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Stub server stopped.")
@@ -0,0 +1,565 @@
+"""
+Run registry: the Redis database (RUN_REGISTRY_URL) holding the state that several
+server workers or nodes must share in multi-worker mode.
+
+- RunRegistry: owner, status and queue position of each run, single-flight claims.
+- RunEventLog / RedisRunEventLog: the per-run event buffers join_room replays.
+- RedisResults: the Redis layout behind app.RedisResultStore.
+- RedisRateBuckets, RedisHierarchyEntries, RedisSimilarityFeed, RedisModelHealth,
+  RedisSubscriberCounts: shared backends of app's rate limiter, hierarchy cache,
+  similarity index, model router and msgpack subscriber counts. Those classes keep
+  their process-local state and fall back to it when a backend call raises.
+
+This module only needs redis-py (when a registry is configured); app.py imports it.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+KEY_PREFIX = os.getenv("RUN_REGISTRY_KEY_PREFIX", "crew:")
+
+
+def connect(url: str, worker_id: str, timeout: float = 5.0):
+    """
+    Returns a Redis client for the run registry at `url`, or None when it is unset or
+    unreachable (run state then stays local to this process, as with a single worker).
+    """
+    if not url: return None
+    try:
+        import redis # Only needed in multi-worker mode
+        client = redis.Redis.from_url(url, socket_connect_timeout=timeout, socket_timeout=timeout, health_check_interval=30)
+        client.ping()
+        print(f"--- Run registry connected at {url} (worker {worker_id}) ---")
+        return client
+    except Exception as e:
+        print(f"Warning: Could not connect to the run registry at {url}: {e}. Run state stays local to this process.")
+        return None
+
+def registry_key(*parts: str) -> str:
+    return KEY_PREFIX + ":".join(parts)
+
+
+# --- Run State ---
+class RunRegistry:
+    """
+    Run state published to the run registry so every worker can answer for runs
+    it is not executing: the owning worker, status and queue position of each run,
+    and the single-flight claims of in-flight task keys. Writes are best effort:
+    a registry outage degrades to per-worker behaviour instead of failing runs.
+    """
+    # Atomic get-or-set and compare-and-delete for single-flight claims
+    _CLAIM_SCRIPT = "local owner = redis.call('get', KEYS[1]) if owner then return owner end redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2]) return false"
+    _RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, client: Any, worker_id: str, ttl_seconds: int = 24 * 3600, flight_ttl_seconds: int = 1800):
+        self.client = client
+        self.worker_id = worker_id
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self.flight_ttl_seconds = max(1, int(flight_ttl_seconds))
+        self.errors = 0
+
+    def _failed(self, action: str, e: Exception) -> None:
+        self.errors += 1
+        print(f"Warning: Run registry {action} failed: {e}")
+
+    def set_run_state(self, run_id: str, status: str, **fields: Any) -> None:
+        state = dict(fields, status=status, worker=self.worker_id, updated_at=round(time.time(), 4))
+        key = registry_key("run", run_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(key, mapping={name: json.dumps(value) for name, value in state.items()})
+            pipe.expire(key, self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            self._failed(f"update of run {run_id} to '{status}'", e)
+
+    def get_run_state(self, run_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = self.client.hgetall(registry_key("run", run_id))
+        except Exception as e:
+            self._failed(f"read of run {run_id}", e)
+            return None
+        return {name.decode('utf-8'): json.loads(value) for name, value in raw.items()} or None
+
+    def queue_position(self, run_id: str) -> Optional[int]:
+        """Same contract as RunScheduler.queue_position, for a run on any worker."""
+        state = self.get_run_state(run_id)
+        if state is None or state.get("status") not in ("queued", "running"): return None
+        return state.get("queue_position", 0)
+
+    @staticmethod
+    def _flight_key(key: tuple) -> str:
+        return registry_key("flight", hashlib.sha256(json.dumps(key, default=str).encode('utf-8')).hexdigest())
+
+    def claim_flight(self, key: tuple, run_id: str) -> Optional[str]:
+        """Returns None if `run_id` now owns `key` on every worker, else the run_id that already does."""
+        try:
+            owner = self.client.eval(self._CLAIM_SCRIPT, 1, self._flight_key(key), run_id, self.flight_ttl_seconds)
+        except Exception as e:
+            self._failed("single-flight claim", e)
+            return None
+        return owner.decode('utf-8') if owner else None
+
+    def release_flight(self, key: tuple, run_id: str) -> None:
+        try:
+            self.client.eval(self._RELEASE_SCRIPT, 1, self._flight_key(key), run_id)
+        except Exception as e:
+            self._failed("single-flight release", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "ttl_seconds": self.ttl_seconds,
+            "flight_ttl_seconds": self.flight_ttl_seconds,
+            "errors": self.errors,
+        }
+
+
+# --- Run Event Log (Resume Support) ---
+class RunEventLog:
+    """
+    Bounded ring buffer of emitted events per run, each tagged with a monotonically
+    increasing `seq`. Lets `join_room` replay what a late or reconnecting client missed.
+    Buffers for the least recently active runs are dropped beyond `max_runs`.
+    """
+    def __init__(self, max_events_per_run: int = 1000, max_runs: int = 200):
+        self.max_events_per_run = max(1, max_events_per_run)
+        self.max_runs = max(1, max_runs)
+        self._runs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, run_id: str, create: bool) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._runs.get(run_id)
+            if entry is None:
+                if not create: return None
+                entry = {"lock": threading.RLock(), "events": deque(maxlen=self.max_events_per_run), "last_seq": 0}
+                self._runs[run_id] = entry
+                while len(self._runs) > self.max_runs:
+                    self._runs.popitem(last=False)
+            else:
+                self._runs.move_to_end(run_id)
+            return entry
+
+    def lock_for(self, run_id: str, create: bool = True):
+        """
+        Per-run lock held while an event is sequenced+emitted and while a joiner is
+        subscribed+replayed, so a resuming client sees no gaps and no reordering.
+        Returns None for unknown runs when `create` is False.
+        """
+        entry = self._entry(run_id, create)
+        return entry["lock"] if entry else None
+
+    def next_seq(self, run_id: str) -> int:
+        entry = self._entry(run_id, create=True)
+        with entry["lock"]:
+            entry["last_seq"] += 1
+            return entry["last_seq"]
+
+    def record(self, run_id: str, event: str, payload: Dict[str, Any]) -> None:
+        entry = self._entry(run_id, create=True)
+        with entry["lock"]:
+            entry["events"].append((payload.get("seq", 0), event, payload))
+            entry["last_seq"] = max(entry["last_seq"], payload.get("seq", 0))
+
+    def record_many(self, run_id: str, events: List[tuple]) -> None:
+        """Records already sequenced (event, payload) pairs, e.g. the log_updates of a relayed log_batch."""
+        for event, payload in events:
+            self.record(run_id, event, payload)
+
+    def sequence(self, run_id: str, event: str, data: Dict[str, Any], record: bool = True) -> Dict[str, Any]:
+        """
+        Returns `data` tagged with the run's next `seq` and the emit time `ts`, recorded
+        for replay unless `record` is False. Call under lock_for(run_id).
+        """
+        payload = dict(data, seq=self.next_seq(run_id), ts=round(time.time(), 4))
+        if record:
+            self.record(run_id, event, payload)
+        return payload
+
+    def events_since(self, run_id: str, since_seq: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns {"events": [(seq, event, payload)...], "last_seq", "truncated"} for events
+        after `since_seq`, or None if nothing is buffered for the run. `truncated` means
+        some requested events were already evicted from the ring buffer.
+        """
+        entry = self._entry(run_id, create=False)
+        if entry is None: return None
+        with entry["lock"]:
+            buffered = list(entry["events"])
+            last_seq = entry["last_seq"]
+        missed = [item for item in buffered if item[0] > since_seq]
+        oldest_seq = buffered[0][0] if buffered else last_seq + 1
+        return {"events": missed, "last_seq": last_seq, "truncated": since_seq + 1 < oldest_seq}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "runs": len(self._runs),
+                "max_runs": self.max_runs,
+                "max_events_per_run": self.max_events_per_run,
+                "buffered_events": sum(len(entry["events"]) for entry in self._runs.values()),
+            }
+
+class RedisRunEventLog(RunEventLog):
+    """
+    RunEventLog whose seq counters and event buffers live in the run registry, so a
+    client can resume a run through any worker. Per-run locks stay process-local: they
+    order sequencing and emits inside the worker executing the run. A joiner on another
+    worker subscribes before it replays, so a live event can reach it ahead of replayed
+    ones; clients drop repeats by `seq`.
+    Buffered entries are JSON [seq, event, payload]; `sequence` stores the payload without
+    its seq (the script assigns it), and `events_since` puts it back.
+    """
+    # KEYS: seq counter, event list. ARGV: ttl_seconds, max events, JSON `"event", payload` ('' = sequence only).
+    # Assigns and records the next seq in one round trip.
+    _SEQUENCE_SCRIPT = """
+    local seq = redis.call('INCR', KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    if ARGV[3] ~= '' then
+        redis.call('RPUSH', KEYS[2], '[' .. seq .. ',' .. ARGV[3] .. ']')
+        redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+        redis.call('EXPIRE', KEYS[2], ARGV[1])
+    end
+    return seq
+    """
+
+    def __init__(self, client: Any, max_events_per_run: int = 1000, max_runs: int = 200, ttl_seconds: int = 24 * 3600):
+        super().__init__(max_events_per_run, max_runs)
+        self.client = client
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self._sequence_script = client.register_script(self._SEQUENCE_SCRIPT)
+
+    def lock_for(self, run_id: str, create: bool = True):
+        lock = super().lock_for(run_id, create)
+        if lock is None and self.client.exists(registry_key("events", run_id)):
+            lock = super().lock_for(run_id, create=True) # Run executing on another worker: a local lock still serializes joiners here
+        return lock
+
+    def next_seq(self, run_id: str) -> int:
+        seq_key = registry_key("seq", run_id)
+        pipe = self.client.pipeline()
+        pipe.incr(seq_key)
+        pipe.expire(seq_key, self.ttl_seconds)
+        return pipe.execute()[0]
+
+    def record(self, run_id: str, event: str, payload: Dict[str, Any]) -> None:
+        self.record_many(run_id, [(event, payload)])
+
+    def record_many(self, run_id: str, events: List[tuple]) -> None:
+        if not events: return
+        self._entry(run_id, create=True) # Local lock/LRU bookkeeping only; the events go to Redis
+        events_key = registry_key("events", run_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(events_key, *[json.dumps([payload.get("seq", 0), event, payload], default=str) for event, payload in events])
+        pipe.ltrim(events_key, -self.max_events_per_run, -1)
+        pipe.expire(events_key, self.ttl_seconds)
+        pipe.execute()
+
+    def sequence(self, run_id: str, event: str, data: Dict[str, Any], record: bool = True) -> Dict[str, Any]:
+        ts = round(time.time(), 4)
+        entry_tail = ""
+        if record:
+            self._entry(run_id, create=True)
+            entry_tail = json.dumps([event, dict(data, ts=ts)], default=str)[1:-1]
+        seq = self._sequence_script(keys=[registry_key("seq", run_id), registry_key("events", run_id)],
+                                    args=[self.ttl_seconds, self.max_events_per_run, entry_tail])
+        return dict(data, seq=int(seq), ts=ts)
+
+    def events_since(self, run_id: str, since_seq: int) -> Optional[Dict[str, Any]]:
+        pipe = self.client.pipeline()
+        pipe.lrange(registry_key("events", run_id), 0, -1)
+        pipe.get(registry_key("seq", run_id))
+        raw_events, last_seq = pipe.execute()
+        if not raw_events and last_seq is None: return None
+        buffered = []
+        for raw in raw_events:
+            seq, event, payload = json.loads(raw)
+            buffered.append((seq, event, payload if "seq" in payload else dict(payload, seq=seq)))
+        last_seq = int(last_seq or 0)
+        missed = [item for item in buffered if item[0] > since_seq]
+        oldest_seq = buffered[0][0] if buffered else last_seq + 1
+        return {"events": missed, "last_seq": last_seq, "truncated": since_seq + 1 < oldest_seq}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            local_runs = len(self._runs)
+        return {"backend": "redis", "local_runs": local_runs, "max_events_per_run": self.max_events_per_run, "ttl_seconds": self.ttl_seconds}
+
+
+# --- Shared Backends ---
+class RedisResults:
+    """
+    Run results shared by every worker and node: a hash per run (status, result JSON),
+    a sorted set of run ids by created_at, and a hash of summary JSON for /results pages
+    and retention sweeps.
+    """
+    def __init__(self, client: Any):
+        self.client = client
+        self._index_key = registry_key("results", "by_created_at")
+        self._summaries_key = registry_key("results", "summaries")
+
+    @staticmethod
+    def _result_key(run_id: str) -> str:
+        return registry_key("result", run_id)
+
+    def write(self, run_id: str, status: str, json_bytes: bytes, summary: Dict[str, Any]) -> None:
+        pipe = self.client.pipeline()
+        pipe.hset(self._result_key(run_id), mapping={"status": status, "json": json_bytes})
+        pipe.zadd(self._index_key, {run_id: summary["created_at"]})
+        pipe.hset(self._summaries_key, run_id, json.dumps(summary))
+        pipe.execute()
+
+    def read(self, run_id: str) -> Optional[tuple]:
+        """Returns (status, result JSON bytes), or None for unknown runs."""
+        status, json_bytes = self.client.hmget(self._result_key(run_id), "status", "json")
+        if json_bytes is None: return None
+        return status.decode('utf-8'), json_bytes
+
+    def exists(self, run_id: str) -> bool:
+        return bool(self.client.exists(self._result_key(run_id)))
+
+    def run_ids(self) -> List[str]:
+        return [member.decode('utf-8') for member in self.client.zrange(self._index_key, 0, -1)]
+
+    def count(self) -> int:
+        return self.client.zcard(self._index_key)
+
+    def query(self, limit: int, after: Optional[tuple] = None, status: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              min_cost: Optional[float] = None, min_tokens: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Up to `limit` + 1 matching summaries, newest first, strictly before the (created_at, run_id) `after`."""
+        bounds = [bound for bound in (until, after[0] if after else None) if bound is not None]
+        max_score = min(bounds) if bounds else "+inf"
+        min_score = since if since is not None else "-inf"
+        page: List[Dict[str, Any]] = []
+        offset, chunk = 0, max(limit + 1, 100)
+        # Equal scores come back in descending run_id order, matching the (created_at, run_id) cursor
+        while len(page) <= limit:
+            run_ids = self.client.zrevrangebyscore(self._index_key, max_score, min_score, start=offset, num=chunk)
+            if not run_ids: break
+            offset += len(run_ids)
+            for raw in self.client.hmget(self._summaries_key, run_ids):
+                if raw is None: continue # Pruned between the two reads
+                summary = json.loads(raw)
+                if after is not None and (summary["created_at"], summary["run_id"]) >= after: continue
+                if status and summary["status"] != status: continue
+                if min_cost is not None and summary["estimated_cost_usd"] < min_cost: continue
+                if min_tokens is not None and summary["total_tokens"] < min_tokens: continue
+                page.append(summary)
+                if len(page) > limit: break
+        return page
+
+    def stale_run_ids(self, retention_seconds: float = 0, max_runs: int = 0) -> List[str]:
+        """Run ids past the retention window, then the oldest beyond `max_runs`."""
+        stale: List[str] = []
+        if retention_seconds:
+            cutoff = time.time() - retention_seconds
+            stale += [member.decode('utf-8') for member in self.client.zrangebyscore(self._index_key, "-inf", f"({cutoff}")]
+        if max_runs:
+            overflow = self.client.zcard(self._index_key) - len(stale) - max_runs
+            if overflow > 0:
+                # The expired runs are the oldest ones, so the next `overflow` follow them in the index
+                stale += [member.decode('utf-8') for member in self.client.zrange(self._index_key, len(stale), len(stale) + overflow - 1)]
+        return stale
+
+    def remove(self, run_ids: List[str]) -> None:
+        if not run_ids: return
+        pipe = self.client.pipeline()
+        pipe.zrem(self._index_key, *run_ids)
+        pipe.hdel(self._summaries_key, *run_ids)
+        pipe.delete(*[self._result_key(run_id) for run_id in run_ids])
+        pipe.execute()
+
+class RedisRateBuckets:
+    """
+    RPM/TPM token buckets of app.ModelRateLimiter shared by every process. Each call
+    refills and updates both buckets of a model in one Lua call on the Redis clock.
+    """
+    # KEYS: requests bucket, tokens bucket. ARGV: mode (acquire | try | credit | peek), then rpm, requests, tpm, tokens.
+    # Returns {wait seconds, or -1 when "try" would have to wait; requests level; tokens level} as strings.
+    _BUCKETS_SCRIPT = """
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local mode = ARGV[1]
+    local per_minute, amounts, levels = {}, {}, {}
+    for i = 1, 2 do
+        per_minute[i] = tonumber(ARGV[2 * i])
+        amounts[i] = tonumber(ARGV[2 * i + 1])
+        levels[i] = per_minute[i]
+        local state = redis.call('HMGET', KEYS[i], 'level', 'updated')
+        if per_minute[i] > 0 and state[1] then
+            levels[i] = math.min(per_minute[i], tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * per_minute[i] / 60)
+        end
+        if mode ~= 'credit' then amounts[i] = math.min(amounts[i], per_minute[i]) end
+    end
+    if mode == 'try' then
+        for i = 1, 2 do
+            if per_minute[i] > 0 and levels[i] < amounts[i] then
+                return {'-1', tostring(levels[1]), tostring(levels[2])}
+            end
+        end
+    end
+    local wait = 0
+    for i = 1, 2 do
+        if per_minute[i] > 0 then
+            if mode == 'credit' then
+                levels[i] = math.min(per_minute[i], levels[i] + amounts[i])
+            elseif mode ~= 'peek' then
+                levels[i] = levels[i] - amounts[i]
+                if levels[i] < 0 then wait = math.max(wait, -levels[i] * 60 / per_minute[i]) end
+            end
+            redis.call('HSET', KEYS[i], 'level', tostring(levels[i]), 'updated', tostring(now))
+            -- Idle buckets refill completely, so they can expire once full
+            redis.call('PEXPIRE', KEYS[i], math.ceil((per_minute[i] - levels[i]) * 60000 / per_minute[i]) + 1000)
+        end
+    end
+    return {tostring(wait), tostring(levels[1]), tostring(levels[2])}
+    """
+
+    def __init__(self, client: Any):
+        self.client = client
+        self._script = client.register_script(self._BUCKETS_SCRIPT)
+
+    def update(self, model: str, mode: str, rpm: float, requests_amount: float, tpm: float, tokens_amount: float) -> tuple:
+        """
+        Modes: "acquire" debits (buckets may go into debt), "try" debits only if nothing would
+        wait, "credit" adds the amounts back, "peek" only refills. A limit <= 0 is unlimited.
+        Returns (wait seconds or -1 for a refused "try", requests level, tokens level).
+        """
+        keys = [registry_key("ratelimit", model, "requests"), registry_key("ratelimit", model, "tokens")]
+        return tuple(float(value) for value in self._script(keys=keys, args=[mode, rpm, requests_amount, tpm, tokens_amount]))
+
+class RedisHierarchyEntries:
+    """
+    Hierarchy cache entries of app.HierarchyCache shared by every worker: strings that
+    expire after the TTL, bounded to `max_entries` by a sorted set of last use.
+    """
+    def __init__(self, client: Any):
+        self.client = client
+        self._lru_key = registry_key("hierarchy", "lru")
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> tuple:
+        """Returns (hierarchy JSON or None, whether a missing entry had expired); touches hits."""
+        digest = self._digest(key)
+        pipe = self.client.pipeline()
+        pipe.get(registry_key("hierarchy", digest))
+        pipe.zadd(self._lru_key, {digest: time.time()}, xx=True, ch=True) # Touches the entry if it is indexed
+        raw, indexed = pipe.execute()
+        if raw is None:
+            if indexed: self.client.zrem(self._lru_key, digest) # Expired by its TTL
+            return None, bool(indexed)
+        return raw.decode('utf-8'), False
+
+    def put(self, key: str, value: str, ttl_seconds: float, max_entries: int) -> int:
+        """Stores an entry; returns how many least recently used ones were evicted."""
+        digest = self._digest(key)
+        pipe = self.client.pipeline()
+        pipe.set(registry_key("hierarchy", digest), value, ex=max(1, int(ttl_seconds)) if ttl_seconds > 0 else None)
+        pipe.zadd(self._lru_key, {digest: time.time()})
+        pipe.zcard(self._lru_key)
+        overflow = pipe.execute()[2] - max_entries
+        if overflow <= 0: return 0
+        oldest = self.client.zrange(self._lru_key, 0, overflow - 1)
+        pipe = self.client.pipeline()
+        pipe.zrem(self._lru_key, *oldest)
+        pipe.delete(*[registry_key("hierarchy", member.decode('utf-8')) for member in oldest])
+        pipe.execute()
+        return len(oldest)
+
+    def size(self) -> int:
+        return self.client.zcard(self._lru_key)
+
+    def clear(self) -> None:
+        members = self.client.zrange(self._lru_key, 0, -1)
+        self.client.delete(self._lru_key, *[registry_key("hierarchy", member.decode('utf-8')) for member in members])
+
+class RedisSimilarityFeed:
+    """
+    Capped stream of the (task description, hierarchy JSON) entries added to
+    app.HierarchySimilarityIndex by any worker; each process reads the entries
+    it has not seen yet into its local index.
+    """
+    def __init__(self, client: Any):
+        self.client = client
+        self._stream_key = registry_key("hierarchy_similarity", "entries")
+        self._last_id = b"0-0"
+        self._lock = threading.Lock()
+
+    def publish(self, task_description: str, hierarchy_json_str: str, max_entries: int) -> None:
+        self.client.xadd(self._stream_key, {"task": task_description, "hierarchy": hierarchy_json_str},
+                         maxlen=max_entries, approximate=True)
+
+    def read_new(self, count: int) -> List[tuple]:
+        """Entries added since the previous call, oldest first."""
+        with self._lock:
+            response = self.client.xread({self._stream_key: self._last_id}, count=count)
+            entries = response[0][1] if response else []
+            if entries: self._last_id = entries[-1][0]
+        return [(fields[b"task"].decode('utf-8'), fields[b"hierarchy"].decode('utf-8')) for _, fields in entries]
+
+class RedisModelHealth:
+    """Per-model call statistics of app.ModelRouter (calls, errors, EWMA latency) shared by every worker."""
+    # KEYS: model health hash. ARGV: ok (1/0), seconds, ewma_alpha, ttl_seconds.
+    _OBSERVE_SCRIPT = """
+    local clock = redis.call('TIME')
+    redis.call('HINCRBY', KEYS[1], 'calls', 1)
+    redis.call('HSET', KEYS[1], 'last_observed', tostring(tonumber(clock[1]) + tonumber(clock[2]) / 1000000))
+    if ARGV[1] == '1' then
+        local seconds = tonumber(ARGV[2])
+        local previous = redis.call('HGET', KEYS[1], 'ewma_latency')
+        if previous then seconds = tonumber(previous) + tonumber(ARGV[3]) * (seconds - tonumber(previous)) end
+        redis.call('HSET', KEYS[1], 'ewma_latency', tostring(seconds))
+    else
+        redis.call('HINCRBY', KEYS[1], 'errors', 1)
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    """
+
+    def __init__(self, client: Any, ttl_seconds: int = 24 * 3600):
+        self.client = client
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self._observe_script = client.register_script(self._OBSERVE_SCRIPT)
+
+    def observe(self, model: str, seconds: float, ok: bool, ewma_alpha: float) -> None:
+        self._observe_script(keys=[registry_key("model_health", model)], args=[1 if ok else 0, seconds, ewma_alpha, self.ttl_seconds])
+
+    def read(self, model: str) -> Dict[str, Any]:
+        """{"calls", "errors", "ewma_latency", "idle_seconds"} of a model, or {} if it was never observed."""
+        pipe = self.client.pipeline()
+        pipe.hmget(registry_key("model_health", model), "calls", "errors", "ewma_latency", "last_observed")
+        pipe.time()
+        (calls, errors, latency, last_observed), (seconds, microseconds) = pipe.execute()
+        if calls is None: return {}
+        return {"calls": int(calls), "errors": int(errors or 0), "ewma_latency": float(latency) if latency is not None else None,
+                "idle_seconds": seconds + microseconds / 1e6 - float(last_observed or 0)}
+
+    def reset(self, model: str) -> None:
+        pipe = self.client.pipeline()
+        pipe.hset(registry_key("model_health", model), mapping={"calls": 0, "errors": 0})
+        pipe.hdel(registry_key("model_health", model), "ewma_latency")
+        pipe.execute()
+
+class RedisSubscriberCounts:
+    """Msgpack subscribers per run on every worker, for app.MsgpackSubscribers."""
+    def __init__(self, client: Any, ttl_seconds: int = 24 * 3600):
+        self.client = client
+        self.ttl_seconds = max(1, int(ttl_seconds))
+        self._key = registry_key("msgpack_subscribers")
+
+    def add(self, run_id: str, delta: int) -> None:
+        pipe = self.client.pipeline()
+        pipe.hincrby(self._key, run_id, delta)
+        pipe.expire(self._key, self.ttl_seconds)
+        if pipe.execute()[0] <= 0: self.client.hdel(self._key, run_id)
+
+    def count(self, run_id: str) -> int:
+        return int(self.client.hget(self._key, run_id) or 0)
@@ -0,0 +1,24 @@
+"""
+Shared test setup: app is imported in ASGI mode (no eventlet monkey patching) with
+process-local state, and Redis-backed classes are exercised against fakeredis.
+"""
+import os
+import sys
+
+os.environ["SERVER_MODE"] = "asgi"
+os.environ["SOCKETIO_MESSAGE_QUEUE"] = ""
+os.environ["RUN_REGISTRY_URL"] = ""
+os.environ["RESULT_STORE_BACKEND"] = "memory"
+os.environ["COMPLETION_CACHE_PATH"] = ""
+os.environ["CREW_EXECUTOR_MODE"] = "inline"
+os.environ["WEB_CONCURRENCY"] = "1"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis
+import pytest
+
+
+@pytest.fixture
+def redis_client():
+    """In-process Redis with Lua support (fakeredis[lua]); every test gets an empty server."""
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
@@ -0,0 +1,61 @@
+"""Process-local HierarchyCache: key normalization, TTL expiry and LRU eviction."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_near_identical_prompts_share_an_entry():
+    cache = app.HierarchyCache()
+    cache.put("Write a  Report!", '{"agents": []}')
+    assert cache.get("write a report") == '{"agents": []}'
+    assert cache.get("write a different report") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = app.HierarchyCache(ttl_seconds=60)
+    cache.put("task", "{}")
+    clock[0] += 60
+    assert cache.get("task") == "{}"
+    clock[0] += 1
+    assert cache.get("task") is None
+    stats = cache.stats()
+    assert stats["expirations"] == 1 and stats["size"] == 0
+
+
+def test_zero_ttl_never_expires(clock):
+    cache = app.HierarchyCache(ttl_seconds=0)
+    cache.put("task", "{}")
+    clock[0] += 10 ** 6
+    assert cache.get("task") == "{}"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = app.HierarchyCache(max_entries=2)
+    cache.put("first", "1")
+    cache.put("second", "2")
+    assert cache.get("first") == "1" # "second" is now the least recently used
+    cache.put("third", "3")
+    assert cache.get("second") is None
+    assert cache.get("first") == "1" and cache.get("third") == "3"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_put_refreshes_an_existing_entry(clock):
+    cache = app.HierarchyCache(max_entries=2, ttl_seconds=60)
+    cache.put("first", "old")
+    cache.put("second", "2")
+    clock[0] += 50
+    cache.put("first", "new") # Moves to the most recent end and restarts its TTL
+    cache.put("third", "3")
+    clock[0] += 30
+    assert cache.get("first") == "new"
+    assert cache.get("second") is None
@@ -0,0 +1,47 @@
+"""HierarchyStreamParser: agent objects and their array indexes from a streamed completion."""
+import json
+
+import pytest
+
+import app
+
+HIERARCHY = [
+    {"agent_name": "Planner", "role": "Plan {the} work, [carefully]", "level": 1},
+    {"agent_name": "Writer", "role": "Say \"hi\", then \\ write", "tools": [{"name": "search"}, "notes"], "level": 2},
+    {"agent_name": "Reviewer", "role": "Review", "level": 2},
+]
+
+
+def feed_in_chunks(text: str, size: int) -> tuple:
+    parser = app.HierarchyStreamParser()
+    completed = []
+    for start in range(0, len(text), size):
+        completed += parser.feed(text[start:start + size])
+    return completed, parser
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_objects_come_out_with_their_array_index_whatever_the_chunking(size):
+    text = "Here is the hierarchy:\n```json\n" + json.dumps(HIERARCHY, indent=2) + "\n```"
+    completed, parser = feed_in_chunks(text, size)
+    assert completed == list(enumerate(HIERARCHY))
+    assert parser.finished
+
+
+def test_indexes_count_non_object_elements():
+    elements = ["a note", {"agent_name": "First"}, 42, ["nested", {"not": "an agent"}], {"agent_name": "Second"}]
+    completed, _ = feed_in_chunks(json.dumps(elements), 2)
+    assert completed == [(1, elements[1]), (4, elements[4])]
+
+
+def test_invalid_objects_are_skipped_without_shifting_later_indexes():
+    text = '[{"agent_name": "Broken", "level": }, {"agent_name": "Fine"}]'
+    completed, _ = feed_in_chunks(text, 5)
+    assert completed == [(1, {"agent_name": "Fine"})]
+
+
+def test_text_after_the_closing_bracket_is_ignored():
+    completed, parser = feed_in_chunks('[{"agent_name": "Only"}] and then {"agent_name": "Ignored"}', 4)
+    assert completed == [(0, {"agent_name": "Only"})]
+    assert parser.finished
+    assert parser.feed('{"agent_name": "Late"}') == []
@@ -0,0 +1,171 @@
+"""ResilientRequester: circuit breaker, hedge/retry quota reservations and backoff, with stubbed sends."""
+import asyncio
+import time
+
+import pytest
+
+import app
+
+
+class StubResponse:
+    def __init__(self, status_code: int = 200, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+
+class TransportError(Exception):
+    """Stands in for httpx.TransportError: retried by post_async."""
+
+
+def requester(**kwargs) -> app.ResilientRequester:
+    settings = dict(hedge_enabled=False, max_attempts=1, backoff_base=0.0, failure_threshold=2, reset_seconds=60.0)
+    settings.update(kwargs)
+    return app.ResilientRequester("test API", **settings)
+
+
+def post(requester: app.ResilientRequester, send, reserve_extra=None):
+    return asyncio.run(requester.post_async(send, retry_errors=(TransportError,), reserve_extra=reserve_extra))
+
+
+async def failing_send():
+    raise TransportError("connection reset")
+
+
+async def ok_send():
+    return StubResponse(200)
+
+
+# --- Circuit breaker ---
+def test_breaker_opens_after_consecutive_failures_and_fails_fast():
+    breaker = requester()
+    for _ in range(2):
+        with pytest.raises(TransportError):
+            post(breaker, failing_send)
+    assert breaker.stats()["breaker"]["state"] == "open"
+
+    sends = []
+    async def counted_send():
+        sends.append(1)
+        return StubResponse(200)
+    with pytest.raises(app.CircuitOpenError):
+        post(breaker, counted_send)
+    assert sends == []
+    assert breaker.stats()["short_circuited"] == 1 and breaker.stats()["breaker_opened"] == 1
+
+
+def test_breaker_half_open_probe_closes_or_reopens():
+    breaker = requester(reset_seconds=0.05)
+    for _ in range(2):
+        with pytest.raises(TransportError):
+            post(breaker, failing_send)
+    time.sleep(0.06)
+    with pytest.raises(TransportError):
+        post(breaker, failing_send) # The probe fails: open again right away
+    assert breaker.stats()["breaker"]["state"] == "open" and breaker.stats()["breaker_opened"] == 2
+
+    time.sleep(0.06)
+    assert post(breaker, ok_send).status_code == 200
+    stats = breaker.stats()["breaker"]
+    assert stats["state"] == "closed" and stats["consecutive_failures"] == 0
+
+
+def test_non_transient_client_errors_do_not_trip_the_breaker():
+    breaker = requester(failure_threshold=1)
+    async def bad_request():
+        return StubResponse(400)
+    for _ in range(3):
+        assert post(breaker, bad_request).status_code == 400
+    assert breaker.stats()["breaker"]["state"] == "closed"
+
+
+# --- Quota for extra requests ---
+def test_hedge_takes_non_blocking_quota_and_can_win():
+    hedging = requester(hedge_enabled=True, initial_hedge_delay=0.01)
+    reservations = []
+    def reserve_extra(blocking):
+        reservations.append(blocking)
+        return True
+    primary, hedge = StubResponse(200), StubResponse(200)
+    responses = [primary, hedge]
+    async def send():
+        response = responses.pop(0)
+        if response is primary:
+            await asyncio.sleep(1.0) # Slow enough to be hedged, and cancelled once the hedge wins
+        return response
+
+    assert post(hedging, send, reserve_extra) is hedge
+    assert reservations == [False]
+    stats = hedging.stats()
+    assert stats["hedges_sent"] == 1 and stats["hedge_wins"] == 1 and stats["attempts"] == 2
+
+
+def test_hedge_is_skipped_when_quota_is_refused():
+    hedging = requester(hedge_enabled=True, initial_hedge_delay=0.01)
+    reservations = []
+    def reserve_extra(blocking):
+        reservations.append(blocking)
+        return False
+    async def slow_send():
+        await asyncio.sleep(0.05)
+        return StubResponse(200)
+
+    assert post(hedging, slow_send, reserve_extra).status_code == 200
+    assert reservations == [False]
+    assert hedging.stats()["hedges_sent"] == 0 and hedging.stats()["attempts"] == 1
+
+
+def test_retries_take_blocking_quota_and_close_transient_responses():
+    retrying = requester(max_attempts=3)
+    reservations = []
+    def reserve_extra(blocking):
+        reservations.append(blocking)
+        return True
+    transient = StubResponse(503)
+    results = [TransportError("timeout"), transient, StubResponse(200)]
+    async def send():
+        result = results.pop(0)
+        if isinstance(result, Exception): raise result
+        return result
+
+    assert post(retrying, send, reserve_extra).status_code == 200
+    assert reservations == [True, True]
+    assert transient.closed
+    assert retrying.stats()["retries"] == 2 and retrying.stats()["succeeded"] == 1
+
+
+def test_exhausted_retries_return_the_last_transient_response():
+    retrying = requester(max_attempts=2, failure_threshold=5)
+    async def unavailable():
+        return StubResponse(503)
+    assert post(retrying, unavailable).status_code == 503
+    assert retrying.stats()["failed"] == 1
+
+
+def test_sync_post_retries_transient_statuses(monkeypatch):
+    retrying = requester(max_attempts=2)
+    responses = [StubResponse(429, {"Retry-After": "3"}), StubResponse(200)]
+    sleeps = []
+    monkeypatch.setattr(app, "http_clients", type("StubClients", (), {"post": staticmethod(lambda url, **kwargs: responses.pop(0))}))
+    monkeypatch.setattr(app.time, "sleep", sleeps.append)
+
+    assert retrying.post("https://api.example/v1").status_code == 200
+    assert sleeps == [3.0] # Retry-After wins over the (zero) jittered backoff
+
+
+# --- Backoff ---
+def test_full_jitter_backoff_stays_within_bounds():
+    backoff = requester(backoff_base=0.5, max_backoff=4.0)
+    for attempt in range(6):
+        ceiling = min(4.0, 0.5 * 2 ** attempt)
+        delays = [backoff._backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        assert max(delays) > ceiling / 2 # Jitter spreads over the whole window
+    assert all(2.0 <= backoff._backoff(0, retry_after=2.0) <= 4.0 for _ in range(50))
+    assert backoff._backoff(0, retry_after=120) == 4.0 # Retry-After is capped at max_backoff
@@ -0,0 +1,54 @@
+"""/results/<run_id> HTTP helpers: fields projection, Accept-Encoding negotiation and If-None-Match."""
+import pytest
+
+import app
+
+
+# --- parse_fields_param ---
+def test_fields_are_sorted_and_deduplicated():
+    assert app.parse_fields_param("final_output, error,final_output") == ("error", "final_output")
+    assert app.parse_fields_param(None) is None
+
+
+@pytest.mark.parametrize("value", ["", " , ", "final-output", "task_flow.0", "1st"])
+def test_invalid_fields_are_rejected(value):
+    with pytest.raises(ValueError):
+        app.parse_fields_param(value)
+
+
+# --- negotiate_encoding ---
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip;q=0.5, br;q=0", "gzip"),
+    ("br;q=0, gzip;q=0", "identity"),
+    ("*", "br"),
+    ("*, br;q=0", "gzip"),
+    ("gzip;q=abc", "identity"),
+    ("", "identity"),
+    (None, "identity"),
+])
+def test_brotli_is_preferred_when_installed(monkeypatch, header, expected):
+    monkeypatch.setattr(app, "brotli", object())
+    assert app.negotiate_encoding(header) == expected
+
+
+def test_gzip_without_brotli(monkeypatch):
+    monkeypatch.setattr(app, "brotli", None)
+    assert app.negotiate_encoding("br, gzip") == "gzip"
+    assert app.negotiate_encoding("br") == "identity"
+    assert app.negotiate_encoding("GZIP") == "gzip"
+
+
+# --- etag_matches ---
+@pytest.mark.parametrize("header, matches", [
+    ('W/"abc"', True),
+    ('"abc"', True), # Weak comparison ignores the W/ prefix
+    ('"other", W/"abc"', True),
+    ('*', True),
+    ('"other"', False),
+    ('"ab"', False),
+    ("", False),
+    (None, False),
+])
+def test_weak_etag_comparison(header, matches):
+    assert app.etag_matches(header, 'W/"abc"') is matches
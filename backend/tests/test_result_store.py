@@ -0,0 +1,26 @@
+"""Process-local result store: /results paging order."""
+import uuid
+
+import app
+
+
+def result_data(run_id: str) -> dict:
+    return {"run_id": run_id, "task_description": f"Task for {run_id}", "final_output": "done", "agent_token_usage": {}, "error": None}
+
+
+def test_memory_store_pages_by_created_at_not_insertion_order(monkeypatch):
+    # Runs finishing concurrently are stamped before the store's lock, so they can be inserted out of order
+    created_at = iter([1_700_000_003.0, 1_700_000_001.0, 1_700_000_005.0, 1_700_000_002.0, 1_700_000_005.0, 1_700_000_004.0])
+    monkeypatch.setattr(app.time, "time", lambda: next(created_at))
+    store = app.MemoryResultStore()
+    run_ids = [str(uuid.uuid4()) for _ in range(6)]
+    for run_id in run_ids:
+        store.put(run_id, result_data(run_id))
+
+    paged, cursor = [], None
+    while True:
+        page, cursor = store.query_summaries(limit=2, cursor=cursor)
+        paged += [(summary["created_at"], summary["run_id"]) for summary in page]
+        if cursor is None: break
+    assert paged == sorted(paged, reverse=True)
+    assert sorted(run_id for _, run_id in paged) == sorted(run_ids)
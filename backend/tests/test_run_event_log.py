@@ -0,0 +1,56 @@
+"""Process-local RunEventLog: sequencing and since_seq replay for resuming clients."""
+from run_registry import RunEventLog
+
+
+def sequence_events(event_log: RunEventLog, run_id: str, count: int) -> list:
+    with event_log.lock_for(run_id):
+        return [event_log.sequence(run_id, "log_update", {"type": "status", "index": index}) for index in range(count)]
+
+
+def test_events_are_numbered_per_run():
+    event_log = RunEventLog()
+    first = sequence_events(event_log, "run-a", 3)
+    other = sequence_events(event_log, "run-b", 1)
+    assert [payload["seq"] for payload in first] == [1, 2, 3]
+    assert other[0]["seq"] == 1
+    assert all("ts" in payload for payload in first)
+
+
+def test_replay_returns_only_events_after_since_seq():
+    event_log = RunEventLog()
+    payloads = sequence_events(event_log, "run", 5)
+
+    replay = event_log.events_since("run", 2)
+    assert replay["events"] == [(seq, "log_update", payloads[seq - 1]) for seq in (3, 4, 5)]
+    assert replay["last_seq"] == 5 and not replay["truncated"]
+    assert event_log.events_since("run", 5)["events"] == []
+    assert event_log.events_since("unknown", 0) is None
+
+
+def test_replay_reports_events_evicted_from_the_ring_buffer():
+    event_log = RunEventLog(max_events_per_run=3)
+    sequence_events(event_log, "run", 5)
+
+    replay = event_log.events_since("run", 0)
+    assert [seq for seq, _, _ in replay["events"]] == [3, 4, 5]
+    assert replay["truncated"]
+    assert not event_log.events_since("run", 2)["truncated"]
+
+
+def test_unrecorded_events_advance_seq_without_being_replayed():
+    event_log = RunEventLog()
+    event_log.sequence("run", "llm_token", {"text": "partial"}, record=False)
+    recorded = event_log.sequence("run", "log_update", {"type": "status"})
+    replay = event_log.events_since("run", 0)
+    assert recorded["seq"] == 2
+    assert [seq for seq, _, _ in replay["events"]] == [2] and replay["last_seq"] == 2
+
+
+def test_least_recently_active_runs_are_dropped_beyond_max_runs():
+    event_log = RunEventLog(max_runs=2)
+    for run_id in ("a", "b"):
+        sequence_events(event_log, run_id, 1)
+    event_log.events_since("a", 0) # Touches "a"
+    sequence_events(event_log, "c", 1)
+    assert event_log.events_since("b", 0) is None
+    assert event_log.events_since("a", 0) is not None and event_log.lock_for("b", create=False) is None
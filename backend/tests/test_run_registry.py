@@ -0,0 +1,216 @@
+"""Multi-worker state kept in the run registry: results, run events, run state, rate limits and the hierarchy cache."""
+import itertools
+import threading
+import uuid
+
+import pytest
+
+import app
+import run_registry
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Strictly increasing time.time(), so result summaries get distinct created_at values."""
+    ticks = itertools.count(1_700_000_000)
+    monkeypatch.setattr(app.time, "time", lambda: float(next(ticks)))
+
+
+def new_run_id() -> str:
+    return str(uuid.uuid4())
+
+
+def result_data(run_id: str, error: str = None, total_tokens: int = 100) -> dict:
+    return {
+        "run_id": run_id,
+        "task_description": f"Task for {run_id}",
+        "final_output": "done",
+        "agent_token_usage": {"Agent_1": {"total_tokens": total_tokens, "estimated_cost_usd": total_tokens * 1e-6}},
+        "error": error,
+    }
+
+
+# --- RedisResultStore ---
+def test_result_store_shares_results_between_workers(redis_client):
+    writer = app.RedisResultStore(redis_client, hot_entries=4)
+    reader = app.RedisResultStore(redis_client, hot_entries=4)
+    run_id = new_run_id()
+    writer.put(run_id, result_data(run_id))
+
+    snapshot = reader.get_snapshot(run_id)
+    assert snapshot is not None and snapshot.status == "success"
+    assert snapshot.result["final_output"] == "done"
+    assert reader.contains(run_id) and not reader.contains(new_run_id())
+    assert reader.list_run_ids() == [run_id]
+    assert reader.count() == 1
+    assert reader.get_snapshot(new_run_id()) is None
+
+
+def test_result_store_pages_summaries_newest_first(redis_client, clock):
+    store = app.RedisResultStore(redis_client)
+    run_ids = [new_run_id() for _ in range(5)]
+    for index, run_id in enumerate(run_ids):
+        store.put(run_id, result_data(run_id, error="boom" if index == 2 else None, total_tokens=100 * (index + 1)))
+
+    first_page, cursor = store.query_summaries(limit=2)
+    assert [summary["run_id"] for summary in first_page] == run_ids[:2:-1]
+    second_page, cursor = store.query_summaries(limit=2, cursor=cursor)
+    assert [summary["run_id"] for summary in second_page] == [run_ids[2], run_ids[1]]
+    last_page, cursor = store.query_summaries(limit=2, cursor=cursor)
+    assert [summary["run_id"] for summary in last_page] == [run_ids[0]] and cursor is None
+
+    errors, _ = store.query_summaries(limit=10, status="error")
+    assert [summary["run_id"] for summary in errors] == [run_ids[2]]
+    large, _ = store.query_summaries(limit=10, min_tokens=400)
+    assert [summary["run_id"] for summary in large] == [run_ids[4], run_ids[3]]
+
+
+def test_result_store_prunes_oldest_runs_beyond_max_runs(redis_client, clock):
+    store = app.RedisResultStore(redis_client, hot_entries=0, max_runs=2, prune_every=1)
+    run_ids = [new_run_id() for _ in range(3)]
+    for run_id in run_ids:
+        store.put(run_id, result_data(run_id))
+
+    assert store.list_run_ids() == run_ids[1:]
+    assert store.get_snapshot(run_ids[0]) is None
+    assert store.evicted == 1
+
+
+# --- RedisRunEventLog ---
+def test_event_log_sequences_and_records_in_one_call(redis_client):
+    worker = run_registry.RedisRunEventLog(redis_client, max_events_per_run=10)
+    other_worker = run_registry.RedisRunEventLog(redis_client, max_events_per_run=10)
+    run_id = new_run_id()
+    with worker.lock_for(run_id):
+        first = worker.sequence(run_id, "log_update", {"type": "task_start", "data": {"items": []}})
+        second = worker.sequence(run_id, "run_complete", {"status": "success"})
+
+    assert (first["seq"], second["seq"]) == (1, 2)
+    assert first["data"] == {"items": []} and "ts" in first
+    replay = other_worker.events_since(run_id, 0)
+    assert replay["last_seq"] == 2 and not replay["truncated"]
+    assert replay["events"] == [(1, "log_update", first), (2, "run_complete", second)]
+    assert other_worker.events_since(run_id, 1)["events"] == [(2, "run_complete", second)]
+
+
+def test_event_log_sequence_without_record_only_advances_seq(redis_client):
+    event_log = run_registry.RedisRunEventLog(redis_client)
+    run_id = new_run_id()
+    assert event_log.sequence(run_id, "log_update", {"type": "llm_start"}, record=False)["seq"] == 1
+    replay = event_log.events_since(run_id, 0)
+    assert replay["events"] == [] and replay["last_seq"] == 1
+
+
+def test_event_log_records_relayed_batches_and_reports_truncation(redis_client):
+    event_log = run_registry.RedisRunEventLog(redis_client, max_events_per_run=3)
+    run_id = new_run_id()
+    batch = [{"type": "llm_stream", "seq": seq, "ts": 0.0} for seq in range(1, 6)]
+    event_log.record_many(run_id, [("log_update", item) for item in batch])
+    redis_client.set(run_registry.registry_key("seq", run_id), 5) # Sequenced by the crew worker
+
+    replay = event_log.events_since(run_id, 0)
+    assert [seq for seq, _, _ in replay["events"]] == [3, 4, 5]
+    assert replay["truncated"]
+    assert not event_log.events_since(run_id, 2)["truncated"]
+
+
+def test_event_log_lock_for_runs_on_other_workers(redis_client):
+    worker = run_registry.RedisRunEventLog(redis_client)
+    other_worker = run_registry.RedisRunEventLog(redis_client)
+    run_id = new_run_id()
+    assert other_worker.lock_for(run_id, create=False) is None
+    worker.sequence(run_id, "log_update", {"type": "task_start"})
+    assert other_worker.lock_for(run_id, create=False) is not None
+    assert other_worker.events_since(new_run_id(), 0) is None
+
+
+# --- RunRegistry ---
+def test_run_registry_publishes_run_state(redis_client):
+    registry = run_registry.RunRegistry(redis_client, "worker-a")
+    other = run_registry.RunRegistry(redis_client, "worker-b")
+    run_id = new_run_id()
+    registry.set_run_state(run_id, "queued", queue_position=3)
+
+    state = other.get_run_state(run_id)
+    assert state["status"] == "queued" and state["worker"] == "worker-a"
+    assert other.queue_position(run_id) == 3
+    registry.set_run_state(run_id, "completed")
+    assert other.queue_position(run_id) is None
+    assert other.get_run_state(new_run_id()) is None
+
+
+def test_run_registry_single_flight_claims(redis_client):
+    registry = run_registry.RunRegistry(redis_client, "worker-a")
+    other = run_registry.RunRegistry(redis_client, "worker-b")
+    key = ("write a report", True)
+    owner_run, other_run = new_run_id(), new_run_id()
+
+    assert registry.claim_flight(key, owner_run) is None
+    assert other.claim_flight(key, other_run) == owner_run
+    other.release_flight(key, other_run) # Not the owner: no effect
+    assert other.claim_flight(key, other_run) == owner_run
+    registry.release_flight(key, owner_run)
+    assert other.claim_flight(key, other_run) is None
+
+
+def test_run_registry_degrades_when_redis_fails():
+    class BrokenRedis:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise ConnectionError("registry down")
+            return fail
+
+    registry = run_registry.RunRegistry(BrokenRedis(), "worker-a")
+    run_id = new_run_id()
+    registry.set_run_state(run_id, "running")
+    assert registry.get_run_state(run_id) is None
+    assert registry.claim_flight(("task",), run_id) is None
+    assert registry.stats()["errors"] == 3
+
+
+# --- ModelRateLimiter with shared buckets ---
+def test_rate_limiter_buckets_are_shared_by_workers(redis_client):
+    limiter = app.ModelRateLimiter(60, 1000, {}, shared=run_registry.RedisRateBuckets(redis_client))
+    other = app.ModelRateLimiter(60, 1000, {}, shared=run_registry.RedisRateBuckets(redis_client))
+    limiter.scale(0.5) # Only the process-local fallback buckets are scaled
+
+    assert limiter.try_acquire("gpt-4o", 600)
+    assert not other.try_acquire("gpt-4o", 600)
+    other.reconcile("gpt-4o", 600, 100)
+    assert other.try_acquire("gpt-4o", 600)
+    assert limiter.stats()["models"]["gpt-4o"]["tpm"] == 1000
+
+
+def test_rate_limiter_spaces_out_concurrent_callers(redis_client, monkeypatch):
+    waits = []
+    monkeypatch.setattr(app.time, "sleep", waits.append)
+    limiters = [app.ModelRateLimiter(60, 0, {}, shared=run_registry.RedisRateBuckets(redis_client)) for _ in range(2)]
+    threads = [threading.Thread(target=limiter.acquire, args=("gpt-4o", 1)) for limiter in limiters for _ in range(31)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    # 60 requests fit the bucket; the other two wait for their refill (one request per second)
+    assert sorted(round(wait) for wait in waits) == [1, 2]
+
+
+# --- HierarchyCache with shared entries ---
+def test_hierarchy_cache_entries_are_shared_by_workers(redis_client):
+    cache = app.HierarchyCache(max_entries=2, ttl_seconds=60, shared=run_registry.RedisHierarchyEntries(redis_client))
+    other = app.HierarchyCache(max_entries=2, ttl_seconds=60, shared=run_registry.RedisHierarchyEntries(redis_client))
+    cache.put("Write a report.", '{"agents": []}')
+
+    assert other.get("write a   REPORT") == '{"agents": []}'
+    other.put("second task", "{}")
+    other.put("third task", "{}")
+    assert cache.get("write a report") is None # Least recently used of three
+    assert cache.stats()["size"] == 2 and other.stats()["evictions"] == 1
+
+
+def test_hierarchy_cache_falls_back_to_local_entries_when_redis_fails(redis_client, monkeypatch):
+    shared = run_registry.RedisHierarchyEntries(redis_client)
+    cache = app.HierarchyCache(shared=shared)
+    monkeypatch.setattr(shared, "put", lambda *args: (_ for _ in ()).throw(ConnectionError("registry down")))
+    monkeypatch.setattr(shared, "get", lambda *args: (_ for _ in ()).throw(ConnectionError("registry down")))
+
+    cache.put("task", "{}")
+    assert cache.get("task") == "{}"
+    assert cache.stats()["errors"] == 2
@@ -0,0 +1,94 @@
+"""RunScheduler admission control: queue positions, dequeueing and the 429 for a full queue."""
+import pytest
+
+import app
+
+
+class FakeEmitter:
+    """Records emits; background tasks only start when the test runs them."""
+    def __init__(self):
+        self.emitted = []
+        self.started = []
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+    def start_background_task(self, target, *args):
+        self.started.append((target, args))
+
+    def run_next(self):
+        target, args = self.started.pop(0)
+        target(*args)
+
+    def positions(self, run_id):
+        return [data["data"]["queue_position"] for event, data, room in self.emitted
+                if room == run_id and data["type"] in ("queued", "queue_position")]
+
+
+@pytest.fixture
+def emitter():
+    return FakeEmitter()
+
+
+def crew(ran):
+    def target(run_id, queue_wait_seconds, **kwargs):
+        ran.append((run_id, kwargs))
+    return target
+
+
+def test_runs_start_until_the_limit_then_queue_in_order(emitter):
+    scheduler = app.RunScheduler(emitter, max_concurrent=2, max_queue=5)
+    ran = []
+    positions = [scheduler.submit(run_id, crew(ran), task_description=run_id) for run_id in ("a", "b", "c", "d")]
+
+    assert positions == [0, 0, 1, 2]
+    assert [scheduler.queue_position(run_id) for run_id in ("a", "b", "c", "d", "unknown")] == [0, 0, 1, 2, None]
+    assert emitter.positions("c") == [1] and emitter.positions("d") == [2]
+    assert len(emitter.started) == 2
+    stats = scheduler.stats()
+    assert (stats["running"], stats["queued"], stats["admitted"]) == (2, 2, 4)
+
+
+def test_finished_runs_hand_their_slot_to_the_queue_head(emitter):
+    scheduler = app.RunScheduler(emitter, max_concurrent=1, max_queue=5)
+    ran = []
+    for run_id in ("a", "b", "c"):
+        scheduler.submit(run_id, crew(ran), task_description=run_id)
+
+    emitter.run_next() # "a" finishes
+    assert ran == [("a", {"task_description": "a"})]
+    assert scheduler.queue_position("b") == 0 and scheduler.queue_position("c") == 1
+    assert emitter.positions("b") == [1, 0] # Told it is starting
+    assert emitter.positions("c") == [2, 1] # Told it moved up
+    assert scheduler.queue_position("a") is None and scheduler.stats()["completed"] == 1
+
+
+def test_a_failing_run_still_releases_its_slot(emitter):
+    scheduler = app.RunScheduler(emitter, max_concurrent=1, max_queue=1)
+    def broken(run_id, queue_wait_seconds, **kwargs):
+        raise RuntimeError("crew crashed")
+    scheduler.submit("a", broken)
+    scheduler.submit("b", crew([]))
+    emitter.run_next()
+    assert scheduler.queue_position("b") == 0
+
+
+def test_full_queue_raises_and_counts_the_rejection(emitter):
+    scheduler = app.RunScheduler(emitter, max_concurrent=1, max_queue=1)
+    scheduler.submit("a", crew([]))
+    scheduler.submit("b", crew([]))
+    with pytest.raises(app.RunQueueFull):
+        scheduler.submit("c", crew([]))
+    assert scheduler.stats()["rejected"] == 1 and scheduler.queue_position("c") is None
+
+
+def test_submit_run_answers_429_with_retry_after_when_the_queue_is_full(emitter, monkeypatch):
+    monkeypatch.setattr(app, "run_scheduler", app.RunScheduler(emitter, max_concurrent=1, max_queue=0))
+    options = {"use_hierarchy_cache": True}
+
+    body, status, _ = app.submit_run("first task", options, False, emitter)
+    assert status == 202 and body["queue_position"] == 0
+    body, status, headers = app.submit_run("second task", options, False, emitter)
+    assert status == 429
+    assert headers == {"Retry-After": str(app.RUN_QUEUE_RETRY_AFTER_SECONDS)}
+    assert "run queue is full" in body["error"]